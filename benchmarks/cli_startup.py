@@ -0,0 +1,77 @@
+"""
+Benchmark the startup time of the ``wrangler`` CLI
+
+Runs ``wrangler --help`` and the help of each subcommand with ``-X importtime`` several
+times, and reports the median wall time, the median time spent importing, and the
+packages with the highest cumulative import time for each command. Results are printed
+as JSON.
+
+    python benchmarks/cli_startup.py --runs 5
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import time
+
+COMMANDS = [
+    [],
+    ["serve", "text-transform"],
+    ["serve", "image-generate"],
+    ["run", "text-transform"],
+    ["run", "image-generate"],
+]
+
+
+def _run(command: list[str]) -> tuple[float, dict[str, int]]:
+    """
+    :return: Wall time in seconds and the cumulative import time in microseconds of
+    each top level package
+    """
+    start = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-m", "wrangler", *command, "--help"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    elapsed = time.perf_counter() - start
+    packages = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")
+        # Top level imports are the only ones not indented under another import
+        if not name.startswith("  ") and cumulative.strip().isdigit():
+            packages[name.strip()] = int(cumulative)
+    return elapsed, packages
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=5)
+    args = parser.parse_args()
+
+    results = {}
+    for command in COMMANDS:
+        runs = [_run(command) for _ in range(args.runs)]
+        _, packages = runs[-1]
+        results[" ".join(["wrangler", *command, "--help"])] = {
+            "wall_ms": round(statistics.median(elapsed for elapsed, _ in runs) * 1000, 1),
+            "import_ms": round(
+                statistics.median(sum(packages_.values()) for _, packages_ in runs) / 1000, 1
+            ),
+            "slowest_imports_ms": {
+                name: round(cumulative / 1000, 1)
+                for name, cumulative in sorted(
+                    packages.items(), key=lambda item: item[1], reverse=True
+                )[: args.top]
+            },
+        }
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
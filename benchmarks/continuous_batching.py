@@ -0,0 +1,109 @@
+"""
+Benchmark the continuous batching engine against one at a time generation
+
+Loads the tiny text transform test model in process, submits a set of requests with
+mixed prompt and generation lengths at once, and reports generated tokens per second and
+request latency percentiles for sequential ``model.generate`` calls and for the
+continuous batching engine. Results are printed as JSON.
+
+    python benchmarks/continuous_batching.py --requests 64 --max-batch-size 16
+"""
+import argparse
+import json
+import pathlib
+import random
+import statistics
+import time
+from uuid import uuid4
+
+from wrangler.engine import ContinuousBatchingEngine
+from wrangler.model_handlers import TextTransformModelHandler
+
+TEXT_TRANSFORM_TEST_MODEL = str(
+    pathlib.Path(__file__).parent.parent.joinpath(
+        "test/assets/hf-internal-testing_tiny-random-gpt2"
+    )
+)
+
+WORDS = "how now brown cow the quick fox jumps over a lazy dog".split()
+
+
+def _percentile(values: list[float], percentile: float) -> float:
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, round(percentile / 100 * (len(ordered) - 1)))
+    return ordered[index]
+
+
+def _summary(latencies: list[float], tokens: int, elapsed: float) -> dict:
+    return {
+        "tokens_per_second": round(tokens / elapsed, 2),
+        "elapsed_seconds": round(elapsed, 3),
+        "latency_ms": {
+            "mean": round(statistics.mean(latencies) * 1000, 3),
+            "p50": round(_percentile(latencies, 50) * 1000, 3),
+            "p99": round(_percentile(latencies, 99) * 1000, 3),
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--model", default=TEXT_TRANSFORM_TEST_MODEL)
+    parser.add_argument("--requests", type=int, default=64)
+    parser.add_argument("--max-batch-size", type=int, default=16)
+    parser.add_argument("--min-new-tokens", type=int, default=4)
+    parser.add_argument("--max-new-tokens", type=int, default=64)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    requests = [
+        (
+            " ".join(rng.choices(WORDS, k=rng.randint(1, 16))),
+            rng.randint(args.min_new_tokens, args.max_new_tokens),
+        )
+        for _ in range(args.requests)
+    ]
+
+    model, tokenizer = TextTransformModelHandler(args.model, None, None)._get_model_and_tokenizer()
+    eos_token_id = model.generation_config.eos_token_id
+
+    # Every request is submitted at the start so latency includes the time spent waiting
+    latencies = []
+    tokens = 0
+    start = time.perf_counter()
+    for input_, max_new_tokens in requests:
+        tensor = tokenizer(input_, return_tensors="pt", return_token_type_ids=False)
+        output = model.generate(**tensor, max_new_tokens=max_new_tokens, pad_token_id=eos_token_id)
+        tokens += output.shape[1] - tensor["input_ids"].shape[1]
+        latencies.append(time.perf_counter() - start)
+    sequential = _summary(latencies, tokens, time.perf_counter() - start)
+
+    engine = ContinuousBatchingEngine(model, tokenizer, args.max_batch_size)
+    latencies = []
+    tokens = 0
+    start = time.perf_counter()
+    for input_, max_new_tokens in requests:
+        engine.add(uuid4(), input_, max_new_tokens=max_new_tokens)
+    while engine.has_work:
+        for _, result, _ in engine.step():
+            tokens += len(tokenizer(result)["input_ids"])
+            latencies.append(time.perf_counter() - start)
+    prompt_tokens = sum(len(tokenizer(input_)["input_ids"]) for input_, _ in requests)
+    continuous = _summary(latencies, tokens - prompt_tokens, time.perf_counter() - start)
+
+    print(
+        json.dumps(
+            {
+                "requests": args.requests,
+                "max_batch_size": args.max_batch_size,
+                "sequential": sequential,
+                "continuous_batching": continuous,
+            },
+            indent=2,
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""
+Benchmark the time and size of encoding generated images in each format with each
+encoding option, and the throughput of encoding several images one at a time against
+encoding them concurrently on a pool of threads
+
+The image is a smooth gradient with noise, which compresses like a generated image.
+Results are printed as JSON.
+
+    python benchmarks/image_encoding.py --size 512 --images 8
+"""
+import argparse
+import json
+import os
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from PIL import Image
+
+from wrangler.images import encode_image
+from wrangler.models import ImageFormat
+
+CONFIGURATIONS = {
+    "PNG": (ImageFormat.png, {}),
+    "PNG compress_level=1": (ImageFormat.png, {"compress_level": 1}),
+    "PNG compress_level=0": (ImageFormat.png, {"compress_level": 0}),
+    "JPEG": (ImageFormat.jpg, {}),
+    "JPEG quality=95": (ImageFormat.jpg, {"quality": 95}),
+    "WEBP": (ImageFormat.webp, {}),
+    "WEBP quality=95": (ImageFormat.webp, {"quality": 95}),
+    "GIF": (ImageFormat.gif, {}),
+}
+
+
+def _image(size: int) -> Image.Image:
+    gradient = Image.linear_gradient("L").resize((size, size))
+    noise = Image.effect_noise((size, size), 16)
+    return Image.merge("RGB", (gradient, noise, gradient.transpose(Image.Transpose.ROTATE_90)))
+
+
+def _pil_defaults(image: Image.Image, image_format: ImageFormat) -> bytes:
+    """Encoding with PIL's defaults, as before the format specific fast paths"""
+    output = BytesIO()
+    image.save(output, format=image_format.value)
+    return output.getvalue()
+
+
+def _time(runs: int, function, *args, **kwargs) -> float:
+    durations = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        function(*args, **kwargs)
+        durations.append(time.perf_counter() - start)
+    return statistics.median(durations)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--size", type=int, default=512)
+    parser.add_argument("--images", type=int, default=8)
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    image = _image(args.size)
+    formats = {}
+    for name, (image_format, options) in CONFIGURATIONS.items():
+        formats[name] = {
+            "encode_ms": round(
+                _time(args.runs, encode_image, image, image_format, **options) * 1000, 2
+            ),
+            "bytes": len(encode_image(image, image_format, **options)),
+        }
+    for image_format in (ImageFormat.webp, ImageFormat.gif):
+        formats[f"{image_format.value} PIL defaults"] = {
+            "encode_ms": round(_time(args.runs, _pil_defaults, image, image_format) * 1000, 2),
+            "bytes": len(_pil_defaults(image, image_format)),
+        }
+
+    def serial():
+        for _ in range(args.images):
+            encode_image(image, ImageFormat.png)
+
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+
+        def pooled():
+            list(executor.map(lambda _: encode_image(image, ImageFormat.png), range(args.images)))
+
+        throughput = {
+            "serial_images_per_second": round(args.images / _time(args.runs, serial), 2),
+            "pooled_images_per_second": round(args.images / _time(args.runs, pooled), 2),
+            "threads": os.cpu_count(),
+        }
+    print(json.dumps({"formats": formats, "png_throughput": throughput}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
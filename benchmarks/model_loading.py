@@ -0,0 +1,92 @@
+"""
+Benchmark the time to load a text transform model and the peak memory used to load it
+
+Loads the model in a fresh process with the default loading, with fast loading and an
+empty cache (which includes converting the weights to safetensors), and with fast
+loading from the converted weights. Each run reports the time until the model is ready
+to generate and the peak resident memory of the process. Results are printed as JSON.
+
+    python benchmarks/model_loading.py --runs 3 --model gpt2
+"""
+import argparse
+import json
+import pathlib
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+TEXT_TRANSFORM_TEST_MODEL = str(
+    pathlib.Path(__file__).parent.parent.joinpath(
+        "test/assets/hf-internal-testing_tiny-random-gpt2"
+    )
+)
+
+
+def _load(model: str, fast_load_cache: str | None) -> None:
+    """Load the model in this process and print the load time and peak memory as JSON"""
+    from wrangler.model_handlers import TextTransformModelHandler
+
+    # Imports are not part of loading the model
+    start = time.perf_counter()
+    handler = TextTransformModelHandler(
+        model,
+        None,
+        None,
+        fast_load_cache=pathlib.Path(fast_load_cache) if fast_load_cache else None,
+    )
+    handler._get_model_and_tokenizer()
+    print(
+        json.dumps(
+            {
+                "seconds": time.perf_counter() - start,
+                "peak_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+            }
+        )
+    )
+
+
+def _run(model: str, fast_load_cache: str | None) -> dict:
+    args = [sys.executable, __file__, "--model", model, "--load"]
+    if fast_load_cache:
+        args.extend(["--fast-load-cache", fast_load_cache])
+    result = subprocess.run(args, capture_output=True, text=True, check=True)
+    return json.loads(result.stdout.splitlines()[-1])
+
+
+def _summary(runs: list[dict]) -> dict:
+    return {
+        "time_to_ready_seconds": round(statistics.median(run["seconds"] for run in runs), 3),
+        "peak_rss_mib": round(
+            statistics.median(run["peak_rss_bytes"] for run in runs) / 2**20, 1
+        ),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--model", default=TEXT_TRANSFORM_TEST_MODEL)
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--load", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--fast-load-cache", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.load:
+        _load(args.model, args.fast_load_cache)
+        return
+
+    results = {"default": _summary([_run(args.model, None) for _ in range(args.runs)])}
+    first_runs, fast_runs = [], []
+    for _ in range(args.runs):
+        with tempfile.TemporaryDirectory() as cache:
+            first_runs.append(_run(args.model, cache))
+            fast_runs.append(_run(args.model, cache))
+    results["fast_load_converting"] = _summary(first_runs)
+    results["fast_load"] = _summary(fast_runs)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
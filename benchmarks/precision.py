@@ -0,0 +1,132 @@
+"""
+Benchmark the latency, memory and output drift of text transform models loaded in each
+dtype and quantization against the fp32 baseline
+
+Each configuration loads the model in a fresh process, generates the prompts one at a
+time, and reports the median generation latency, the peak resident memory of the
+process, and the logits of a forward pass over the prompts. The logits are compared with
+those of the fp32 model, along with how many greedy generations match the fp32 ones.
+Results are printed as JSON.
+
+    python benchmarks/precision.py --runs 5 --model gpt2
+"""
+import argparse
+import json
+import pathlib
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+TEXT_TRANSFORM_TEST_MODEL = str(
+    pathlib.Path(__file__).parent.parent.joinpath(
+        "test/assets/hf-internal-testing_tiny-random-gpt2"
+    )
+)
+
+PROMPTS = [
+    "How now brown cow",
+    "The quick brown fox jumps over the lazy dog",
+    "Once upon a time there was a",
+    "The capital of France is",
+]
+
+CONFIGURATIONS = {
+    "fp32": ("fp32", None),
+    "bf16": ("bf16", None),
+    "fp16": ("fp16", None),
+    "fp32-dynamic-int8": ("fp32", "dynamic-int8"),
+}
+
+
+def _measure(model: str, dtype: str, quantize: str | None, runs: int, logits_file: str) -> None:
+    """Load the model in this process, generate from the prompts and print the results"""
+    import torch
+
+    from wrangler.model_handlers import TextTransformModelHandler
+    from wrangler.models import TextTransformRequest
+
+    handler = TextTransformModelHandler(model, None, None, dtype=dtype, quantize=quantize)
+    model_, tokenizer = handler._get_model_and_tokenizer()
+    with torch.no_grad():
+        inputs = tokenizer(PROMPTS, return_tensors="pt", padding=True)
+        torch.save(model_(**inputs).logits.float(), logits_file)
+    latencies = []
+    texts = []
+    for _ in range(runs):
+        texts = []
+        start = time.perf_counter()
+        for prompt in PROMPTS:
+            request = TextTransformRequest(input=prompt)
+            texts.extend(handler._generate_results(model_, tokenizer, [request])[0])
+        latencies.append((time.perf_counter() - start) / len(PROMPTS))
+    print(
+        json.dumps(
+            {
+                "latency_seconds": statistics.median(latencies),
+                "peak_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+                "texts": texts,
+            }
+        )
+    )
+
+
+def _run(model: str, dtype: str, quantize: str | None, runs: int, logits_file: str) -> dict:
+    args = [sys.executable, __file__, "--model", model, "--runs", str(runs), "--measure"]
+    args.extend(["--dtype", dtype, "--logits-file", logits_file])
+    if quantize:
+        args.extend(["--quantize", quantize])
+    result = subprocess.run(args, capture_output=True, text=True)
+    if result.returncode:
+        # Such as fp16 layers without a CPU kernel
+        return {"error": result.stderr.strip().splitlines()[-1]}
+    return json.loads(result.stdout.splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--model", default=TEXT_TRANSFORM_TEST_MODEL)
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--measure", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--dtype", default="fp32", help=argparse.SUPPRESS)
+    parser.add_argument("--quantize", help=argparse.SUPPRESS)
+    parser.add_argument("--logits-file", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure:
+        _measure(args.model, args.dtype, args.quantize, args.runs, args.logits_file)
+        return
+
+    import torch
+
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        logits_files = {name: str(pathlib.Path(directory, name)) for name in CONFIGURATIONS}
+        runs = {
+            name: _run(args.model, dtype, quantize, args.runs, logits_files[name])
+            for name, (dtype, quantize) in CONFIGURATIONS.items()
+        }
+        baseline_logits = torch.load(logits_files["fp32"])
+        for name, run in runs.items():
+            if "error" in run:
+                results[name] = run
+                continue
+            drift = (torch.load(logits_files[name]) - baseline_logits).abs()
+            results[name] = {
+                "latency_ms": round(run["latency_seconds"] * 1000, 2),
+                "peak_rss_mib": round(run["peak_rss_bytes"] / 2**20, 1),
+                "max_logit_drift": round(drift.max().item(), 5),
+                "mean_logit_drift": round(drift.mean().item(), 5),
+                "matching_generations": sum(
+                    text == baseline
+                    for text, baseline in zip(run["texts"], runs["fp32"]["texts"], strict=True)
+                ),
+                "generations": len(run["texts"]),
+            }
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
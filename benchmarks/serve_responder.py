@@ -0,0 +1,121 @@
+"""
+Benchmark idle CPU usage and round trip latency of ``wrangler serve``
+
+Starts the server against the tiny text transform test model on a unix socket, measures
+the CPU consumed by the server process tree while it sits idle, then measures the round
+trip latency of sequential requests. Results are printed as JSON.
+
+    python benchmarks/serve_responder.py --idle-seconds 5 --requests 200
+"""
+import argparse
+import json
+import os
+import pathlib
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+import psutil
+
+TEXT_TRANSFORM_TEST_MODEL = str(
+    pathlib.Path(__file__).parent.parent.joinpath(
+        "test/assets/hf-internal-testing_tiny-random-gpt2"
+    )
+)
+
+
+def _cpu_seconds(process: psutil.Process) -> float:
+    total = 0.0
+    for proc in [process, *process.children(recursive=True)]:
+        try:
+            times = proc.cpu_times()
+        except psutil.NoSuchProcess:
+            continue
+        total += times.user + times.system
+    return total
+
+
+def _percentile(values: list[float], percentile: float) -> float:
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, round(percentile / 100 * (len(ordered) - 1)))
+    return ordered[index]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--model", default=TEXT_TRANSFORM_TEST_MODEL)
+    parser.add_argument("--idle-seconds", type=float, default=5.0)
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument("--startup-timeout", type=float, default=60.0)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_directory:
+        socket_filename = os.path.join(temp_directory, "wrangler.sock")
+        server = subprocess.Popen(
+            [
+                sys.executable,
+                "-m",
+                "wrangler",
+                "serve",
+                "--bind",
+                f"unix:{socket_filename}",
+                "text-transform",
+                args.model,
+            ],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        try:
+            client = httpx.Client(transport=httpx.HTTPTransport(uds=socket_filename))
+            start = time.perf_counter()
+            while True:
+                try:
+                    # The first request blocks until the model has loaded
+                    client.post("http://socket/", json={"input": "warm up"}, timeout=None)
+                    break
+                except httpx.TransportError:
+                    if time.perf_counter() - start > args.startup_timeout:
+                        raise
+                    time.sleep(0.05)
+
+            process = psutil.Process(server.pid)
+            cpu_start = _cpu_seconds(process)
+            time.sleep(args.idle_seconds)
+            idle_cpu_percent = (_cpu_seconds(process) - cpu_start) / args.idle_seconds * 100
+
+            latencies = []
+            for _ in range(args.requests):
+                request_start = time.perf_counter()
+                response = client.post("http://socket/", json={"input": "How now brown"})
+                latencies.append((time.perf_counter() - request_start) * 1000)
+                response.raise_for_status()
+        finally:
+            for child in psutil.Process(server.pid).children(recursive=True):
+                child.kill()
+            server.kill()
+            server.wait()
+
+    print(
+        json.dumps(
+            {
+                "idle_seconds": args.idle_seconds,
+                "idle_cpu_percent": round(idle_cpu_percent, 2),
+                "requests": args.requests,
+                "latency_ms": {
+                    "min": round(min(latencies), 3),
+                    "mean": round(statistics.mean(latencies), 3),
+                    "p50": round(_percentile(latencies, 50), 3),
+                    "p95": round(_percentile(latencies, 95), 3),
+                    "p99": round(_percentile(latencies, 99), 3),
+                },
+            },
+            indent=2,
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+"""
+Benchmark assisted generation with a draft model against generating without one
+
+Loads a model and a draft model sharing its tokenizer in process, generates greedily for
+a set of prompts one at a time with and without the draft model, and reports generated
+tokens per second, the drafted tokens the model accepted and the tokens generated per
+forward pass of the model. Outputs with the draft model are checked to match the
+outputs without it. Results are printed as JSON.
+
+The tiny text transform test model is used for both by default, which only exercises the
+code path. Pass a model and a much smaller draft, such as ``gpt2-large`` and
+``distilgpt2``, for a meaningful speedup.
+
+    python benchmarks/speculative_decoding.py --model gpt2-large --draft-model distilgpt2
+"""
+import argparse
+import json
+import pathlib
+import random
+import time
+
+from wrangler.metrics import Timings
+from wrangler.model_handlers import TextTransformModelHandler
+from wrangler.models import TextTransformRequest
+
+TEXT_TRANSFORM_TEST_MODEL = str(
+    pathlib.Path(__file__).parent.parent.joinpath(
+        "test/assets/hf-internal-testing_tiny-random-gpt2"
+    )
+)
+
+WORDS = "how now brown cow the quick fox jumps over a lazy dog".split()
+
+
+def _generate(model, tokenizer, requests, draft_model=None) -> tuple[list, Timings, float]:
+    """
+    :return: Generated sequences, the timings of every request summed, and the wall time
+    """
+    total = Timings(started=0.0)
+    results = []
+    start = time.perf_counter()
+    for request in requests:
+        timings = Timings(started=0.0)
+        results.append(
+            TextTransformModelHandler._generate_results(
+                model, tokenizer, [request], [timings], draft_model=draft_model
+            )
+        )
+        total.tokens += timings.tokens
+        total.draft_tokens += timings.draft_tokens
+        total.accepted_tokens += timings.accepted_tokens
+        total.model_passes += timings.model_passes
+    return results, total, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--model", default=TEXT_TRANSFORM_TEST_MODEL)
+    parser.add_argument("--draft-model", default=TEXT_TRANSFORM_TEST_MODEL)
+    parser.add_argument("--requests", type=int, default=16)
+    parser.add_argument("--max-new-tokens", type=int, default=64)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    requests = [
+        TextTransformRequest(
+            input=" ".join(rng.choices(WORDS, k=rng.randint(1, 16))),
+            max_new_tokens=args.max_new_tokens,
+        )
+        for _ in range(args.requests)
+    ]
+
+    handler = TextTransformModelHandler(args.model, None, None, draft_model=args.draft_model)
+    model, tokenizer = handler._get_model_and_tokenizer()
+    draft_model = handler._get_draft_model(model, tokenizer)
+    # Warm up both paths so the first timed request does not pay for lazy initialization
+    _generate(model, tokenizer, requests[:1])
+    _generate(model, tokenizer, requests[:1], draft_model)
+
+    expected, timings, elapsed = _generate(model, tokenizer, requests)
+    actual, draft_timings, draft_elapsed = _generate(model, tokenizer, requests, draft_model)
+    passes = draft_timings.model_passes
+    print(
+        json.dumps(
+            {
+                "without_draft": {
+                    "tokens_per_second": round(timings.tokens / elapsed, 2),
+                    "elapsed_seconds": round(elapsed, 3),
+                },
+                "with_draft": {
+                    "tokens_per_second": round(draft_timings.tokens / draft_elapsed, 2),
+                    "elapsed_seconds": round(draft_elapsed, 3),
+                    "drafted_tokens": draft_timings.draft_tokens,
+                    "accepted_tokens": draft_timings.accepted_tokens,
+                    "acceptance_rate": round(
+                        draft_timings.accepted_tokens / max(draft_timings.draft_tokens, 1), 3
+                    ),
+                    "tokens_per_model_pass": round(
+                        (draft_timings.accepted_tokens + passes) / max(passes, 1), 3
+                    ),
+                },
+                "speedup": round(elapsed / draft_elapsed, 3),
+                "outputs_match": expected == actual,
+            },
+            indent=2,
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+"""
+Benchmark the cost of sending requests and responses between processes as pickled
+pydantic objects on a multiprocessing queue against the compact wire format
+
+Each kind of message is encoded and decoded in process to measure the serialization
+cost and frame size, then sent from a child process to this one to measure the per
+message cost of crossing the process boundary. Results are printed as JSON.
+
+    python benchmarks/wire_format.py --messages 20000
+"""
+import argparse
+import json
+import multiprocessing as mp
+import pickle
+import time
+from uuid import uuid4
+
+from wrangler.metrics import Timings
+from wrangler.models import TextTransformRequest, TextTransformResponse, TextTransformToken
+from wrangler.wire import (
+    RequestChannel,
+    ResponseChannel,
+    decode_request,
+    decode_response,
+    encode_request,
+    encode_response,
+)
+
+TIMINGS = Timings(started=1.0, model=0.5, tokenize=0.01, decode=0.01, tokens=20, batch_size=4)
+
+MESSAGES = {
+    "token": (uuid4(), TextTransformToken(text=" brown"), None),
+    "response": (
+        uuid4(),
+        TextTransformResponse(generated_text="How now brown cow " * 8),
+        TIMINGS,
+    ),
+    "request": (uuid4(), TextTransformRequest(input="How now brown cow", max_new_tokens=64), 9.0),
+}
+
+
+class _PickledQueue:
+    """The previous transport, a multiprocessing queue of pickled tuples"""
+
+    def __init__(self) -> None:
+        self._queue: mp.Queue = mp.Queue()
+
+    def put(self, item) -> None:
+        self._queue.put(item)
+
+    def get(self):
+        return self._queue.get()
+
+
+def _codecs(name: str) -> dict:
+    encode, decode = encode_response, decode_response
+    if name == "request":
+        encode, decode = encode_request, decode_request
+    return {
+        "pickle": (pickle.dumps, pickle.loads),
+        "wire": (lambda item: encode(*item), decode),
+    }
+
+
+def _send(channel, item, messages: int) -> None:
+    for _ in range(messages):
+        channel.put(item)
+
+
+def _in_process(name: str, messages: int) -> dict:
+    results = {}
+    item = MESSAGES[name]
+    for codec, (encode, decode) in _codecs(name).items():
+        start = time.perf_counter()
+        for _ in range(messages):
+            decode(encode(item))
+        results[codec] = {
+            "encode_decode_us": round((time.perf_counter() - start) / messages * 1e6, 2),
+            "bytes": len(encode(item)),
+        }
+    return results
+
+
+def _across_processes(name: str, messages: int) -> dict:
+    results = {}
+    item = MESSAGES[name]
+    wire_channel = RequestChannel() if name == "request" else ResponseChannel()
+    for transport, channel in (("pickle", _PickledQueue()), ("wire", wire_channel)):
+        process = mp.Process(target=_send, args=(channel, item, messages))
+        start = time.perf_counter()
+        process.start()
+        if isinstance(channel, ResponseChannel):
+            channel.close_writer()
+        for _ in range(messages):
+            channel.get()
+        elapsed = time.perf_counter() - start
+        process.join()
+        results[transport] = round(elapsed / messages * 1e6, 2)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--messages", type=int, default=10000)
+    args = parser.parse_args()
+
+    results = {}
+    for name in MESSAGES:
+        in_process = _in_process(name, args.messages)
+        across_processes = _across_processes(name, args.messages)
+        results[name] = {
+            transport: {**in_process[transport], "per_message_us": across_processes[transport]}
+            for transport in ("pickle", "wire")
+        }
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
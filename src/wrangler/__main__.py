@@ -1,5 +1,7 @@
 """Module execution file"""
 
+import json
+import os
 import pathlib
 import typing as t
 from dataclasses import dataclass
@@ -7,19 +9,8 @@ from dataclasses import dataclass
 import click
 from click import Context, ParamType, Parameter
 
-from wrangler.cli import (
-    serve as cli_serve,
-    run as cli_run,
-    run_image_generate as cli_run_image,
-)
-from wrangler.model_handlers import (
-    TextTransformModelHandler,
-    ImageGenerateModelHandler,
-)
-from wrangler.request_handlers import (
-    TextTransformRequestHandler,
-    ImageGenerateRequestHandler,
-)
+# Commands import the model handlers, request handlers and server when they run, so the
+# CLI starts and shows help without loading torch, transformers, diffusers or fastapi
 
 
 @dataclass(frozen=True)
@@ -33,6 +24,8 @@ class ModelIdentifier:
 class ModelIdentifierType(ParamType):
     """ParamType for converting a model identifier string into a ModelIdentifier Object"""
 
+    name = "model_identifier"
+
     def convert(
         self, value: str, param: t.Optional[Parameter], ctx: t.Optional[Context]
     ) -> ModelIdentifier:
@@ -51,6 +44,102 @@ class ServeConfig:
     bind: list[str]
     access_log: str
     error_log: str
+    workers: int
+    threads_per_worker: int | None
+    pin_workers: bool
+    request_timeout: float | None
+    max_queue_depth: int | None
+    warm_up_inputs: tuple[str, ...]
+    max_model_memory: int | None
+    trace_file: pathlib.Path | None
+    trace_format: str
+    profile_directory: pathlib.Path | None
+
+
+def fast_load_options(command):
+    """Add the options for loading models quickly to a command"""
+    command = click.option(
+        "--fast-load-cache",
+        envvar="MODEL_FAST_LOAD_CACHE",
+        help="Directory in which --fast-load keeps converted models. Defaults to wrangler "
+        "in the user's cache directory.",
+        default=None,
+        show_envvar=True,
+        type=click.Path(dir_okay=True, file_okay=False, path_type=pathlib.Path),
+    )(command)
+    return click.option(
+        "--fast-load/--no-fast-load",
+        envvar="MODEL_FAST_LOAD",
+        help="Load model weights by memory mapping safetensors files. PyTorch checkpoints "
+        "are converted to safetensors once and kept in --fast-load-cache.",
+        default=False,
+        show_default=True,
+        show_envvar=True,
+    )(command)
+
+
+def precision_options(command):
+    """Add the options for the precision of model weights to a command"""
+    command = click.option(
+        "--quantize",
+        envvar="MODEL_QUANTIZE",
+        help="Quantize the weights of linear layers to int8 once the model has loaded. "
+        "Activations are quantized on the fly and the layers run as int8 matrix "
+        "multiplications. Requires --dtype fp32. By default, weights are not quantized.",
+        default=None,
+        show_envvar=True,
+        type=click.Choice(["dynamic-int8"]),
+    )(command)
+    return click.option(
+        "--dtype",
+        envvar="MODEL_DTYPE",
+        help="Data type in which to load model weights. bf16 halves the memory used by "
+        "the weights and is fast on CPUs with bf16 instructions. fp16 requires every "
+        "layer of the model to have a CPU fp16 kernel.",
+        default="fp32",
+        show_default=True,
+        show_envvar=True,
+        type=click.Choice(["fp32", "bf16", "fp16"]),
+    )(command)
+
+
+def draft_model_option(command):
+    """Add the option for a draft model that drafts tokens for the model to a command"""
+    return click.option(
+        "--draft-model",
+        envvar="MODEL_DRAFT_MODEL",
+        help="Small model sharing the model's tokenizer which drafts tokens that the model "
+        "verifies several at a time in one forward pass. Greedy results are "
+        "unchanged. Only requests generated alone and for a single sequence are drafted "
+        "for. By default, the model generates one token per forward pass.",
+        default=None,
+        show_envvar=True,
+        metavar="MODEL[:REVISION]",
+        type=ModelIdentifierType(),
+    )(command)
+
+
+def quantization(dtype: str, quantize: str | None) -> str | None:
+    """
+    Quantization method after checking the model weights can be quantized in the dtype
+    """
+    if quantize is not None and dtype != "fp32":
+        raise click.UsageError(f"--quantize {quantize} requires --dtype fp32, not {dtype}")
+    return quantize
+
+
+def fast_load_cache_directory(
+    fast_load: bool, fast_load_cache: pathlib.Path | None
+) -> pathlib.Path | None:
+    """
+    Directory in which converted models are kept or None when fast loading is disabled
+    """
+    if not fast_load:
+        return None
+    if fast_load_cache is not None:
+        return fast_load_cache
+    cache_home = os.environ.get("XDG_CACHE_HOME", pathlib.Path.home().joinpath(".cache"))
+    return pathlib.Path(cache_home, "wrangler")
 
 
 @click.group(name="wrangler")
@@ -93,6 +182,106 @@ def main():
     show_default=False,
     show_envvar=True,
 )
+@click.option(
+    "--workers",
+    envvar="MODEL_WORKERS",
+    help="Number of model processes to serve requests. Requests are sent to the process "
+    "with the fewest outstanding requests.",
+    default=1,
+    show_default=True,
+    show_envvar=True,
+    type=click.IntRange(min=1),
+)
+@click.option(
+    "--threads-per-worker",
+    envvar="MODEL_THREADS_PER_WORKER",
+    help="Number of CPU threads each model process will use. Defaults to the available "
+    "CPUs divided by the number of workers when there are multiple workers.",
+    default=None,
+    show_envvar=True,
+    type=click.IntRange(min=1),
+)
+@click.option(
+    "--pin-workers/--no-pin-workers",
+    envvar="MODEL_PIN_WORKERS",
+    help="Pin each model process to its own set of CPU cores",
+    default=False,
+    show_default=True,
+    show_envvar=True,
+)
+@click.option(
+    "--request-timeout",
+    envvar="SERVER_REQUEST_TIMEOUT",
+    help="Maximum number of seconds to wait for the model to respond to a request. "
+    "Requests which time out receive a 504 response and are cancelled in the model "
+    "process. By default, requests do not time out.",
+    default=None,
+    show_envvar=True,
+    type=click.FloatRange(min=0.0, min_open=True),
+)
+@click.option(
+    "--max-queue-depth",
+    envvar="SERVER_MAX_QUEUE_DEPTH",
+    help="Maximum number of requests waiting on the model processes. Additional requests "
+    "receive a 429 response with a Retry-After header. By default, the number of "
+    "waiting requests is not limited.",
+    default=None,
+    show_envvar=True,
+    type=click.IntRange(min=1),
+)
+@click.option(
+    "--warm-up-input",
+    "warm_up_inputs",
+    envvar="MODEL_WARM_UP_INPUTS",
+    help="Input from which each model process generates before it reports ready at "
+    "/ready. May be given multiple times and the inputs are generated as one batch. By "
+    "default, model processes are ready as soon as the model has loaded.",
+    multiple=True,
+    show_envvar=True,
+)
+@click.option(
+    "--max-model-memory",
+    envvar="MODEL_MAX_MEMORY",
+    help="Maximum number of bytes of resident memory the model processes of the loaded "
+    "models may use when serving several models. The least recently used models without "
+    "outstanding requests are unloaded to stay within it and loaded again on demand. By "
+    "default, models stay loaded once loaded.",
+    default=None,
+    show_envvar=True,
+    type=click.IntRange(min=1),
+)
+@click.option(
+    "--trace-file",
+    envvar="SERVER_TRACE_FILE",
+    help="File to which a trace of every request is written as requests complete, with "
+    "spans for the queue wait, the model's tokenize, generate and decode phases, the "
+    "response's trip back to the API process, and its handling there. By default, "
+    "requests are not traced.",
+    default=None,
+    show_envvar=True,
+    type=click.Path(dir_okay=False, writable=True, path_type=pathlib.Path),
+)
+@click.option(
+    "--trace-format",
+    envvar="SERVER_TRACE_FORMAT",
+    help="Format of the trace file. chrome traces open in Perfetto or chrome://tracing, "
+    "and otlp traces are OTLP JSON lines as written by the OpenTelemetry collector.",
+    default="chrome",
+    show_default=True,
+    show_envvar=True,
+    type=click.Choice(["chrome", "otlp"]),
+)
+@click.option(
+    "--profile-dir",
+    "profile_directory",
+    envvar="SERVER_PROFILE_DIR",
+    help="Directory to which model processes write torch.profiler traces of their next "
+    "requests when asked to with POST /admin/profile. By default, the endpoint is not "
+    "served.",
+    default=None,
+    show_envvar=True,
+    type=click.Path(file_okay=False, path_type=pathlib.Path),
+)
 @main.group(name="serve")
 @click.pass_context
 def serve(
@@ -101,10 +290,37 @@ def serve(
     bind: list[str],
     access_log: str,
     error_log: str,
+    workers: int,
+    threads_per_worker: int | None,
+    pin_workers: bool,
+    request_timeout: float | None,
+    max_queue_depth: int | None,
+    warm_up_inputs: tuple[str, ...],
+    max_model_memory: int | None,
+    trace_file: pathlib.Path | None,
+    trace_format: str,
+    profile_directory: pathlib.Path | None,
 ):
-    """Serve a model"""
+    """
+    Serve one or more models. When several MODEL_IDENTIFIERS are given, requests are
+    routed by their model field to a model that is loaded on demand, and the first model
+    serves requests without one.
+    """
     ctx.obj = ServeConfig(
-        service_name=service_name, bind=bind, access_log=access_log, error_log=error_log
+        service_name=service_name,
+        bind=bind,
+        access_log=access_log,
+        error_log=error_log,
+        workers=workers,
+        threads_per_worker=threads_per_worker,
+        pin_workers=pin_workers,
+        request_timeout=request_timeout,
+        max_queue_depth=max_queue_depth,
+        warm_up_inputs=warm_up_inputs,
+        max_model_memory=max_model_memory,
+        trace_file=trace_file,
+        trace_format=trace_format,
+        profile_directory=profile_directory,
     )
 
 
@@ -115,7 +331,7 @@ def run():
 
 
 @serve.command(name="text-transform")
-@click.argument("MODEL_IDENTIFIER", type=ModelIdentifierType())
+@click.argument("MODEL_IDENTIFIERS", type=ModelIdentifierType(), nargs=-1, required=True)
 @click.option(
     "--model-offload-folder",
     envvar="MODEL_OFFLOAD_FOLDER",
@@ -125,26 +341,131 @@ def run():
     show_envvar=True,
     type=click.Path(dir_okay=True, file_okay=False, path_type=pathlib.Path),
 )
+@click.option(
+    "--max-batch-size",
+    envvar="MODEL_MAX_BATCH_SIZE",
+    help="Maximum number of queued requests the model will process together in a single batch.",
+    default=1,
+    show_default=True,
+    show_envvar=True,
+    type=click.IntRange(min=1),
+)
+@click.option(
+    "--batch-timeout",
+    envvar="MODEL_BATCH_TIMEOUT",
+    help="Maximum number of milliseconds to wait for additional requests to fill a batch "
+    "once a request has been received.",
+    default=0.0,
+    show_default=True,
+    show_envvar=True,
+    type=click.FloatRange(min=0.0),
+)
+@click.option(
+    "--continuous-batching/--no-continuous-batching",
+    envvar="MODEL_CONTINUOUS_BATCHING",
+    help="Schedule generation one token at a time so that requests join and leave the "
+    "running batch at every decoding step. Up to --max-batch-size requests are "
+    "generated concurrently and --batch-timeout is not used.",
+    default=False,
+    show_default=True,
+    show_envvar=True,
+)
+@click.option(
+    "--prefix-cache-size",
+    envvar="MODEL_PREFIX_CACHE_SIZE",
+    help="Maximum number of bytes of prompt KV caches each model process keeps. Prompts "
+    "sharing a prefix with a cached prompt only prefill the tokens after the shared "
+    "prefix. By default, prompt KV caches are not kept.",
+    default=0,
+    show_default=True,
+    show_envvar=True,
+    type=click.IntRange(min=0),
+)
+@click.option(
+    "--response-cache-size",
+    envvar="SERVER_RESPONSE_CACHE_SIZE",
+    help="Maximum number of bytes of responses to cache. Identical requests are answered "
+    "from the cache without queueing them for the model. Only requests the model "
+    "generates greedily are cached. By default, responses are not cached.",
+    default=0,
+    show_default=True,
+    show_envvar=True,
+    type=click.IntRange(min=0),
+)
+@click.option(
+    "--response-cache-ttl",
+    envvar="SERVER_RESPONSE_CACHE_TTL",
+    help="Number of seconds after which cached responses expire. By default, cached "
+    "responses only leave the cache when it is full.",
+    default=None,
+    show_envvar=True,
+    type=click.FloatRange(min=0.0, min_open=True),
+)
+@fast_load_options
+@precision_options
+@draft_model_option
 @click.pass_obj
 def text_transform_serve(
     config: ServeConfig,
-    model_identifier: ModelIdentifier,
+    model_identifiers: tuple[ModelIdentifier, ...],
     model_offload_folder: str | None,
+    max_batch_size: int,
+    batch_timeout: float,
+    continuous_batching: bool,
+    prefix_cache_size: int,
+    response_cache_size: int,
+    response_cache_ttl: float | None,
+    fast_load: bool,
+    fast_load_cache: pathlib.Path | None,
+    dtype: str,
+    quantize: str | None,
+    draft_model: ModelIdentifier | None,
 ):
     """Text transform model action"""
+    if draft_model is not None and continuous_batching:
+        raise click.UsageError("--draft-model cannot be used with --continuous-batching")
+    from wrangler.cli import serve as cli_serve
+    from wrangler.model_handlers import TextTransformModelHandler
+    from wrangler.request_handlers import (
+        TextTransformRequestHandler,
+        TextTransformStreamRequestHandler,
+    )
 
     cli_serve(
-        service_name=config.service_name
-        if config.service_name
-        else "Text Transform Model Service",
+        service_name=config.service_name if config.service_name else "Text Transform Model Service",
         model_handler_class=TextTransformModelHandler,
-        model_identifier=model_identifier.model,
-        model_revision=model_identifier.revision,
+        model_identifier=model_identifiers[0].model,
+        model_revision=model_identifiers[0].revision,
         model_offload_folder=model_offload_folder,
+        model_max_batch_size=max_batch_size,
+        model_batch_timeout=batch_timeout,
+        model_continuous_batching=continuous_batching,
         request_handler_class=TextTransformRequestHandler,
+        stream_request_handler_class=TextTransformStreamRequestHandler,
+        model_workers=config.workers,
+        model_threads_per_worker=config.threads_per_worker,
+        model_pin_workers=config.pin_workers,
+        request_timeout=config.request_timeout,
+        max_queue_depth=config.max_queue_depth,
         webserver_bind=config.bind,
         webserver_access_log=config.access_log,
         webserver_error_log=config.error_log,
+        response_cache_size=response_cache_size,
+        response_cache_ttl=response_cache_ttl,
+        model_prefix_cache_size=prefix_cache_size,
+        model_fast_load_cache=fast_load_cache_directory(fast_load, fast_load_cache),
+        model_dtype=dtype,
+        model_quantize=quantization(dtype, quantize),
+        model_warm_up_inputs=config.warm_up_inputs,
+        model_additional_identifiers=tuple(
+            (identifier.model, identifier.revision) for identifier in model_identifiers[1:]
+        ),
+        model_max_memory=config.max_model_memory,
+        trace_file=config.trace_file,
+        trace_format=config.trace_format,
+        profile_directory=config.profile_directory,
+        model_draft_identifier=draft_model.model if draft_model else None,
+        model_draft_revision=draft_model.revision if draft_model else None,
     )
 
 
@@ -160,12 +481,22 @@ def text_transform_serve(
     show_envvar=True,
     type=click.Path(dir_okay=True, file_okay=False, path_type=pathlib.Path),
 )
+@fast_load_options
+@precision_options
+@draft_model_option
 def text_transform_run(
     model_identifier: ModelIdentifier,
     model_offload_folder: str | None,
     input_text: list[str],
+    fast_load: bool,
+    fast_load_cache: pathlib.Path | None,
+    dtype: str,
+    quantize: str | None,
+    draft_model: ModelIdentifier | None,
 ):
     """Text transform model action"""
+    from wrangler.cli import run as cli_run
+    from wrangler.model_handlers import TextTransformModelHandler
 
     cli_run(
         model_handler_class=TextTransformModelHandler,
@@ -173,52 +504,405 @@ def text_transform_run(
         model_revision=model_identifier.revision,
         model_offload_folder=model_offload_folder,
         input_text=" ".join(input_text),
+        model_fast_load_cache=fast_load_cache_directory(fast_load, fast_load_cache),
+        model_dtype=dtype,
+        model_quantize=quantization(dtype, quantize),
+        model_draft_identifier=draft_model.model if draft_model else None,
+        model_draft_revision=draft_model.revision if draft_model else None,
     )
 
 
-@serve.command(name="image-generate")
+@run.command(name="text-transform-batch")
 @click.argument("MODEL_IDENTIFIER", type=ModelIdentifierType())
+@click.argument("INPUT_FILE", type=click.File("r"), default="-")
+@click.option(
+    "--output-file",
+    help='File to which a JSON result is written for each input line. "-" will send to STDOUT',
+    default="-",
+    show_default=True,
+    type=click.File("w"),
+)
+@click.option(
+    "--model-offload-folder",
+    envvar="MODEL_OFFLOAD_FOLDER",
+    help="Filesystem folder in which tensor data will be placed if the tensors cannot "
+    "be stored fully in memory.",
+    default=None,
+    show_envvar=True,
+    type=click.Path(dir_okay=True, file_okay=False, path_type=pathlib.Path),
+)
+@click.option(
+    "--batch-size",
+    envvar="MODEL_BATCH_SIZE",
+    help="Number of requests the model will process together in a single batch.",
+    default=8,
+    show_default=True,
+    show_envvar=True,
+    type=click.IntRange(min=1),
+)
+@fast_load_options
+@precision_options
+def text_transform_run_batch(
+    model_identifier: ModelIdentifier,
+    input_file: t.TextIO,
+    output_file: t.TextIO,
+    model_offload_folder: str | None,
+    batch_size: int,
+    fast_load: bool,
+    fast_load_cache: pathlib.Path | None,
+    dtype: str,
+    quantize: str | None,
+):
+    """
+    Text transform every request in a JSON lines file, loading the model once. Each line
+    of INPUT_FILE is a request object such as {"input": "How now brown"}. Results are
+    written in the same order as the input. INPUT_FILE defaults to STDIN.
+    """
+    from wrangler.cli import run_batch as cli_run_batch
+    from wrangler.model_handlers import TextTransformModelHandler
+
+    cli_run_batch(
+        model_handler_class=TextTransformModelHandler,
+        model_identifier=model_identifier.model,
+        model_revision=model_identifier.revision,
+        model_offload_folder=model_offload_folder,
+        input_file=input_file,
+        output_file=output_file,
+        batch_size=batch_size,
+        model_fast_load_cache=fast_load_cache_directory(fast_load, fast_load_cache),
+        model_dtype=dtype,
+        model_quantize=quantization(dtype, quantize),
+    )
+
+
+@serve.command(name="image-generate")
+@click.argument("MODEL_IDENTIFIERS", type=ModelIdentifierType(), nargs=-1, required=True)
+@click.option(
+    "--max-batch-size",
+    envvar="MODEL_MAX_BATCH_SIZE",
+    help="Maximum number of queued requests the model will process together in a single "
+    "batch. Only requests with the same inference steps and size are batched together.",
+    default=1,
+    show_default=True,
+    show_envvar=True,
+    type=click.IntRange(min=1),
+)
+@click.option(
+    "--batch-timeout",
+    envvar="MODEL_BATCH_TIMEOUT",
+    help="Maximum number of milliseconds to wait for additional requests to fill a batch "
+    "once a request has been received.",
+    default=0.0,
+    show_default=True,
+    show_envvar=True,
+    type=click.FloatRange(min=0.0),
+)
+@click.option(
+    "--encode-workers",
+    envvar="SERVER_ENCODE_WORKERS",
+    help="Number of threads that encode generated images while the model generates the "
+    "next ones. Defaults to the number of CPUs.",
+    default=None,
+    show_envvar=True,
+    type=click.IntRange(min=1),
+)
+@fast_load_options
+@precision_options
 @click.pass_obj
 def image_generation_serve(
     config: ServeConfig,
-    model_identifier: ModelIdentifier,
+    model_identifiers: tuple[ModelIdentifier, ...],
+    max_batch_size: int,
+    batch_timeout: float,
+    encode_workers: int | None,
+    fast_load: bool,
+    fast_load_cache: pathlib.Path | None,
+    dtype: str,
+    quantize: str | None,
 ):
     """Serve an image generation API with an image generation model"""
+    from wrangler.cli import serve as cli_serve
+    from wrangler.model_handlers import ImageGenerateModelHandler
+    from wrangler.request_handlers import ImageGenerateRequestHandler
+
     cli_serve(
         service_name="Image Generation Model Service"
         if config.service_name is None
         else config.service_name,
         model_handler_class=ImageGenerateModelHandler,
         request_handler_class=ImageGenerateRequestHandler,
-        model_identifier=model_identifier.model,
-        model_revision=model_identifier.revision,
+        stream_request_handler_class=None,
+        model_identifier=model_identifiers[0].model,
+        model_revision=model_identifiers[0].revision,
         model_offload_folder=None,
+        model_max_batch_size=max_batch_size,
+        model_batch_timeout=batch_timeout,
+        model_continuous_batching=False,
+        model_workers=config.workers,
+        model_threads_per_worker=config.threads_per_worker,
+        model_pin_workers=config.pin_workers,
+        request_timeout=config.request_timeout,
+        max_queue_depth=config.max_queue_depth,
         webserver_bind=config.bind,
         webserver_access_log=config.access_log,
         webserver_error_log=config.error_log,
+        model_fast_load_cache=fast_load_cache_directory(fast_load, fast_load_cache),
+        model_dtype=dtype,
+        model_quantize=quantization(dtype, quantize),
+        model_warm_up_inputs=config.warm_up_inputs,
+        model_additional_identifiers=tuple(
+            (identifier.model, identifier.revision) for identifier in model_identifiers[1:]
+        ),
+        model_max_memory=config.max_model_memory,
+        trace_file=config.trace_file,
+        trace_format=config.trace_format,
+        profile_directory=config.profile_directory,
+        image_encode_workers=encode_workers,
     )
 
 
 @run.command(name="image-generate")
 @click.argument("MODEL_IDENTIFIER", type=ModelIdentifierType())
 @click.argument(
-    "DESTINATION_FILE",
-    type=click.Path(file_okay=True, dir_okay=False, path_type=pathlib.Path),
+    "DESTINATION",
+    type=click.Path(path_type=pathlib.Path),
 )
-@click.argument("INPUT_TEXT", required=True, nargs=-1)
+@click.argument("INPUT_TEXT", nargs=-1)
+@click.option(
+    "--prompt",
+    "prompts",
+    help="Prompt to generate an image from. May be given several times.",
+    multiple=True,
+)
+@click.option(
+    "--prompt-file",
+    help='File of prompts to generate images from, one per line. "-" will read from STDIN.',
+    type=click.File("r"),
+)
+@click.option(
+    "--format",
+    "image_format",
+    help="Format of the images written for prompts given with --prompt or --prompt-file.",
+    default="PNG",
+    show_default=True,
+    type=click.Choice(["PNG", "JPEG", "GIF", "WEBP"], case_sensitive=False),
+)
+@fast_load_options
+@precision_options
 def image_generation_run(
     model_identifier: ModelIdentifier,
-    destination_file: pathlib.Path,
+    destination: pathlib.Path,
     input_text: list[str],
+    prompts: tuple[str, ...],
+    prompt_file: t.TextIO | None,
+    image_format: str,
+    fast_load: bool,
+    fast_load_cache: pathlib.Path | None,
+    dtype: str,
+    quantize: str | None,
 ):
-    """Serve an image generation API with an image generation model"""
+    """
+    Generate an image from INPUT_TEXT and write it to the DESTINATION file. With prompts
+    given by --prompt or --prompt-file instead, an image is generated from each prompt
+    and written to a numbered file in the DESTINATION directory, while the next image is
+    generated.
+    """
+    if prompt_file is not None:
+        prompts += tuple(line.strip() for line in prompt_file if line.strip())
+    if bool(input_text) == bool(prompts):
+        raise click.UsageError("Give either INPUT_TEXT or prompts with --prompt or --prompt-file")
+    from wrangler.model_handlers import ImageGenerateModelHandler
+
+    if prompts:
+        from wrangler.cli import run_image_generate_prompts as cli_run_image_prompts
+        from wrangler.models import ImageFormat
+
+        cli_run_image_prompts(
+            model_handler_class=ImageGenerateModelHandler,
+            model_identifier=model_identifier.model,
+            model_revision=model_identifier.revision,
+            output_directory=destination,
+            input_texts=list(prompts),
+            image_format=ImageFormat(image_format.upper()),
+            model_fast_load_cache=fast_load_cache_directory(fast_load, fast_load_cache),
+            model_dtype=dtype,
+            model_quantize=quantization(dtype, quantize),
+        )
+        return
+    from wrangler.cli import run_image_generate as cli_run_image
+
     cli_run_image(
         model_handler_class=ImageGenerateModelHandler,
         model_identifier=model_identifier.model,
         model_revision=model_identifier.revision,
-        output_file=destination_file,
+        output_file=destination,
         input_text=" ".join(input_text),
+        model_fast_load_cache=fast_load_cache_directory(fast_load, fast_load_cache),
+        model_dtype=dtype,
+        model_quantize=quantization(dtype, quantize),
+    )
+
+
+@run.command(name="image-generate-batch")
+@click.argument("MODEL_IDENTIFIER", type=ModelIdentifierType())
+@click.argument(
+    "OUTPUT_DIRECTORY",
+    type=click.Path(file_okay=False, dir_okay=True, path_type=pathlib.Path),
+)
+@click.argument("INPUT_FILE", type=click.File("r"), default="-")
+@click.option(
+    "--output-file",
+    help='File to which a JSON result is written for each input line. "-" will send to STDOUT',
+    default="-",
+    show_default=True,
+    type=click.File("w"),
+)
+@click.option(
+    "--batch-size",
+    envvar="MODEL_BATCH_SIZE",
+    help="Number of requests the model will process together in a single batch. Only "
+    "requests with the same inference steps and size are batched together.",
+    default=1,
+    show_default=True,
+    show_envvar=True,
+    type=click.IntRange(min=1),
+)
+@fast_load_options
+@precision_options
+def image_generation_run_batch(
+    model_identifier: ModelIdentifier,
+    output_directory: pathlib.Path,
+    input_file: t.TextIO,
+    output_file: t.TextIO,
+    batch_size: int,
+    fast_load: bool,
+    fast_load_cache: pathlib.Path | None,
+    dtype: str,
+    quantize: str | None,
+):
+    """
+    Generate images for every request in a JSON lines file, loading the model once.
+    Each line of INPUT_FILE is a request object such as {"input": "Brown Cow"}. Images
+    are written to OUTPUT_DIRECTORY. INPUT_FILE defaults to STDIN.
+    """
+    from wrangler.cli import run_image_generate_batch as cli_run_image_batch
+    from wrangler.model_handlers import ImageGenerateModelHandler
+
+    cli_run_image_batch(
+        model_handler_class=ImageGenerateModelHandler,
+        model_identifier=model_identifier.model,
+        model_revision=model_identifier.revision,
+        output_directory=output_directory,
+        input_file=input_file,
+        output_file=output_file,
+        batch_size=batch_size,
+        model_fast_load_cache=fast_load_cache_directory(fast_load, fast_load_cache),
+        model_dtype=dtype,
+        model_quantize=quantization(dtype, quantize),
+    )
+
+
+@main.command(name="bench", context_settings={"ignore_unknown_options": True})
+@click.argument("TASK", type=click.Choice(["text-transform", "image-generate"]))
+@click.argument("SERVE_ARGS", nargs=-1, type=click.UNPROCESSED)
+@click.option(
+    "--url",
+    help="URL of a running server to benchmark rather than starting one with SERVE_ARGS.",
+    default=None,
+)
+@click.option(
+    "--requests",
+    "request_count",
+    help="Total number of requests to send.",
+    default=100,
+    show_default=True,
+    type=click.IntRange(min=1),
+)
+@click.option(
+    "--concurrency",
+    help="Number of requests in flight at once.",
+    default=1,
+    show_default=True,
+    type=click.IntRange(min=1),
+)
+@click.option(
+    "--requests-file",
+    help='JSON lines file of request bodies, such as {"input": "Brown Cow"}, which '
+    "are sent in turn to make up the request mix. Defaults to a single request.",
+    default=None,
+    type=click.File("r"),
+)
+@click.option(
+    "--stream-fraction",
+    help="Fraction of text transform requests sent to the streaming endpoint, for which "
+    "the time to first token is measured.",
+    default=0.0,
+    show_default=True,
+    type=click.FloatRange(min=0.0, max=1.0),
+)
+@click.option(
+    "--startup-timeout",
+    help="Maximum number of seconds to wait for the server to be ready.",
+    default=600.0,
+    show_default=True,
+    type=click.FloatRange(min=0.0),
+)
+@click.option(
+    "--output-file",
+    help='File to which the JSON results are written. "-" will send to STDOUT',
+    default="-",
+    show_default=True,
+    type=click.File("w"),
+)
+def bench(
+    task: str,
+    serve_args: tuple[str, ...],
+    url: str | None,
+    request_count: int,
+    concurrency: int,
+    requests_file: t.TextIO | None,
+    stream_fraction: float,
+    startup_timeout: float,
+    output_file: t.TextIO,
+):
+    """
+    Benchmark the throughput, latency, time to first token and error rates of a server
+    for TASK. Unless --url is given, a server is started with `wrangler serve TASK
+    SERVE_ARGS`, such as the model identifier and serve command options. Options of
+    `wrangler serve` itself, such as --workers, are set with their environment
+    variables. Results are written as JSON.
+    """
+    if (url is None) == (not serve_args):
+        raise click.UsageError("Give either SERVE_ARGS to start a server or --url")
+    if stream_fraction and task != "text-transform":
+        raise click.UsageError("Only text transform requests can be streamed")
+    bodies = None
+    if requests_file is not None:
+        try:
+            bodies = [json.loads(line) for line in requests_file if line.strip()]
+        except json.JSONDecodeError as e:
+            raise click.BadParameter(f"Invalid JSON: {e}", param_hint="--requests-file") from None
+    try:
+        from wrangler.bench import bench as run_bench
+    except ModuleNotFoundError as e:
+        if e.name != "httpx":
+            raise
+        raise click.ClickException(
+            "wrangler bench requires httpx. Install it with "
+            "pip install zettafi-model-wrangler[bench]"
+        ) from None
+
+    result = run_bench(
+        task=task,
+        url=url,
+        serve_args=serve_args,
+        requests=request_count,
+        concurrency=concurrency,
+        bodies=bodies,
+        stream_fraction=stream_fraction,
+        startup_timeout=startup_timeout,
     )
+    output_file.write(json.dumps(result, indent=2) + "\n")
 
 
 if __name__ == "__main__":
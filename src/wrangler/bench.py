@@ -0,0 +1,269 @@
+"""Load generation and latency measurement against a model server"""
+import asyncio
+import contextlib
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from dataclasses import dataclass
+from typing import Any, Iterator
+
+import click
+import httpx
+
+TASKS = ("text-transform", "image-generate")
+
+# Request bodies sent when no requests file is given
+DEFAULT_REQUESTS: dict[str, list[dict[str, Any]]] = {
+    "text-transform": [{"input": "How now brown cow"}],
+    "image-generate": [{"input": "A brown cow in a green field"}],
+}
+
+
+@dataclass(frozen=True)
+class Sample:
+    """Outcome of a single benchmark request"""
+
+    # Seconds from sending the request to receiving the whole response
+    latency: float
+    # Seconds from sending a streamed request to receiving its first line
+    time_to_first_token: float | None = None
+    # Kind of failure, such as http_429, or None if the request succeeded
+    error: str | None = None
+
+
+def is_streamed(index: int, stream_fraction: float) -> bool:
+    """
+    Is a request sent to the streaming endpoint. Streamed requests are spread evenly
+    through the run so that exactly the fraction of any prefix of the run is streamed.
+    :param index: Index of the request in the run
+    :param stream_fraction: Fraction of requests to stream from 0 to 1
+    """
+    return int((index + 1) * stream_fraction) > int(index * stream_fraction)
+
+
+async def send_request(client: httpx.AsyncClient, body: dict[str, Any], stream: bool) -> Sample:
+    """
+    Send a request and time its response
+    :param client: Client for the server
+    :param body: JSON body of the request
+    :param stream: Send the request to the streaming endpoint and time its first line
+    """
+    start = time.perf_counter()
+    time_to_first_token = None
+    error = None
+    try:
+        if stream:
+            async with client.stream("POST", "/stream", json=body) as response:
+                if response.status_code != 200:
+                    error = f"http_{response.status_code}"
+                async for line in response.aiter_lines():
+                    if not line or error is not None:
+                        continue
+                    if time_to_first_token is None:
+                        time_to_first_token = time.perf_counter() - start
+                    if "error" in json.loads(line):
+                        # Failures after the response has started are reported in the stream
+                        error = "stream_error"
+        else:
+            response = await client.post("/", json=body, headers={"Accept": "application/json"})
+            if response.status_code != 200:
+                error = f"http_{response.status_code}"
+    except httpx.TransportError:
+        error = "transport_error"
+    return Sample(time.perf_counter() - start, time_to_first_token, error)
+
+
+async def generate_load(
+    client: httpx.AsyncClient,
+    bodies: list[dict[str, Any]],
+    requests: int,
+    concurrency: int,
+    stream_fraction: float = 0.0,
+) -> list[Sample]:
+    """
+    Send requests from a fixed number of concurrent clients, each sending its next
+    request as soon as its previous one completes
+    :param client: Client for the server
+    :param bodies: Request bodies, sent in turn
+    :param requests: Total number of requests to send
+    :param concurrency: Number of requests in flight at once
+    :param stream_fraction: Fraction of requests sent to the streaming endpoint
+    :return: Sample of each request in the order they completed
+    """
+    indexes = iter(range(requests))
+    samples: list[Sample] = []
+
+    async def send_requests() -> None:
+        for index in indexes:
+            body = bodies[index % len(bodies)]
+            samples.append(await send_request(client, body, is_streamed(index, stream_fraction)))
+
+    await asyncio.gather(*(send_requests() for _ in range(concurrency)))
+    return samples
+
+
+def percentiles(values: list[float]) -> dict[str, float]:
+    """Mean, median, 95th and 99th percentiles, and maximum of durations in milliseconds"""
+    if len(values) == 1:
+        values = values * 2
+    cut_points = statistics.quantiles(values, n=100, method="inclusive")
+    return {
+        name: round(value * 1000, 2)
+        for name, value in (
+            ("mean", statistics.fmean(values)),
+            ("p50", cut_points[49]),
+            ("p95", cut_points[94]),
+            ("p99", cut_points[98]),
+            ("max", max(values)),
+        )
+    }
+
+
+def summarize(samples: list[Sample], elapsed: float) -> dict[str, Any]:
+    """
+    Throughput, latency and error rates of a run. Latencies only include successful
+    requests.
+    :param samples: Sample of every request of the run
+    :param elapsed: Seconds the run took
+    """
+    succeeded = [sample for sample in samples if sample.error is None]
+    errors: dict[str, int] = {}
+    for sample in samples:
+        if sample.error is not None:
+            errors[sample.error] = errors.get(sample.error, 0) + 1
+    summary: dict[str, Any] = {
+        "requests": len(samples),
+        "succeeded": len(succeeded),
+        "duration_seconds": round(elapsed, 3),
+        "throughput_requests_per_second": round(len(succeeded) / elapsed, 3) if elapsed else 0.0,
+        "error_rate": round(1 - len(succeeded) / len(samples), 4) if samples else 0.0,
+        "errors": dict(sorted(errors.items())),
+    }
+    if succeeded:
+        summary["latency_ms"] = percentiles([sample.latency for sample in succeeded])
+    first_tokens = [
+        sample.time_to_first_token for sample in succeeded if sample.time_to_first_token is not None
+    ]
+    if first_tokens:
+        summary["time_to_first_token_ms"] = percentiles(first_tokens)
+    return summary
+
+
+@contextlib.contextmanager
+def serving(task: str, serve_args: tuple[str, ...]) -> Iterator[tuple[subprocess.Popen, str]]:
+    """
+    Run wrangler serve on a private unix socket for the duration of the context. The
+    server's errors and progress go to STDERR and its access log is discarded.
+    :param task: Serve command, such as text-transform
+    :param serve_args: Arguments of the serve command, such as the model identifier
+    :return: Server process and the path of its socket
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        socket_path = os.path.join(directory, "wrangler.sock")
+        process = subprocess.Popen(
+            [sys.executable, "-m", "wrangler", "serve", "--bind", f"unix:{socket_path}"]
+            + ["--access-log", os.devnull, task, *serve_args],
+            stdout=subprocess.DEVNULL,
+        )
+        try:
+            yield process, socket_path
+        finally:
+            process.terminate()
+            try:
+                process.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+
+
+async def wait_until_ready(
+    client: httpx.AsyncClient, timeout: float, process: subprocess.Popen | None = None
+) -> None:
+    """
+    Wait for the server to report a model process ready
+    :param client: Client for the server
+    :param timeout: Maximum seconds to wait
+    :param process: Server process, which must not exit while waiting, if it was started
+    :raises click.ClickException: The server was not ready in time or exited
+    """
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process is not None and process.poll() is not None:
+            raise click.ClickException(f"The server exited with code {process.returncode}")
+        with contextlib.suppress(httpx.TransportError):
+            if (await client.get("/ready")).status_code == 204:
+                return
+        await asyncio.sleep(0.25)
+    raise click.ClickException(f"The server was not ready within {timeout:g} seconds")
+
+
+async def _bench(
+    client: httpx.AsyncClient,
+    bodies: list[dict[str, Any]],
+    requests: int,
+    concurrency: int,
+    stream_fraction: float,
+    startup_timeout: float,
+    process: subprocess.Popen | None,
+) -> dict[str, Any]:
+    async with client:
+        await wait_until_ready(client, startup_timeout, process)
+        start = time.perf_counter()
+        samples = await generate_load(client, bodies, requests, concurrency, stream_fraction)
+        return summarize(samples, time.perf_counter() - start)
+
+
+def bench(
+    task: str,
+    url: str | None,
+    serve_args: tuple[str, ...],
+    requests: int,
+    concurrency: int,
+    bodies: list[dict[str, Any]] | None = None,
+    stream_fraction: float = 0.0,
+    startup_timeout: float = 600.0,
+) -> dict[str, Any]:
+    """
+    Benchmark a server, starting one for the duration of the run unless a URL is given
+    :param task: Task the server performs, such as text-transform
+    :param url: URL of a running server, or None to start one with the serve arguments
+    :param serve_args: Arguments of the serve command, such as the model identifier
+    :param requests: Total number of requests to send
+    :param concurrency: Number of requests in flight at once
+    :param bodies: Request bodies, sent in turn. Defaults to a single request for the task.
+    :param stream_fraction: Fraction of requests sent to the streaming endpoint
+    :param startup_timeout: Maximum seconds to wait for the server to be ready
+    :return: Run configuration followed by its throughput, latency and error rates
+    """
+    bodies = bodies or DEFAULT_REQUESTS[task]
+    result: dict[str, Any] = {
+        "task": task,
+        "target": url or " ".join(serve_args),
+        "concurrency": concurrency,
+        "stream_fraction": stream_fraction,
+    }
+    limits = httpx.Limits(max_connections=concurrency)
+    timeout = httpx.Timeout(None)
+    with contextlib.ExitStack() as stack:
+        process = None
+        if url is None:
+            process, socket_path = stack.enter_context(serving(task, serve_args))
+            client = httpx.AsyncClient(
+                base_url="http://wrangler",
+                transport=httpx.AsyncHTTPTransport(uds=socket_path, limits=limits),
+                timeout=timeout,
+            )
+        else:
+            client = httpx.AsyncClient(base_url=url, limits=limits, timeout=timeout)
+        result.update(
+            asyncio.run(
+                _bench(
+                    client, bodies, requests, concurrency, stream_fraction, startup_timeout, process
+                )
+            )
+        )
+    return result
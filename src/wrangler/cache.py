@@ -0,0 +1,106 @@
+"""Response cache for deterministic requests"""
+import json
+import time
+from collections import OrderedDict
+from typing import Callable
+
+from pydantic import BaseModel
+
+from wrangler.metrics import Metrics
+
+
+class ResponseCache:
+    """
+    Least recently used cache of the responses to requests whose result is fully
+    determined by the model and the request. Entries expire after the time to live and
+    the least recently used entries are evicted to keep the cache within its size.
+    """
+
+    def __init__(
+        self,
+        model: str,
+        revision: str | None,
+        max_bytes: int,
+        cacheable: Callable[[BaseModel], bool],
+        ttl: float | None = None,
+        metrics: Metrics | None = None,
+    ) -> None:
+        """
+        :param model: Identifier of the model whose responses are cached
+        :param revision: Revision of the model whose responses are cached
+        :param max_bytes: Maximum combined size of the cached keys and responses
+        :param cacheable: Is the response to a request deterministic
+        :param ttl: Seconds after which a cached response expires. Responses do not
+        expire by default.
+        :param metrics: Metrics in which to count cache hits and misses
+        """
+        self._model = model
+        self._revision = revision
+        self._max_bytes = max_bytes
+        self._cacheable = cacheable
+        self._ttl = ttl
+        self._metrics = metrics
+        self._entries: OrderedDict[str, tuple[BaseModel, int, float | None]] = OrderedDict()
+        self._size = 0
+
+    @property
+    def size(self) -> int:
+        """Combined size in bytes of the cached keys and responses"""
+        return self._size
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def key(self, request: BaseModel) -> str | None:
+        """
+        Cache key of a request
+        :param request: Request for the model
+        :return: Key identifying the model, revision, request type and every request
+        field, or None if the response to the request should not be cached
+        """
+        if not self._cacheable(request):
+            return None
+        return json.dumps(
+            [self._model, self._revision, type(request).__name__, request.dict()],
+            sort_keys=True,
+            default=str,
+        )
+
+    def get(self, key: str) -> BaseModel | None:
+        """
+        Look up a cached response, counting the hit or miss
+        :param key: Key of the request
+        :return: Cached response or None if it is not cached or has expired
+        """
+        entry = self._entries.get(key)
+        if entry is not None and entry[2] is not None and entry[2] <= time.monotonic():
+            self._remove(key)
+            entry = None
+        if self._metrics is not None:
+            self._metrics.response_cache.inc(result="miss" if entry is None else "hit")
+        if entry is None:
+            return None
+        self._entries.move_to_end(key)
+        return entry[0]
+
+    def put(self, key: str, response: BaseModel) -> None:
+        """
+        Cache a response, evicting the least recently used responses to make room.
+        Responses larger than the cache are not cached.
+        :param key: Key of the request
+        :param response: Response to the request
+        """
+        if key in self._entries:
+            self._remove(key)
+        size = len(key.encode()) + len(response.json().encode())
+        if size > self._max_bytes:
+            return
+        while self._size + size > self._max_bytes:
+            self._remove(next(iter(self._entries)))
+        expires = None if self._ttl is None else time.monotonic() + self._ttl
+        self._entries[key] = (response, size, expires)
+        self._size += size
+
+    def _remove(self, key: str) -> None:
+        _, size, _ = self._entries.pop(key)
+        self._size -= size
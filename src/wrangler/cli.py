@@ -1,33 +1,63 @@
 """Functions related to executing CLI requests"""
 import asyncio
 import contextlib
-import multiprocessing as mp
+import functools
+import math
 import pathlib
-import queue
 from asyncio import Future
+from typing import TYPE_CHECKING, Annotated, TextIO
 from uuid import UUID
 
-from fastapi import FastAPI
-from hypercorn import Config as HypercornConfig
-from hypercorn.asyncio import serve as hypercorn_serve
 from pydantic import BaseModel
 
 from . import __version__ as version
-from .model_handlers import ModelHandler, RunImageGenerateInput, RunGenerateInput
-from .request_handlers import RequestHandler
+from .cache import ResponseCache
+from .hosting import ModelPool, model_label
+from .images import SharedImage
+from .metrics import Gauge, Metrics
+from .models import ImageFormat
+from .tracing import Tracer
+from .model_handlers import (
+    ModelHandler,
+    RunBatchInput,
+    RunImageGenerateBatchInput,
+    RunImageGenerateInput,
+    RunImageGeneratePromptsInput,
+    RunGenerateInput,
+)
+from .workers import WorkerPool
 
+if TYPE_CHECKING:
+    from .request_handlers import RequestHandler
 
-async def __responder(response_queue: mp.Queue, request_future_map_: dict[UUID, Future[BaseModel]]):
-    while True:
-        try:
-            request_id, response = response_queue.get(block=False)
-            future = request_future_map_[request_id]
-            if isinstance(response, Exception):
-                future.set_exception(response)
-            else:
-                future.set_result(response)
-        except queue.Empty:
-            await asyncio.sleep(0)
+
+def __resolve_future(
+    request_future_map_: dict[UUID, Future[BaseModel] | asyncio.Queue[BaseModel | Exception]],
+    request_id: UUID,
+    response: BaseModel | Exception,
+) -> None:
+    future = request_future_map_.get(request_id)
+    if isinstance(future, asyncio.Queue):
+        future.put_nowait(response)  # Streamed responses are delivered as they arrive
+        return
+    if future is None or future.done():
+        # The requester is no longer waiting on the response
+        if isinstance(response, list):
+            for shared_image in response:
+                if isinstance(shared_image, SharedImage):
+                    shared_image.release()
+        return
+    if isinstance(response, Exception):
+        future.set_exception(response)
+    else:
+        future.set_result(response)
+
+
+def _draft_model_kwargs(identifier: str | None, revision: str | None) -> dict[str, str | None]:
+    """Keyword arguments of a model handler's create method for the draft model, if any"""
+    if identifier is None:
+        return {}
+    return {"draft_model": identifier, "draft_revision": revision}
 
 
 def run(
@@ -36,12 +66,22 @@ def run(
     model_revision: str | None,
     model_offload_folder,
     input_text: str,
+    model_fast_load_cache: pathlib.Path | None = None,
+    model_dtype: str = "fp32",
+    model_quantize: str | None = None,
+    model_draft_identifier: str | None = None,
+    model_draft_revision: str | None = None,
 ):
-    """Run a model"""
+    """Run a model, with a draft model drafting tokens for it if one is given"""
     model_handler = model_handler_class.create(
         model=model_identifier,
         revision=model_revision,
         offload_folder=model_offload_folder,
+        fast_load_cache=model_fast_load_cache,
+        dtype=model_dtype,
+        quantize=model_quantize,
+        # Only text transform model handlers generate with a draft model
+        **_draft_model_kwargs(model_draft_identifier, model_draft_revision),
     )
     model_handler.run(RunGenerateInput(input=input_text))
 
@@ -52,53 +92,267 @@ def run_image_generate(
     model_revision: str | None,
     output_file: pathlib.Path,
     input_text: str,
+    model_fast_load_cache: pathlib.Path | None = None,
+    model_dtype: str = "fp32",
+    model_quantize: str | None = None,
 ):
     """Run an image generation model"""
     model_handler = model_handler_class.create(
-        model=model_identifier, revision=model_revision, offload_folder=None
+        model=model_identifier,
+        revision=model_revision,
+        offload_folder=None,
+        fast_load_cache=model_fast_load_cache,
+        dtype=model_dtype,
+        quantize=model_quantize,
     )
     model_handler.run(RunImageGenerateInput(input=input_text, output_file=output_file))
 
 
+def run_image_generate_prompts(
+    model_handler_class: type[ModelHandler],
+    model_identifier: str,
+    model_revision: str | None,
+    output_directory: pathlib.Path,
+    input_texts: list[str],
+    image_format: ImageFormat = ImageFormat.png,
+    model_fast_load_cache: pathlib.Path | None = None,
+    model_dtype: str = "fp32",
+    model_quantize: str | None = None,
+):
+    """Run an image generation model for each of several prompts, loading the model once"""
+    model_handler = model_handler_class.create(
+        model=model_identifier,
+        revision=model_revision,
+        offload_folder=None,
+        fast_load_cache=model_fast_load_cache,
+        dtype=model_dtype,
+        quantize=model_quantize,
+    )
+    model_handler.run(
+        RunImageGeneratePromptsInput(
+            inputs=input_texts, output_directory=output_directory, format=image_format
+        )
+    )
+
+
+def run_batch(
+    model_handler_class: type[ModelHandler],
+    model_identifier: str,
+    model_revision: str | None,
+    model_offload_folder,
+    input_file: TextIO,
+    output_file: TextIO,
+    batch_size: int,
+    model_fast_load_cache: pathlib.Path | None = None,
+    model_dtype: str = "fp32",
+    model_quantize: str | None = None,
+):
+    """Run a model once for every request in a JSON lines file"""
+    model_handler = model_handler_class.create(
+        model=model_identifier,
+        revision=model_revision,
+        offload_folder=model_offload_folder,
+        fast_load_cache=model_fast_load_cache,
+        dtype=model_dtype,
+        quantize=model_quantize,
+    )
+    model_handler.run_batch(
+        RunBatchInput(input_file=input_file, output_file=output_file, batch_size=batch_size)
+    )
+
+
+def run_image_generate_batch(
+    model_handler_class: type[ModelHandler],
+    model_identifier: str,
+    model_revision: str | None,
+    output_directory: pathlib.Path,
+    input_file: TextIO,
+    output_file: TextIO,
+    batch_size: int = 1,
+    model_fast_load_cache: pathlib.Path | None = None,
+    model_dtype: str = "fp32",
+    model_quantize: str | None = None,
+):
+    """Run an image generation model once for every request in a JSON lines file"""
+    model_handler = model_handler_class.create(
+        model=model_identifier,
+        revision=model_revision,
+        offload_folder=None,
+        fast_load_cache=model_fast_load_cache,
+        dtype=model_dtype,
+        quantize=model_quantize,
+    )
+    model_handler.run_batch(
+        RunImageGenerateBatchInput(
+            input_file=input_file,
+            output_file=output_file,
+            batch_size=batch_size,
+            output_directory=output_directory,
+        )
+    )
+
+
 def serve(
     service_name: str,
     model_handler_class: type[ModelHandler],
-    request_handler_class: type[RequestHandler],
+    request_handler_class: type["RequestHandler"],
+    stream_request_handler_class: type["RequestHandler"] | None,
     model_identifier: str,
     model_revision: str | None,
     model_offload_folder,
+    model_max_batch_size: int,
+    model_batch_timeout: float,
+    model_continuous_batching: bool,
+    model_workers: int,
+    model_threads_per_worker: int | None,
+    model_pin_workers: bool,
+    request_timeout: float | None,
+    max_queue_depth: int | None,
     webserver_bind,
     webserver_access_log,
     webserver_error_log,
+    response_cache_size: int = 0,
+    response_cache_ttl: float | None = None,
+    model_prefix_cache_size: int = 0,
+    model_fast_load_cache: pathlib.Path | None = None,
+    model_dtype: str = "fp32",
+    model_quantize: str | None = None,
+    model_warm_up_inputs: tuple[str, ...] = (),
+    model_additional_identifiers: tuple[tuple[str, str | None], ...] = (),
+    model_max_memory: int | None = None,
+    image_encode_workers: int | None = None,
+    trace_file: pathlib.Path | None = None,
+    trace_format: str = "chrome",
+    profile_directory: pathlib.Path | None = None,
+    model_draft_identifier: str | None = None,
+    model_draft_revision: str | None = None,
 ):
-    """Serve a model via an API"""
-    model_request_queue: mp.Queue = mp.Queue()
-    model_response_queue: mp.Queue = mp.Queue()
-    model_handler = model_handler_class.create(
-        model=model_identifier,
-        revision=model_revision,
-        offload_folder=model_offload_folder,
+    """
+    Serve a model via an API. With additional model identifiers, the server hosts every
+    model and requests are routed by their model field, loading models on demand and
+    unloading the least recently used ones to stay within the model memory budget. With
+    a trace file, the spans of every request are written to it, and with a profile
+    directory, model processes can be asked to profile their next requests. With a draft
+    model, it drafts tokens for every hosted model.
+    """
+    # The web server is only loaded by the serve commands
+    from fastapi import FastAPI, HTTPException, Query
+    from fastapi.responses import PlainTextResponse, StreamingResponse
+    from hypercorn import Config as HypercornConfig
+    from hypercorn.asyncio import serve as hypercorn_serve
+
+    model_handlers = {
+        (model, revision): model_handler_class.create(
+            model=model,
+            revision=revision,
+            offload_folder=model_offload_folder,
+            max_batch_size=model_max_batch_size,
+            batch_timeout=model_batch_timeout / 1000,
+            continuous_batching=model_continuous_batching,
+            prefix_cache_size=model_prefix_cache_size,
+            fast_load_cache=model_fast_load_cache,
+            dtype=model_dtype,
+            quantize=model_quantize,
+            warm_up_inputs=model_warm_up_inputs,
+            **_draft_model_kwargs(model_draft_identifier, model_draft_revision),
+        )
+        for model, revision in ((model_identifier, model_revision), *model_additional_identifiers)
+    }
+    # Loaded before the server starts so that handling requests does not block on it
+    for model_handler in model_handlers.values():
+        model_handler.prepare()
+
+    request_future_map: dict[UUID, Future[BaseModel] | asyncio.Queue[BaseModel | Exception]] = {}
+    service_metrics = Metrics()
+    tracer = None if trace_file is None else Tracer(trace_file, trace_format)
+
+    def create_worker_pool(model_handler: ModelHandler) -> WorkerPool:
+        return WorkerPool(
+            model_handler,
+            functools.partial(__resolve_future, request_future_map),
+            workers=model_workers,
+            threads_per_worker=model_threads_per_worker,
+            pin_workers=model_pin_workers,
+            max_queue_depth=max_queue_depth,
+            metrics=service_metrics,
+            tracer=tracer,
+        )
+
+    worker_pool: WorkerPool | ModelPool
+    if len(model_handlers) > 1:
+        worker_pool = ModelPool(model_handlers, create_worker_pool, max_memory=model_max_memory)
+        is_deterministic = worker_pool.is_deterministic
+        service_metrics.add_gauge(
+            Gauge(
+                "wrangler_models_loaded",
+                "Hosted models whose worker processes are running",
+                lambda: len(worker_pool.loaded),  # type: ignore[union-attr]
+            )
+        )
+    else:
+        (model_handler,) = model_handlers.values()
+        worker_pool = create_worker_pool(model_handler)
+        is_deterministic = model_handler.is_deterministic
+    service_metrics.add_gauge(
+        Gauge(
+            "wrangler_requests_in_flight",
+            "Requests waiting on a model response",
+            lambda: len(request_future_map),
+        )
+    )
+    service_metrics.add_gauge(
+        Gauge(
+            "wrangler_workers_ready",
+            "Model worker processes which have loaded and warmed up their model",
+            lambda: worker_pool.ready,
+        )
+    )
+    service_metrics.add_gauge(
+        Gauge(
+            "wrangler_worker_resident_memory_bytes",
+            "Resident memory of each model worker process",
+            worker_pool.memory_usage,
+            label_name="worker",
+        )
     )
 
-    request_future_map: dict[UUID, Future[BaseModel]] = {}
+    response_cache = None
+    if response_cache_size:
+        response_cache = ResponseCache(
+            model_identifier,
+            model_revision,
+            response_cache_size,
+            is_deterministic,
+            ttl=response_cache_ttl,
+            metrics=service_metrics,
+        )
+        service_metrics.add_gauge(
+            Gauge(
+                "wrangler_response_cache_bytes",
+                "Size of the cached responses",
+                lambda: response_cache.size,  # type: ignore[union-attr]
+            )
+        )
 
-    model_request_handler = request_handler_class(model_request_queue, request_future_map)
+    model_request_handler = request_handler_class(
+        worker_pool,
+        request_future_map,
+        timeout=request_timeout,
+        metrics=service_metrics,
+        response_cache=response_cache,
+        tracer=tracer,
+        # Only image generation request handlers encode images
+        **({} if image_encode_workers is None else {"encode_workers": image_encode_workers}),
+    )
 
     @contextlib.asynccontextmanager
     async def lifespan(_app: FastAPI):
-        """FastAPI lifespan manages the threadpool executor"""
-        p = mp.Process(
-            target=model_handler.start,
-            args=(model_request_queue, model_response_queue),
-            name="Model Request Processor",
-        )
-        p.start()
-        responder_task = asyncio.get_event_loop().create_task(
-            __responder(model_response_queue, request_future_map)
-        )
+        """FastAPI lifespan manages the model worker processes"""
+        worker_pool.start(asyncio.get_running_loop())
         yield
-        p.terminate()
-        responder_task.cancel("Application shutting down")
+        worker_pool.stop()
+        if tracer is not None:
+            tracer.close()
 
     app = FastAPI(
         lifespan=lifespan,
@@ -106,11 +360,38 @@ def serve(
         version=version,
         description=f"**{service_name}:**\n\n"
         f"Model: {model_identifier}\n\n"
-        f"Revision: {model_revision}\n\n",
+        f"Revision: {model_revision}\n\n"
+        + (
+            f"Hosted models: {', '.join(model_label(key) for key in model_handlers)}\n\n"
+            if len(model_handlers) > 1
+            else ""
+        ),
     )
 
     # noinspection PyTypeChecker
-    app.add_api_route("/", model_request_handler.__call__, methods=["POST"], tags=["Models"])
+    app.add_api_route(
+        "/",
+        model_request_handler.__call__,
+        methods=["POST"],
+        tags=["Models"],
+        response_model_exclude_none=True,
+    )
+    if stream_request_handler_class is not None:
+        stream_request_handler = stream_request_handler_class(
+            worker_pool,
+            request_future_map,
+            timeout=request_timeout,
+            metrics=service_metrics,
+            tracer=tracer,
+        )
+        # noinspection PyTypeChecker
+        app.add_api_route(
+            "/stream",
+            stream_request_handler.__call__,
+            methods=["POST"],
+            tags=["Models"],
+            response_class=StreamingResponse,
+        )
 
     @app.get("/ping", status_code=204, tags=["Checks"])
     async def ping() -> None:
@@ -119,6 +400,57 @@ def serve(
         """
         return
 
+    @app.get(
+        "/ready",
+        status_code=204,
+        tags=["Checks"],
+        responses={503: {"description": "No model process has loaded and warmed up"}},
+    )
+    async def ready() -> None:
+        """
+        Is a model process ready to respond, having loaded and warmed up its model
+        """
+        if worker_pool.failed:
+            raise HTTPException(status_code=503, detail="The model processes failed to start")
+        if not worker_pool.ready:
+            raise HTTPException(
+                status_code=503,
+                detail="The model is not ready",
+                headers={"Retry-After": str(math.ceil(worker_pool.restart_delay))},
+            )
+
+    @app.get("/metrics", response_class=PlainTextResponse, tags=["Checks"])
+    async def metrics() -> str:
+        """
+        Service metrics in the Prometheus text exposition format
+        """
+        return service_metrics.render()
+
+    if profile_directory is not None:
+
+        @app.post(
+            "/admin/profile",
+            status_code=202,
+            tags=["Admin"],
+            responses={503: {"description": "No model process is running"}},
+        )
+        async def profile(
+            requests: Annotated[int, Query(ge=1, le=10_000)] = 1
+        ) -> dict[str, int | str]:
+            """
+            Profile each model process's handling of its next requests with
+            torch.profiler. Each process writes a Chrome trace to the profile directory
+            once the requests have finished.
+            """
+            workers = worker_pool.profile(requests, profile_directory)
+            if not workers:
+                raise HTTPException(status_code=503, detail="No model process is running")
+            return {
+                "workers": workers,
+                "requests": requests,
+                "directory": str(profile_directory),
+            }
+
     config = HypercornConfig()
     config.bind = webserver_bind
     config.accesslog = webserver_access_log
@@ -0,0 +1,282 @@
+"""Continuous batching engine for text generation"""
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from uuid import UUID
+
+import torch
+from transformers.generation.streamers import BaseStreamer
+
+from wrangler.metrics import Timings
+from wrangler.prefix_cache import PastKeyValues, PrefixCache
+from wrangler.stopping import find_stop, stop_window
+
+
+@dataclass
+class _Sequence:
+    """State of a single sequence being generated by the engine"""
+
+    request_id: UUID
+    input_ids: list[int]
+    max_length: int
+    do_sample: bool = False
+    temperature: float = 1.0
+    top_p: float = 1.0
+    stop: list[str] | None = None
+    generated_ids: list[int] = field(default_factory=list)
+    past_key_values: PastKeyValues | None = None
+    streamer: BaseStreamer | None = None
+    timings: Timings = field(default_factory=lambda: Timings(started=time.monotonic()))
+
+    def append(self, token_id: int) -> None:
+        """Add a generated token to the sequence"""
+        self.generated_ids.append(token_id)
+        if self.streamer is not None:
+            self.streamer.put(torch.tensor([token_id]))
+
+    @property
+    def cache_length(self) -> int:
+        """Number of tokens held in the KV cache of the sequence"""
+        return len(self.input_ids) + len(self.generated_ids) - 1
+
+
+class ContinuousBatchingEngine:
+    """
+    Decoding engine that schedules at the iteration level rather than the request
+    level. Every call to step admits waiting requests into the running batch,
+    advances every running sequence by one token, and retires finished sequences
+    immediately so their slots can be filled on the next step. Each sequence keeps its
+    own KV cache which is padded to a common length only for the duration of a
+    decoding step. When given a prefix cache, prompts only prefill the tokens after the
+    longest prefix they share with a previously prefilled prompt.
+    """
+
+    def __init__(
+        self, model, tokenizer, max_batch_size: int, prefix_cache: PrefixCache | None = None
+    ) -> None:
+        self._model = model
+        self._tokenizer = tokenizer
+        self._max_batch_size = max_batch_size
+        self._prefix_cache = prefix_cache
+        self._waiting: deque[_Sequence] = deque()
+        self._running: list[_Sequence] = []
+
+    @property
+    def has_work(self) -> bool:
+        """Are there sequences waiting to be admitted or being generated"""
+        return bool(self._waiting or self._running)
+
+    def add(
+        self,
+        request_id: UUID,
+        input_: str,
+        max_new_tokens: int | None = None,
+        streamer: BaseStreamer | None = None,
+        do_sample: bool | None = None,
+        temperature: float | None = None,
+        top_p: float | None = None,
+        stop: list[str] | None = None,
+    ) -> None:
+        """
+        Add a request to be admitted into the running batch on the next step. Sampling
+        parameters default to the model's generation config.
+        :param request_id: ID with which the result will be returned
+        :param input_: Text with which to prompt the model
+        :param max_new_tokens: Maximum number of tokens to generate. Defaults to the
+        limits of the model's generation config.
+        :param streamer: Streamer which will receive each generated token. Unlike
+        generate, the prompt is not sent to the streamer.
+        :param do_sample: Sample each token rather than choosing the most likely one
+        :param temperature: Temperature with which tokens are sampled
+        :param top_p: Sample only from the most likely tokens whose probabilities add up
+        to top_p
+        :param stop: Strings at which generation stops. The stop string is removed from
+        the result.
+        """
+        tokenize_start = time.perf_counter()
+        input_ids = self._tokenizer(input_, return_token_type_ids=False)["input_ids"]
+        tokenize_time = time.perf_counter() - tokenize_start
+        generation_config = self._model.generation_config
+        if max_new_tokens is None:
+            max_new_tokens = generation_config.max_new_tokens
+        if max_new_tokens is None:
+            max_length = generation_config.max_length
+        else:
+            max_length = len(input_ids) + max_new_tokens
+        sequence = _Sequence(
+            request_id,
+            input_ids,
+            max_length,
+            do_sample=generation_config.do_sample if do_sample is None else do_sample,
+            temperature=generation_config.temperature if temperature is None else temperature,
+            top_p=generation_config.top_p if top_p is None else top_p,
+            stop=stop,
+            streamer=streamer,
+        )
+        sequence.timings.tokenize = tokenize_time
+        self._waiting.append(sequence)
+
+    def cancel(self, request_id: UUID) -> None:
+        """
+        Stop generating a request. No result will be returned for the request.
+        :param request_id: ID of the request to cancel
+        """
+        self._waiting = deque(
+            sequence for sequence in self._waiting if sequence.request_id != request_id
+        )
+        self._running = [
+            sequence for sequence in self._running if sequence.request_id != request_id
+        ]
+
+    def step(self) -> list[tuple[UUID, str | Exception, Timings]]:
+        """
+        Admit waiting sequences and advance all running sequences by one token
+        :return: Decoded text or the exception raised, and the timings, for each sequence
+        that finished during the step. Model timings are the time spent in the steps
+        the sequence took part in.
+        """
+        finished: list[tuple[UUID, str | Exception, Timings]] = []
+        admitted = []
+        while self._waiting and len(self._running) + len(admitted) < self._max_batch_size:
+            sequence = self._waiting.popleft()
+            sequence.timings.started = time.monotonic()
+            try:
+                self._prefill(sequence)
+            except Exception as e:
+                finished.append((sequence.request_id, e, sequence.timings))
+            else:
+                sequence.timings.model += time.monotonic() - sequence.timings.started
+                admitted.append(sequence)
+
+        if self._running:
+            step_start = time.perf_counter()
+            try:
+                self._decode(self._running)
+            except Exception as e:
+                finished.extend(
+                    (sequence.request_id, e, sequence.timings) for sequence in self._running
+                )
+                self._running = []
+            step_time = time.perf_counter() - step_start
+            for sequence in self._running:
+                sequence.timings.model += step_time
+
+        running = []
+        batch_size = len(self._running) + len(admitted)
+        for sequence in [*self._running, *admitted]:
+            if self._is_finished(sequence):
+                if sequence.streamer is not None:
+                    sequence.streamer.end()
+                decode_start = time.perf_counter()
+                text = self._decode_text(sequence)
+                sequence.timings.decode = time.perf_counter() - decode_start
+                sequence.timings.tokens = len(sequence.generated_ids)
+                sequence.timings.batch_size = batch_size
+                finished.append((sequence.request_id, text, sequence.timings))
+            else:
+                running.append(sequence)
+        self._running = running
+        return finished
+
+    @torch.inference_mode()
+    def _prefill(self, sequence: _Sequence) -> None:
+        cached_length, past_key_values = 0, None
+        if self._prefix_cache is not None:
+            # At least one token is run to get the logits of the next token
+            cached_length, past_key_values = self._prefix_cache.lookup(sequence.input_ids[:-1])
+        device = self._model.device
+        input_ids = torch.tensor([sequence.input_ids[cached_length:]], device=device)
+        position_ids = torch.arange(cached_length, len(sequence.input_ids), device=device)
+        outputs = self._model(
+            input_ids=input_ids,
+            past_key_values=past_key_values,
+            position_ids=position_ids.unsqueeze(0),
+            use_cache=True,
+        )
+        sequence.past_key_values = outputs.past_key_values
+        if self._prefix_cache is not None:
+            self._prefix_cache.insert(sequence.input_ids, outputs.past_key_values)
+        sequence.append(self._next_token(sequence, outputs.logits[0, -1]))
+
+    @torch.inference_mode()
+    def _decode(self, sequences: list[_Sequence]) -> None:
+        cache_lengths = [sequence.cache_length for sequence in sequences]
+        padded_length = max(cache_lengths)
+        device = self._model.device
+
+        # Left pad each sequence's cache so the newest entries line up across the batch
+        past_key_values = []
+        for layer in range(len(sequences[0].past_key_values)):  # type: ignore[arg-type]
+            keys, values = [], []
+            for sequence, cache_length in zip(sequences, cache_lengths, strict=True):
+                key, value = sequence.past_key_values[layer]  # type: ignore[index]
+                padding = padded_length - cache_length
+                keys.append(torch.nn.functional.pad(key, (0, 0, padding, 0)))
+                values.append(torch.nn.functional.pad(value, (0, 0, padding, 0)))
+            past_key_values.append((torch.cat(keys), torch.cat(values)))
+
+        attention_mask = torch.zeros(
+            (len(sequences), padded_length + 1), dtype=torch.long, device=device
+        )
+        for row, cache_length in enumerate(cache_lengths):
+            attention_mask[row, padded_length - cache_length :] = 1
+        input_ids = torch.tensor(
+            [[sequence.generated_ids[-1]] for sequence in sequences], device=device
+        )
+        position_ids = torch.tensor([[length] for length in cache_lengths], device=device)
+
+        outputs = self._model(
+            input_ids=input_ids,
+            past_key_values=tuple(past_key_values),
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            use_cache=True,
+        )
+
+        for row, sequence in enumerate(sequences):
+            # Strip the padding back off so the cache only grows with the sequence
+            start = padded_length - cache_lengths[row]
+            sequence.past_key_values = tuple(
+                (key[row : row + 1, :, start:], value[row : row + 1, :, start:])
+                for key, value in outputs.past_key_values
+            )
+            sequence.append(self._next_token(sequence, outputs.logits[row, -1]))
+
+    @staticmethod
+    def _next_token(sequence: _Sequence, logits: torch.Tensor) -> int:
+        if not sequence.do_sample:
+            return int(logits.argmax())
+        logits = logits / sequence.temperature
+        if sequence.top_p < 1.0:
+            sorted_logits, sorted_indices = logits.sort(descending=True)
+            cumulative_probabilities = sorted_logits.softmax(dim=-1).cumsum(dim=-1)
+            # Keep the fewest tokens whose probabilities reach top_p
+            removed = cumulative_probabilities > sequence.top_p
+            removed[1:] = removed[:-1].clone()
+            removed[0] = False
+            logits = logits.index_fill(0, sorted_indices[removed], -float("inf"))
+        return int(torch.multinomial(logits.softmax(dim=-1), 1))
+
+    def _is_finished(self, sequence: _Sequence) -> bool:
+        eos_token_id = self._model.generation_config.eos_token_id
+        eos_token_ids = eos_token_id if isinstance(eos_token_id, list) else [eos_token_id]
+        if (
+            sequence.generated_ids[-1] in eos_token_ids
+            or len(sequence.input_ids) + len(sequence.generated_ids) >= sequence.max_length
+        ):
+            return True
+        if not sequence.stop:
+            return False
+        tail = self._tokenizer.decode(
+            sequence.generated_ids[-stop_window(sequence.stop) :], skip_special_tokens=True
+        )
+        return find_stop(tail, sequence.stop) is not None
+
+    def _decode_text(self, sequence: _Sequence) -> str:
+        text = self._tokenizer.decode(
+            sequence.input_ids + sequence.generated_ids, skip_special_tokens=True
+        )
+        if sequence.stop:
+            prompt = self._tokenizer.decode(sequence.input_ids, skip_special_tokens=True)
+            text = text[: find_stop(text, sequence.stop, len(prompt))]
+        return text
@@ -0,0 +1,248 @@
+"""Hosting of several models with least recently used model residency"""
+import asyncio
+import functools
+from collections import OrderedDict
+from pathlib import Path
+from typing import Callable
+from uuid import UUID
+
+import click
+from pydantic import BaseModel
+
+from wrangler.model_handlers import ModelHandler
+from wrangler.workers import WorkerPool
+
+# Model identifier and revision
+ModelKey = tuple[str, str | None]
+
+
+class UnknownModelError(LookupError):
+    """The request is for a model the server does not host"""
+
+
+def model_key(identifier: str) -> ModelKey:
+    """
+    Model identifier and revision of a model identifier in the form MODEL[:REVISION]
+    :param identifier: Model identifier with an optional revision
+    """
+    model, _, revision = identifier.partition(":")
+    return model, revision or None
+
+
+def model_label(key: ModelKey) -> str:
+    """Model identifier of a model key in the form MODEL[:REVISION]"""
+    model, revision = key
+    return model if revision is None else f"{model}:{revision}"
+
+
+class ModelPool:
+    """
+    Hosts several models, each in its own worker pool with its own request queues, so
+    that requests queued for one model never wait behind those for another and each
+    model's queue depth is limited separately. Requests are routed by their model field,
+    defaulting to the first model. The first model is loaded at start and the others the
+    first time a request is sent to them. When the loaded models use more resident memory
+    than the budget, the least recently used models without outstanding requests are
+    unloaded by stopping their worker processes in the background. They are loaded again
+    on demand, and requests for a model which is unloading wait until it has stopped.
+    """
+
+    def __init__(
+        self,
+        model_handlers: dict[ModelKey, ModelHandler],
+        create_worker_pool: Callable[[ModelHandler], WorkerPool],
+        max_memory: int | None = None,
+        check_interval: float = 1.0,
+    ) -> None:
+        """
+        :param model_handlers: Handler of each hosted model. The first is the default.
+        :param create_worker_pool: Creates the worker pool which runs a model handler
+        :param max_memory: Maximum combined resident memory in bytes of the worker
+        processes of the loaded models. Unlimited by default.
+        :param check_interval: Seconds between checks of the loaded models' memory
+        """
+        self._model_handlers = model_handlers
+        self._default = next(iter(model_handlers))
+        self._pools = {key: create_worker_pool(handler) for key, handler in model_handlers.items()}
+        self._max_memory = max_memory
+        self._check_interval = check_interval
+        # Loaded models from least to most recently used
+        self._loaded: OrderedDict[ModelKey, None] = OrderedDict()
+        # Models whose worker processes are being stopped
+        self._unloading: set[ModelKey] = set()
+        # Memory each unloaded model used, to make room before loading it again
+        self._model_memory: dict[ModelKey, float] = {}
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._check_handle: asyncio.TimerHandle | None = None
+
+    @property
+    def loaded(self) -> list[str]:
+        """Identifiers of the loaded models from least to most recently used"""
+        return [model_label(key) for key in self._loaded]
+
+    @property
+    def in_flight(self) -> int:
+        """Number of requests submitted to any model that have not been responded to"""
+        return sum(pool.in_flight for pool in self._pools.values())
+
+    @property
+    def available(self) -> bool:
+        """Can requests be submitted, which is the case once started as models load on demand"""
+        return self._loop is not None
+
+    @property
+    def failed(self) -> bool:
+        """Have the worker processes of every loaded model repeatedly failed to start"""
+        return bool(self._loaded) and all(self._pools[key].failed for key in self._loaded)
+
+    @property
+    def ready(self) -> int:
+        """Number of worker processes of every model which have loaded and warmed up"""
+        return sum(pool.ready for pool in self._pools.values())
+
+    @property
+    def restart_delay(self) -> float:
+        """Seconds to wait before restarting a worker that exited"""
+        return self._pools[self._default].restart_delay
+
+    def memory_usage(self) -> dict[str, float]:
+        """
+        Resident set size in bytes of each running worker process, keyed by the model
+        identifier and worker index
+        """
+        return {
+            f"{model_label(key)}/{worker}": usage
+            for key, pool in self._pools.items()
+            for worker, usage in pool.memory_usage().items()
+        }
+
+    def is_deterministic(self, request: BaseModel) -> bool:
+        """
+        Is the response to a request fully determined by its model and the request
+        :param request: Request for one of the hosted models
+        """
+        try:
+            return self._model_handlers[self._key(request)].is_deterministic(request)
+        except UnknownModelError:
+            return False
+
+    def start(self, loop: asyncio.AbstractEventLoop) -> None:
+        """
+        Load the default model and begin checking the memory of the loaded models
+        :param loop: Event loop on which responses and worker exits are handled
+        """
+        self._loop = loop
+        self._load(self._default)
+        self._check_handle = loop.call_later(self._check_interval, self._check)
+
+    def stop(self) -> None:
+        """Stop the worker processes of every loaded model"""
+        if self._check_handle is not None:
+            self._check_handle.cancel()
+        for key in list(self._loaded):
+            self._pools[key].stop()
+            del self._loaded[key]
+        self._loop = None
+
+    def submit(self, request_id: UUID, request: BaseModel, deadline: float | None = None) -> None:
+        """
+        Send a request to the worker pool of its model, loading the model if necessary
+        :param request_id: ID with which the response will be returned
+        :param request: Request for one of the hosted models
+        :param deadline: time.monotonic value after which the worker will drop the
+        request rather than process it
+        :raises UnknownModelError: The request is for a model the server does not host
+        :raises WorkerPoolFailedError: The model's worker processes failed to start
+        :raises QueueFullError: The model has the maximum number of outstanding requests
+        """
+        key = self._key(request)
+        if key in self._unloading:
+            # The pool has no workers, so the request waits in it until it is loaded again
+            self._pools[key].submit(request_id, request, deadline)
+            return
+        if key not in self._loaded:
+            self._make_room(key, self._model_memory.get(key, 0.0))
+            self._load(key)
+        self._loaded.move_to_end(key)
+        self._pools[key].submit(request_id, request, deadline)
+
+    def cancel(self, request_id: UUID) -> None:
+        """
+        Tell the worker handling a request that the response is no longer needed
+        :param request_id: ID of the request to cancel
+        """
+        # Pools ignore requests they were not sent
+        for key in (*self._loaded, *self._unloading):
+            self._pools[key].cancel(request_id)
+
+    def profile(self, requests: int, directory: Path) -> int:
+        """
+        Ask each worker of every loaded model to profile its next requests
+        :param requests: Number of requests each worker profiles
+        :param directory: Directory to which workers write their profiles
+        :return: Number of workers asked to profile
+        """
+        return sum(self._pools[key].profile(requests, directory) for key in self._loaded)
+
+    def _key(self, request: BaseModel) -> ModelKey:
+        identifier = getattr(request, "model", None)
+        if identifier is None:
+            return self._default
+        key = model_key(identifier)
+        if key not in self._pools:
+            raise UnknownModelError(f"Model {identifier} is not hosted by this server")
+        return key
+
+    def _load(self, key: ModelKey) -> None:
+        click.echo(f"Loading {model_label(key)}", err=True)
+        self._pools[key].start(self._loop)  # type: ignore[arg-type]
+        self._loaded[key] = None
+
+    def _unload(self, key: ModelKey) -> None:
+        pool = self._pools[key]
+        memory = sum(pool.memory_usage().values())
+        if memory:
+            self._model_memory[key] = memory
+        # Requests are held back from the pool's workers from here on
+        stopped = pool.stop_in_background()
+        self._unloading.add(key)
+        del self._loaded[key]
+        stopped.add_done_callback(functools.partial(self._unloaded, key, memory))
+
+    def _unloaded(self, key: ModelKey, memory: float, _stopped: asyncio.Future) -> None:
+        """Load a model again once it has stopped if requests arrived while it unloaded"""
+        self._unloading.discard(key)
+        click.echo(
+            f"Unloaded {model_label(key)}, which used {memory / 2**20:.1f} MiB, to stay "
+            f"within the model memory budget",
+            err=True,
+        )
+        if self._loop is not None and self._pools[key].in_flight:
+            self._make_room(key, self._model_memory.get(key, 0.0))
+            self._load(key)
+
+    def _memory(self) -> float:
+        return sum(sum(self._pools[key].memory_usage().values()) for key in self._loaded)
+
+    def _make_room(self, keep: ModelKey, expected: float) -> None:
+        """
+        Unload the least recently used models without outstanding requests until the
+        loaded models and the expected memory fit within the budget
+        :param keep: Model which is never unloaded
+        :param expected: Bytes of memory about to be used by loading a model
+        """
+        if self._max_memory is None:
+            return
+        for key in list(self._loaded):
+            if self._memory() + expected <= self._max_memory:
+                return
+            if key != keep and not self._pools[key].in_flight:
+                self._unload(key)
+
+    def _check(self) -> None:
+        # Loading models grow after they are loaded, so the budget is checked regularly
+        if self._loaded:
+            self._make_room(next(reversed(self._loaded)), 0.0)
+        self._check_handle = self._loop.call_later(  # type: ignore[union-attr]
+            self._check_interval, self._check
+        )
@@ -0,0 +1,173 @@
+"""Transport and encoding of generated images"""
+import queue
+import threading
+import time
+from dataclasses import dataclass
+from io import BytesIO
+from multiprocessing import shared_memory
+from pathlib import Path
+
+from PIL import Image
+
+from wrangler.models import ImageFormat
+
+MEDIA_TYPES = {
+    ImageFormat.png: "image/png",
+    ImageFormat.jpg: "image/jpeg",
+    ImageFormat.gif: "image/gif",
+    ImageFormat.webp: "image/webp",
+}
+
+
+def encode_image(
+    image: Image.Image,
+    format_: ImageFormat,
+    quality: int | None = None,
+    compress_level: int | None = None,
+) -> bytes:
+    """
+    Encode an image, taking the fastest path each format allows. GIF images are reduced
+    to a palette with fast octree quantization rather than median cut, WebP images use
+    the fastest compression method, and JPEG images drop any alpha channel.
+    :param image: Image to encode
+    :param format_: Format to encode
+    :param quality: JPEG or WebP quality from 1 to 100. Defaults to the encoder's.
+    :param compress_level: PNG compression level from 0, fastest, to 9, smallest.
+    Defaults to the encoder's.
+    :return: Encoded image bytes
+    """
+    options: dict = {}
+    if format_ is ImageFormat.png and compress_level is not None:
+        options["compress_level"] = compress_level
+    elif format_ in (ImageFormat.jpg, ImageFormat.webp) and quality is not None:
+        options["quality"] = quality
+    if format_ is ImageFormat.webp:
+        options["method"] = 0
+    elif format_ is ImageFormat.jpg and image.mode not in ("RGB", "L", "CMYK"):
+        image = image.convert("RGB")
+    elif format_ is ImageFormat.gif and image.mode not in ("P", "L"):
+        image = image.convert("RGB").quantize(method=Image.Quantize.FASTOCTREE)
+    output = BytesIO()
+    image.save(output, format=format_.value, **options)
+    return output.getvalue()
+
+
+@dataclass(frozen=True)
+class SharedImage:
+    """
+    Raw pixel data of an image held in shared memory so that only this small descriptor
+    is pickled between processes. The process receiving the descriptor owns the shared
+    memory and must either encode or release the image exactly once.
+    """
+
+    name: str
+    mode: str
+    size: tuple[int, int]
+    format: ImageFormat
+
+    @classmethod
+    def create(cls, image: Image.Image, format_: ImageFormat) -> "SharedImage":
+        """
+        Copy the pixels of an image into a new shared memory block
+        :param image: Image to share
+        :param format_: Format in which the image was requested
+        """
+        data = image.tobytes()
+        memory = shared_memory.SharedMemory(create=True, size=max(len(data), 1))
+        try:
+            memory.buf[: len(data)] = data
+        finally:
+            memory.close()
+        return cls(name=memory.name, mode=image.mode, size=image.size, format=format_)
+
+    def encode(
+        self,
+        format_: ImageFormat | None = None,
+        quality: int | None = None,
+        compress_level: int | None = None,
+    ) -> bytes:
+        """
+        Encode the image and release its shared memory
+        :param format_: Format to encode. Defaults to the format the image was requested in.
+        :param quality: JPEG or WebP quality from 1 to 100. Defaults to the encoder's.
+        :param compress_level: PNG compression level from 0 to 9. Defaults to the encoder's.
+        :return: Encoded image bytes
+        """
+        memory = shared_memory.SharedMemory(name=self.name)
+        try:
+            # Decoded into PIL's own storage so no reference to the buffer outlives it
+            image = Image.frombytes(self.mode, self.size, memory.buf)
+            return encode_image(image, format_ or self.format, quality, compress_level)
+        finally:
+            memory.close()
+            memory.unlink()
+
+    def release(self) -> None:
+        """Release the shared memory of an image which will not be encoded"""
+        memory = shared_memory.SharedMemory(name=self.name)
+        memory.close()
+        memory.unlink()
+
+
+class ImageWriter:
+    """
+    Encodes images and writes them to files on a background thread, so that a caller
+    generating images starts on the next ones while the previous ones are written. At
+    most max_pending images wait to be written, which bounds the memory they hold. Use
+    as a context manager to wait for every image to be written.
+    """
+
+    def __init__(self, max_pending: int = 4) -> None:
+        """
+        :param max_pending: Maximum number of images waiting to be written before put
+        blocks
+        """
+        self._queue: queue.Queue[tuple[Image.Image, Path, ImageFormat] | None] = queue.Queue(
+            max_pending
+        )
+        self._error: Exception | None = None
+        # Seconds spent encoding and writing images
+        self.seconds = 0.0
+        self._thread = threading.Thread(target=self._write, name="image-writer", daemon=True)
+        self._thread.start()
+
+    def __enter__(self) -> "ImageWriter":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def put(self, image: Image.Image, path: Path, format_: ImageFormat) -> None:
+        """
+        Queue an image to be written
+        :param image: Image to write
+        :param path: File to write the image to
+        :param format_: Format in which to encode the image
+        :raises Exception: Raised writing an earlier image
+        """
+        if self._error is not None:
+            raise self._error
+        self._queue.put((image, path, format_))
+
+    def close(self) -> None:
+        """
+        Wait for every queued image to be written
+        :raises Exception: Raised writing an image
+        """
+        self._queue.put(None)
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+
+    def _write(self) -> None:
+        while (item := self._queue.get()) is not None:
+            if self._error is not None:
+                # Images after a failure are dropped as the caller will stop
+                continue
+            image, path, format_ = item
+            start = time.perf_counter()
+            try:
+                path.write_bytes(encode_image(image, format_))
+            except Exception as e:
+                self._error = e
+            self.seconds += time.perf_counter() - start
@@ -0,0 +1,140 @@
+"""Fast model loading from memory mapped safetensors weights"""
+import contextlib
+import hashlib
+import json
+import resource
+import shutil
+import tempfile
+import time
+from pathlib import Path
+from typing import Iterator
+
+import click
+import torch
+from huggingface_hub import snapshot_download
+from safetensors.torch import save_file
+
+# Single file PyTorch checkpoints and the safetensors file transformers and diffusers
+# load in their place
+SAFETENSORS_NAMES = {
+    "pytorch_model.bin": "model.safetensors",
+    "diffusion_pytorch_model.bin": "diffusion_pytorch_model.safetensors",
+}
+
+# Weights in formats the PyTorch models never load
+IGNORED_PATTERNS = ["*.msgpack", "*.h5", "*.ot", "*.onnx", "*.tflite"]
+
+
+def model_source(
+    model: str, revision: str | None, fast_load_cache: Path | None
+) -> tuple[str, str | None]:
+    """
+    Path or identifier and revision from which to load a model
+    :param model: Path or hub identifier of the model
+    :param revision: Revision of a hub model
+    :param fast_load_cache: Directory in which converted models are kept. The model is
+    loaded as it is when None.
+    """
+    if fast_load_cache is None:
+        return model, revision
+    return safetensors_model(model, revision, fast_load_cache), None
+
+
+def safetensors_model(model: str, revision: str | None, cache_directory: Path) -> str:
+    """
+    Local directory of a model whose single file PyTorch checkpoints all have a
+    safetensors equivalent, so that every weight is memory mapped rather than read into
+    memory. Models which already have them are used in place. Others are converted once
+    into the cache directory, where the converted weights sit beside links to the rest
+    of the model's files. Sharded PyTorch checkpoints are left as they are.
+    :param model: Path or hub identifier of the model
+    :param revision: Revision of a hub model
+    :param cache_directory: Directory in which converted models are kept
+    :return: Path of the directory from which to load the model
+    """
+    source = Path(model)
+    if not source.is_dir():
+        source = Path(snapshot_download(model, revision=revision, ignore_patterns=IGNORED_PATTERNS))
+    source = source.resolve()
+    checkpoints = sorted(
+        path
+        for path in source.rglob("*.bin")
+        if path.name in SAFETENSORS_NAMES
+        and not path.with_name(SAFETENSORS_NAMES[path.name]).exists()
+    )
+    if not checkpoints:
+        return str(source)
+    # Checkpoints which change on disk are converted again
+    key = hashlib.sha256(
+        json.dumps(
+            [str(source), revision]
+            + [[str(path), path.stat().st_size, path.stat().st_mtime_ns] for path in checkpoints]
+        ).encode()
+    ).hexdigest()[:16]
+    target = cache_directory / f"{source.name}-{key}"
+    if not target.is_dir():
+        _convert(source, checkpoints, target)
+    return str(target)
+
+
+def _convert(source: Path, checkpoints: list[Path], target: Path) -> None:
+    target.parent.mkdir(parents=True, exist_ok=True)
+    # Built aside and renamed into place so other processes never see a partial model
+    temporary = Path(tempfile.mkdtemp(prefix=f".{target.name}-", dir=target.parent))
+    try:
+        for path in source.rglob("*"):
+            if path.is_dir():
+                continue
+            destination = temporary / path.relative_to(source)
+            destination.parent.mkdir(parents=True, exist_ok=True)
+            if path in checkpoints:
+                _convert_checkpoint(path, destination.with_name(SAFETENSORS_NAMES[path.name]))
+            else:
+                destination.symlink_to(path.resolve())
+        try:
+            temporary.rename(target)
+        except OSError:
+            # Another process converted the model first
+            if not target.is_dir():
+                raise
+    finally:
+        shutil.rmtree(temporary, ignore_errors=True)
+
+
+def _convert_checkpoint(checkpoint: Path, destination: Path) -> None:
+    try:
+        state_dict = torch.load(str(checkpoint), map_location="cpu", mmap=True, weights_only=True)
+    except (RuntimeError, TypeError):
+        # Checkpoints saved in the legacy format cannot be memory mapped, and torch before
+        # 2.1 cannot memory map checkpoints at all
+        state_dict = torch.load(checkpoint, map_location="cpu", weights_only=True)
+    tensors = {}
+    storages = set()
+    for name, tensor in state_dict.items():
+        tensor = tensor.contiguous()
+        # Safetensors cannot hold tensors sharing memory, such as tied embeddings
+        storage = tensor.untyped_storage().data_ptr()
+        if storage in storages:
+            tensor = tensor.clone()
+        storages.add(tensor.untyped_storage().data_ptr())
+        tensors[name] = tensor
+    save_file(tensors, str(destination), metadata={"format": "pt"})
+
+
+@contextlib.contextmanager
+def report_loading(model: str) -> Iterator[None]:
+    """
+    Write the time taken to load a model and the peak resident memory of the process
+    to STDERR once the model has loaded
+    :param model: Identifier of the model being loaded
+    """
+    start = time.perf_counter()
+    yield
+    elapsed = time.perf_counter() - start
+    # Kilobytes on Linux
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    click.echo(
+        f"Loaded {model} in {elapsed:.2f}s with a peak resident memory of "
+        f"{peak / 2**20:.1f} MiB",
+        err=True,
+    )
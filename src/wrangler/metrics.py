@@ -0,0 +1,260 @@
+"""Service metrics in the Prometheus text exposition format"""
+import math
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Callable
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128)
+TOKENS_PER_PASS_BUCKETS = (1.0, 1.25, 1.5, 2.0, 2.5, 3.0, 4.0, 6.0, 8.0)
+
+
+@dataclass
+class Timings:
+    """
+    Timings measured by a model process while handling a request. Started is the
+    time.monotonic value when processing began and the model, tokenize, and decode
+    timings are in seconds. Batched requests each report the timings of their batch.
+    Sent is the time.monotonic value when the response was sent to the API process.
+    Requests generated with a draft model report the tokens it drafted, the drafted
+    tokens the model accepted, and the forward passes of the model.
+    """
+
+    started: float
+    model: float = 0.0
+    tokenize: float = 0.0
+    decode: float = 0.0
+    tokens: int = 0
+    batch_size: int = 1
+    sent: float = 0.0
+    draft_tokens: int = 0
+    accepted_tokens: int = 0
+    model_passes: int = 0
+
+
+def _format_labels(labels: dict[str, str]) -> str:
+    if not labels:
+        return ""
+    pairs = []
+    for key, value in labels.items():
+        value = value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(key + '="' + value + '"')
+    return "{" + ",".join(pairs) + "}"
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value))
+
+
+class Counter:
+    """Monotonically increasing value, optionally split by label values"""
+
+    def __init__(self, name: str, help_: str, label_names: tuple[str, ...] = ()) -> None:
+        self._name = name
+        self._help = help_
+        self._label_names = label_names
+        self._values: dict[tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        """
+        Increase the counter
+        :param amount: Amount by which to increase the counter
+        :param labels: Value of each of the counter's labels
+        """
+        key = tuple(labels[name] for name in self._label_names)
+        self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels: str) -> float:
+        """Current value of the counter for the label values"""
+        return self._values.get(tuple(labels[name] for name in self._label_names), 0.0)
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self._name} {self._help}", f"# TYPE {self._name} counter"]
+        for key, value in sorted(self._values.items()):
+            labels = _format_labels(dict(zip(self._label_names, key, strict=True)))
+            lines.append(f"{self._name}{labels} {_format_value(value)}")
+        return lines
+
+
+class Gauge:
+    """Value read when metrics are collected, optionally split by label values"""
+
+    def __init__(
+        self,
+        name: str,
+        help_: str,
+        collect: Callable[[], float | dict[str, float]],
+        label_name: str | None = None,
+    ) -> None:
+        """
+        :param collect: Returns the current value or, when the gauge has a label, a map
+        of each label value to its current value
+        :param label_name: Name of the label of the values returned by collect
+        """
+        self._name = name
+        self._help = help_
+        self._collect = collect
+        self._label_name = label_name
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self._name} {self._help}", f"# TYPE {self._name} gauge"]
+        values = self._collect()
+        if isinstance(values, dict):
+            for label_value, value in sorted(values.items()):
+                labels = _format_labels({self._label_name: label_value})  # type: ignore
+                lines.append(f"{self._name}{labels} {_format_value(value)}")
+        else:
+            lines.append(f"{self._name} {_format_value(values)}")
+        return lines
+
+
+class Histogram:
+    """Distribution of observed values counted in cumulative buckets"""
+
+    def __init__(self, name: str, help_: str, buckets: tuple[float, ...] = LATENCY_BUCKETS):
+        self._name = name
+        self._help = help_
+        self._buckets = (*buckets, math.inf)
+        self._counts = [0] * len(self._buckets)
+        self._sum = 0.0
+
+    @property
+    def count(self) -> int:
+        """Number of observed values"""
+        return self._counts[-1]
+
+    def observe(self, value: float) -> None:
+        """
+        Record a value
+        :param value: Value to record
+        """
+        self._sum += value
+        for index, bucket in enumerate(self._buckets):
+            if value <= bucket:
+                self._counts[index] += 1
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self._name} {self._help}", f"# TYPE {self._name} histogram"]
+        for bucket, count in zip(self._buckets, self._counts, strict=True):
+            labels = _format_labels({"le": _format_value(bucket)})
+            lines.append(f"{self._name}_bucket{labels} {count}")
+        lines.append(f"{self._name}_sum {_format_value(self._sum)}")
+        lines.append(f"{self._name}_count {self.count}")
+        return lines
+
+
+class Metrics:
+    """
+    Metrics aggregated by the API process from request outcomes and the timings model
+    processes report alongside each response
+    """
+
+    def __init__(self, tokens_per_second_window: float = 60.0) -> None:
+        """
+        :param tokens_per_second_window: Number of trailing seconds over which the
+        generated tokens per second are averaged
+        """
+        self.requests = Counter(
+            "wrangler_requests_total", "Requests handled by result", ("result",)
+        )
+        self.queue_wait = Histogram(
+            "wrangler_queue_wait_seconds", "Time requests waited before the model processed them"
+        )
+        self.model = Histogram("wrangler_model_seconds", "Time spent executing the model")
+        self.tokenize = Histogram("wrangler_tokenize_seconds", "Time spent tokenizing inputs")
+        self.decode = Histogram("wrangler_decode_seconds", "Time spent decoding outputs")
+        self.image_encode = Histogram(
+            "wrangler_image_encode_seconds", "Time spent encoding generated images"
+        )
+        self.batch_size = Histogram(
+            "wrangler_batch_size",
+            "Number of requests in the batch each request was processed in",
+            BATCH_SIZE_BUCKETS,
+        )
+        self.tokens = Counter("wrangler_generated_tokens_total", "Tokens generated")
+        self.draft_tokens = Counter(
+            "wrangler_draft_tokens_total",
+            "Tokens drafted by the draft model by whether the model accepted them",
+            ("result",),
+        )
+        self.tokens_per_model_pass = Histogram(
+            "wrangler_tokens_per_model_pass",
+            "Tokens generated per forward pass of the model for requests generated with a "
+            "draft model, which is the speedup in model passes over generating one token a pass",
+            TOKENS_PER_PASS_BUCKETS,
+        )
+        self.response_cache = Counter(
+            "wrangler_response_cache_lookups_total", "Response cache lookups by result", ("result",)
+        )
+        self._tokens_per_second_window = tokens_per_second_window
+        self._recent_tokens: deque[tuple[float, int]] = deque()
+        self._gauges: list[Gauge] = [
+            Gauge(
+                "wrangler_generated_tokens_per_second",
+                f"Tokens generated per second over the last {tokens_per_second_window:g} "
+                "seconds",
+                self.tokens_per_second,
+            )
+        ]
+
+    def add_gauge(self, gauge: Gauge) -> None:
+        """Include a gauge in the rendered metrics"""
+        self._gauges.append(gauge)
+
+    def observe_timings(self, timings: Timings, submitted: float) -> None:
+        """
+        Record the timings a model process reported for a request
+        :param timings: Timings reported by the model process
+        :param submitted: time.monotonic value when the request was sent to the model
+        process
+        """
+        self.queue_wait.observe(max(timings.started - submitted, 0.0))
+        self.model.observe(timings.model)
+        if timings.tokenize:
+            self.tokenize.observe(timings.tokenize)
+        if timings.decode:
+            self.decode.observe(timings.decode)
+        self.batch_size.observe(timings.batch_size)
+        if timings.tokens:
+            self.tokens.inc(timings.tokens)
+            now = time.monotonic()
+            self._recent_tokens.append((now, timings.tokens))
+            # Pruned here too so the window stays bounded when the metrics are never read
+            self._prune_recent_tokens(now)
+        if timings.model_passes:
+            self.draft_tokens.inc(timings.accepted_tokens, result="accepted")
+            self.draft_tokens.inc(timings.draft_tokens - timings.accepted_tokens, result="rejected")
+            self.tokens_per_model_pass.observe(
+                (timings.accepted_tokens + timings.model_passes) / timings.model_passes
+            )
+
+    def tokens_per_second(self) -> float:
+        """Tokens generated per second over the trailing window"""
+        self._prune_recent_tokens(time.monotonic())
+        return sum(tokens for _, tokens in self._recent_tokens) / self._tokens_per_second_window
+
+    def _prune_recent_tokens(self, now: float) -> None:
+        cutoff = now - self._tokens_per_second_window
+        while self._recent_tokens and self._recent_tokens[0][0] < cutoff:
+            self._recent_tokens.popleft()
+
+    def render(self) -> str:
+        """Metrics in the Prometheus text exposition format"""
+        instruments = [
+            self.requests,
+            self.queue_wait,
+            self.model,
+            self.tokenize,
+            self.decode,
+            self.image_encode,
+            self.batch_size,
+            self.tokens,
+            self.draft_tokens,
+            self.tokens_per_model_pass,
+            self.response_cache,
+            *self._gauges,
+        ]
+        return "\n".join(line for instrument in instruments for line in instrument.render()) + "\n"
@@ -1,25 +1,51 @@
 """Model Handlers"""
 import abc
-import base64
+import contextlib
+import json
 import multiprocessing as mp
+import os
+import queue
+import time
+from collections import OrderedDict
 from dataclasses import dataclass
-from io import BytesIO
 from pathlib import Path
-from uuid import UUID
+from typing import TYPE_CHECKING, Any, Callable, Iterator, TextIO
+from uuid import UUID, uuid4
 
 import click
+import torch
 from PIL.Image import Image
-from diffusers import DiffusionPipeline
-from transformers import AutoTokenizer, AutoModelForCausalLM
+from pydantic import BaseModel, ValidationError
+from transformers import (
+    AutoConfig,
+    AutoTokenizer,
+    AutoModelForCausalLM,
+    GenerationConfig,
+    StoppingCriteria,
+    StoppingCriteriaList,
+)
+from transformers.generation.streamers import BaseStreamer
 
+from wrangler.engine import ContinuousBatchingEngine
+from wrangler.images import ImageWriter, SharedImage, encode_image
+from wrangler.loading import model_source, report_loading
+from wrangler.precision import DTYPES, check_precision, quantize_module
+from wrangler.metrics import Timings
+from wrangler.prefix_cache import PrefixCache
+from wrangler.stopping import StopStringCriteria, find_stop, stop_window
 from wrangler.models import (
+    ImageFormat,
+    ImageGenerateBatchResponse,
     ImageGenerateRequest,
-    ImageGenerateResponse,
     TextTransformRequest,
     TextTransformResponse,
-    ImageFormat,
+    TextTransformStreamRequest,
+    TextTransformToken,
 )
 
+if TYPE_CHECKING:
+    from diffusers import DiffusionPipeline
+
 
 class RunInput(abc.ABC):
     """Base class for run input"""
@@ -41,15 +67,158 @@ class RunImageGenerateInput(RunGenerateInput):
     output_file: Path
 
 
+@dataclass(frozen=True)
+class RunImageGeneratePromptsInput(RunInput):
+    """Input data for running a generate image command for each of several prompts"""
+
+    inputs: list[str]
+    output_directory: Path
+    format: ImageFormat
+
+
+@dataclass(frozen=True)
+class RunBatchInput(RunInput):
+    """Input data for running a batch of requests read as JSON lines"""
+
+    input_file: TextIO
+    output_file: TextIO
+    batch_size: int
+
+
+@dataclass(frozen=True)
+class RunImageGenerateBatchInput(RunBatchInput):
+    """Input data for running a batch of generate image requests read as JSON lines"""
+
+    output_directory: Path
+
+
+@dataclass(frozen=True)
+class ProfileRequests:
+    """
+    Sent on the control queue to profile the model process's handling of its next
+    requests with torch.profiler
+    """
+
+    requests: int
+    directory: Path
+
+
+class RequestProfiler:
+    """
+    Profiles a model process once asked to. A profile starts with the first batch, or
+    engine step, after the request and stops once the requested number of requests have
+    finished. It is written to the requested directory as a Chrome trace.
+    """
+
+    def __init__(self) -> None:
+        self._remaining = 0
+        self._directory: Path | None = None
+        self._profile: torch.profiler.profile | None = None
+        self._requests = 0
+
+    def request(self, message: ProfileRequests) -> None:
+        """Profile the next requests, replacing any earlier request not yet started"""
+        if self._profile is None:
+            self._remaining = message.requests
+            self._directory = message.directory
+
+    def start(self) -> None:
+        """Begin profiling, if asked to, before processing requests"""
+        if self._remaining <= 0 or self._profile is not None:
+            return
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        self._profile = torch.profiler.profile(activities=activities, record_shapes=True)
+        self._profile.start()
+        self._requests = 0
+
+    def finished(self, requests: int = 1) -> None:
+        """
+        Count requests which finished, writing the profile once enough have
+        :param requests: Number of requests which finished
+        """
+        if self._profile is None:
+            return
+        self._requests += requests
+        self._remaining -= requests
+        if self._remaining > 0:
+            return
+        profile, self._profile = self._profile, None
+        profile.stop()
+        path = self._directory / f"profile-{os.getpid()}-{time.time_ns()}.json"  # type: ignore
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            profile.export_chrome_trace(str(path))
+        except OSError as e:
+            click.echo(f"Failed to write profile to {path}: {e}", err=True)
+            return
+        click.echo(f"Wrote a profile of {self._requests} requests to {path}", err=True)
+
+
+class ControlMessages:
+    """
+    Receives the messages the API process sends a model process on its control queue.
+    Cancellations are the IDs of requests the API process is no longer waiting on, of
+    which only the most recent are kept as they may arrive after a request has finished.
+    Requests to profile the model process are passed to the profiler.
+    """
+
+    def __init__(self, control_queue: mp.Queue, max_size: int = 10_000) -> None:
+        self._control_queue = control_queue
+        self._max_size = max_size
+        self._request_ids: OrderedDict[UUID, None] = OrderedDict()
+        self.profiler = RequestProfiler()
+
+    def poll(self) -> list[UUID]:
+        """
+        Receive cancellations and profiling requests sent since the last poll
+        :return: IDs of the newly cancelled requests
+        """
+        request_ids = []
+        with contextlib.suppress(queue.Empty):
+            while True:
+                message = self._control_queue.get(block=False)
+                if isinstance(message, ProfileRequests):
+                    self.profiler.request(message)
+                else:
+                    request_ids.append(message)
+        for request_id in request_ids:
+            self._request_ids[request_id] = None
+        while len(self._request_ids) > self._max_size:
+            self._request_ids.popitem(last=False)
+        return request_ids
+
+    def __contains__(self, request_id: UUID) -> bool:
+        self.poll()
+        return request_id in self._request_ids
+
+
+class ModelReady:
+    """
+    Sent on the response queue, without a request ID or timings, once the model has
+    loaded and completed its warm-up generations
+    """
+
+
 class ModelHandler(abc.ABC):
     """Abstract base class for handlers"""
 
     @abc.abstractmethod
-    def start(self, request_queue: mp.Queue, response_queue: mp.Queue) -> None:
+    def start(
+        self, request_queue: mp.Queue, response_queue: mp.Queue, control_queue: mp.Queue
+    ) -> None:
         """
         Initialize the model and begin processing requests
-        :param request_queue: Queue to send requests to be processed
-        :param response_queue: Queue in which responses will be placed
+        :param request_queue: Queue to send requests to be processed. Each item is a
+        tuple of the request ID, the request, and the time.monotonic deadline after which
+        the request is dropped or None.
+        :param response_queue: Queue in which responses will be placed. Each item is a
+        tuple of the request ID, the response or exception, and the Timings measured for
+        the request or None for streamed tokens. A ModelReady item is placed once the
+        model is ready to respond.
+        :param control_queue: Queue to send control messages: the IDs of requests that are
+        no longer needed and ProfileRequests
         """
         raise NotImplementedError
 
@@ -61,6 +230,30 @@ class ModelHandler(abc.ABC):
         """
         raise NotImplementedError
 
+    @abc.abstractmethod
+    def run_batch(self, input_: RunBatchInput) -> None:
+        """
+        Initialize the model once and process every request in a JSON lines file
+        :param input_: Input for the batch run
+        """
+        raise NotImplementedError
+
+    def prepare(self) -> None:
+        """
+        Load what the API process needs to handle requests, without loading the model.
+        Called by serve before it accepts requests, so nothing blocks the event loop.
+        """
+        return
+
+    def is_deterministic(self, request: BaseModel) -> bool:
+        """
+        Is the response to a request fully determined by the model and the request, so
+        that it may be cached. Called in the API process for every request, so it must
+        not block.
+        :param request: Request for the model
+        """
+        return False
+
     @classmethod
     @abc.abstractmethod
     def create(
@@ -68,80 +261,509 @@ class ModelHandler(abc.ABC):
         model: str,
         revision: str | None,
         offload_folder: str | None,
+        max_batch_size: int = 1,
+        batch_timeout: float = 0.0,
+        continuous_batching: bool = False,
+        prefix_cache_size: int = 0,
+        fast_load_cache: Path | None = None,
+        warm_up_inputs: tuple[str, ...] = (),
+        dtype: str = "fp32",
+        quantize: str | None = None,
     ) -> "ModelHandler":
         """Standard factory method for all handlers"""
         raise NotImplementedError
 
+    @staticmethod
+    def _warm_up(
+        warm_up_inputs: tuple[str, ...],
+        generate: Callable[[list[str]], Any],
+        response_queue: mp.Queue,
+    ) -> None:
+        """
+        Generate from the warm-up inputs as a single batch, so that first call costs are
+        paid before any request, and then tell the API process that the model is ready
+        :param warm_up_inputs: Inputs from which to generate
+        :param generate: Generates from a list of inputs with the loaded model
+        :param response_queue: Queue on which to send ModelReady
+        """
+        if warm_up_inputs:
+            start = time.perf_counter()
+            generate(list(warm_up_inputs))
+            click.echo(
+                f"Warmed up with {len(warm_up_inputs)} inputs in "
+                f"{time.perf_counter() - start:.2f}s",
+                err=True,
+            )
+        response_queue.put((None, ModelReady(), None))
+
+    @staticmethod
+    def _batch_key(request: BaseModel) -> tuple:
+        """Requests with the same batch key can be processed together in a batch"""
+        return ()
+
+    @classmethod
+    def _group_requests(cls, batch: list[tuple[Any, Any]]) -> list[list[tuple[Any, Any]]]:
+        """
+        Split a batch of requests into groups with the same batch key
+        :param batch: Identifier and request of each request
+        """
+        groups: dict[tuple, list[tuple[Any, Any]]] = {}
+        for item in batch:
+            groups.setdefault(cls._batch_key(item[1]), []).append(item)
+        return list(groups.values())
+
+    @staticmethod
+    def _get_request_batch(
+        request_queue: mp.Queue, max_batch_size: int, batch_timeout: float
+    ) -> list[tuple[UUID, Any]]:
+        """
+        Block until a request is available and then collect up to max_batch_size
+        requests, waiting no more than batch_timeout seconds for additional requests.
+        Requests whose deadline has passed are dropped, so the batch may be empty.
+        :param request_queue: Queue from which to get requests
+        :param max_batch_size: Maximum number of requests to return
+        :param batch_timeout: Maximum number of seconds to wait for additional requests
+        :return: Request ID and request of each unexpired request
+        """
+        batch = [request_queue.get()]
+        deadline = time.monotonic() + batch_timeout
+        while len(batch) < max_batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining > 0:
+                    batch.append(request_queue.get(timeout=remaining))
+                else:
+                    batch.append(request_queue.get(block=False))
+            except queue.Empty:
+                break
+        return ModelHandler._drop_expired(batch)
+
+    @staticmethod
+    def _read_request_batches(
+        input_file: TextIO, request_class: type[BaseModel], batch_size: int
+    ) -> Iterator[list[BaseModel | Exception]]:
+        """
+        Parse requests from a JSON lines file in batches. Blank lines are skipped.
+        :param input_file: File with a JSON request object on each line
+        :param request_class: Model with which to parse each line
+        :param batch_size: Maximum number of requests in each batch
+        :return: Batches of parsed requests or the error raised parsing the line
+        """
+        batch: list[BaseModel | Exception] = []
+        for line in input_file:
+            if not line.strip():
+                continue
+            try:
+                batch.append(request_class.parse_raw(line))
+            except ValidationError as e:
+                batch.append(e)
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    @staticmethod
+    def _write_batch_response(output_file: TextIO, response: BaseModel | Exception) -> None:
+        if isinstance(response, Exception):
+            output_file.write(json.dumps({"error": str(response)}) + "\n")
+        else:
+            output_file.write(response.json(exclude_none=True) + "\n")
+
+    @staticmethod
+    def _echo_batch_progress(processed: int, failed: int, start: float, done: bool) -> None:
+        elapsed = time.perf_counter() - start
+        click.echo(
+            f"{'Completed' if done else 'Processed'} {processed} requests ({failed} failed) "
+            f"in {elapsed:.2f}s, {processed / elapsed if elapsed else 0.0:.2f} requests/s",
+            err=True,
+        )
+
+    @staticmethod
+    def _drop_expired(items: list[tuple[UUID, Any, float | None]]) -> list[tuple[UUID, Any]]:
+        """
+        Remove requests whose deadline passed while they were queued. No response is
+        sent for them as the API process has already stopped waiting.
+        :param items: Request ID, request, and deadline tuples from the request queue
+        :return: Request ID and request of each unexpired request
+        """
+        now = time.monotonic()
+        return [
+            (request_id, request)
+            for request_id, request, deadline in items
+            if deadline is None or deadline > now
+        ]
+
 
 class ImageGenerateModelHandler(ModelHandler):
     """
     Handler for initializing an image generation model pipeline and then executing
-    requests against the pipeline.
+    requests against the pipeline. Queued requests with the same inference steps and
+    size are generated together with a single pipeline call.
     """
 
     def __init__(
         self,
         model: str,
         revision: str | None,
+        max_batch_size: int = 1,
+        batch_timeout: float = 0.0,
+        fast_load_cache: Path | None = None,
+        warm_up_inputs: tuple[str, ...] = (),
+        dtype: str = "fp32",
+        quantize: str | None = None,
     ):
         self._model = model
         self._revision = revision
+        self._max_batch_size = max_batch_size
+        self._batch_timeout = batch_timeout
+        self._fast_load_cache = fast_load_cache
+        self._warm_up_inputs = warm_up_inputs
+        check_precision(dtype, quantize)
+        self._dtype = dtype
+        self._quantize = quantize
 
-    def _get_pipeline(self) -> DiffusionPipeline:
-        pipeline = DiffusionPipeline.from_pretrained(self._model, revision=self._revision)
-        pipeline = pipeline.to(pipeline.device)
+    def _get_pipeline(self) -> "DiffusionPipeline":
+        # Imported here as diffusers takes seconds to import and text models never use it
+        from diffusers import DiffusionPipeline
+
+        with report_loading(self._model):
+            model, revision = model_source(self._model, self._revision, self._fast_load_cache)
+            pipeline = DiffusionPipeline.from_pretrained(
+                model, revision=revision, low_cpu_mem_usage=True, torch_dtype=DTYPES[self._dtype]
+            )
+            # The VAE runs once per image and its convolutions are not quantized
+            for name in ("unet", "text_encoder", "text_encoder_2"):
+                if getattr(pipeline, name, None) is not None:
+                    quantize_module(getattr(pipeline, name), self._quantize)
+            pipeline = pipeline.to(pipeline.device)
         return pipeline
 
     @staticmethod
-    def _generate_image(pipeline, input_: str) -> Image:
-        result = pipeline(input_)
-        image: Image = result.images[0]
-        return image
+    def _batch_key(request: ImageGenerateRequest) -> tuple:
+        """Requests with the same inference steps and size can be generated together"""
+        return request.num_inference_steps, request.width, request.height
 
     @staticmethod
-    def _get_image_base64(image: Image, output_format: ImageFormat):
-        image_bytes_io = BytesIO()
-        image.save(image_bytes_io, format=output_format.value)
-        image_bytes = image_bytes_io.getvalue()
-        image_base64 = base64.b64encode(image_bytes).decode()
-        return image_base64
-
-    def start(self, request_queue: mp.Queue, response_queue: mp.Queue) -> None:
+    def _generate_images(
+        pipeline, requests: list[ImageGenerateRequest], timings: list[Timings] | None = None
+    ) -> list[list[Image]]:
+        """
+        Generate the images of a batch of requests with the same batch key with a single
+        pipeline call. Each image has its own generator, so a seeded request generates
+        the same images whether or not it is batched.
+        :param timings: Timings for each request which will be updated with the time
+        spent on the batch
+        :return: Generated images of each request
+        """
+        prompts = []
+        generators = []
+        for request in requests:
+            for index in range(request.num_images_per_prompt):
+                generator = torch.Generator(pipeline.device)
+                if request.seed is None:
+                    generator.seed()
+                else:
+                    generator.manual_seed(request.seed + index)
+                prompts.append(request.input)
+                generators.append(generator)
+        pipeline_kwargs = {
+            name: getattr(requests[0], name)
+            for name in ("num_inference_steps", "width", "height")
+            if getattr(requests[0], name) is not None
+        }
+        model_start = time.perf_counter()
+        result = pipeline(prompts, generator=generators, **pipeline_kwargs)
+        model_time = time.perf_counter() - model_start
+        for timing in timings or []:
+            timing.model += model_time
+            timing.batch_size = len(requests)
+        images = iter(result.images)
+        return [
+            [next(images) for _ in range(request.num_images_per_prompt)] for request in requests
+        ]
+
+    def start(
+        self, request_queue: mp.Queue, response_queue: mp.Queue, control_queue: mp.Queue
+    ) -> None:
         pipeline = self._get_pipeline()
+        self._warm_up(
+            self._warm_up_inputs,
+            lambda inputs: self._generate_images(
+                pipeline, [ImageGenerateRequest(input=input_) for input_ in inputs]
+            ),
+            response_queue,
+        )
+        control_messages = ControlMessages(control_queue)
         while True:
-            item: tuple[UUID, ImageGenerateRequest] = request_queue.get()
-            request_id, request = item
-            try:
-                image = self._generate_image(pipeline, request.input)
-                image_base64 = self._get_image_base64(image, request.format)
-                response: ImageGenerateResponse | Exception = ImageGenerateResponse(
-                    image=image_base64, format=request.format
-                )
-            except Exception as e:
-                response = e
-            response_queue.put((request_id, response))
+            batch: list[tuple[UUID, ImageGenerateRequest]] = self._get_request_batch(
+                request_queue, self._max_batch_size, self._batch_timeout
+            )
+            started = time.monotonic()
+            # Requests cancelled while queued are dropped without a response
+            batch = [item for item in batch if item[0] not in control_messages]
+            control_messages.profiler.start()
+            for group in self._group_requests(batch):
+                timings = [Timings(started=started) for _ in group]
+                try:
+                    results = self._generate_images(
+                        pipeline, [request for _, request in group], timings
+                    )
+                except Exception as e:
+                    results = [e] * len(group)
+                for (request_id, request), images, timing in zip(
+                    group, results, timings, strict=True
+                ):
+                    response: list[SharedImage] | Exception = images  # type: ignore[assignment]
+                    if not isinstance(images, Exception):
+                        try:
+                            # Encoding is left to the API process so only raw pixels are shared
+                            response = [
+                                SharedImage.create(image, request.format) for image in images
+                            ]
+                        except Exception as e:
+                            response = e
+                    response_queue.put((request_id, response, timing))
+                control_messages.profiler.finished(len(group))
 
-    def run(self, input_: RunImageGenerateInput) -> None:  # type: ignore[override]
+    def run(  # type: ignore[override]
+        self, input_: RunImageGenerateInput | RunImageGeneratePromptsInput
+    ) -> None:
+        if isinstance(input_, RunImageGeneratePromptsInput):
+            self._run_prompts(input_)
+            return
         pipeline = self._get_pipeline()
-        image = self._generate_image(pipeline, input_.input)
+        results = self._generate_images(pipeline, [ImageGenerateRequest(input=input_.input)])
+        image = results[0][0]
         output_file: Path = Path(input_.output_file)  # Does nothing but makes testable
         with output_file.open("wb") as output_fd:
             image.save(output_fd)
 
+    def _run_prompts(self, input_: RunImageGeneratePromptsInput) -> None:
+        """
+        Generate an image from each prompt and write them to numbered files. Images are
+        encoded and written in the background while the next image is generated.
+        """
+        pipeline = self._get_pipeline()
+        input_.output_directory.mkdir(parents=True, exist_ok=True)
+        start = time.perf_counter()
+        timings = Timings(started=time.monotonic())
+        with ImageWriter() as writer:
+            for index, prompt in enumerate(input_.inputs, start=1):
+                ((image,),) = self._generate_images(
+                    pipeline, [ImageGenerateRequest(input=prompt)], [timings]
+                )
+                output_file = input_.output_directory.joinpath(f"{index:06d}.{input_.format.name}")
+                writer.put(image, output_file, input_.format)
+        elapsed = time.perf_counter() - start
+        click.echo(
+            f"Generated {len(input_.inputs)} images in {elapsed:.2f}s, "
+            f"{len(input_.inputs) / elapsed if elapsed else 0.0:.2f} images/s, spending "
+            f"{timings.model:.2f}s in the pipeline and {writer.seconds:.2f}s encoding and "
+            f"writing images",
+            err=True,
+        )
+
+    def run_batch(self, input_: RunImageGenerateBatchInput) -> None:  # type: ignore[override]
+        pipeline = self._get_pipeline()
+        input_.output_directory.mkdir(parents=True, exist_ok=True)
+        processed = failed = 0
+        start = time.perf_counter()
+        for batch in self._read_request_batches(
+            input_.input_file, ImageGenerateRequest, input_.batch_size
+        ):
+            # Lines which failed to parse are written back as errors in place
+            responses: list[BaseModel | Exception] = list(batch)
+            requests = [
+                (processed + index + 1, request)
+                for index, request in enumerate(batch)
+                if isinstance(request, ImageGenerateRequest)
+            ]
+            for group in self._group_requests(requests):
+                try:
+                    results = self._generate_images(pipeline, [request for _, request in group])
+                except Exception as e:
+                    results = [e] * len(group)
+                for (line, request), images in zip(group, results, strict=True):
+                    responses[line - processed - 1] = self._save_images(
+                        images, request, input_.output_directory, line
+                    )
+            for response in responses:
+                self._write_batch_response(input_.output_file, response)
+            input_.output_file.flush()
+            processed += len(responses)
+            failed += sum(isinstance(response, Exception) for response in responses)
+            self._echo_batch_progress(processed, failed, start, done=False)
+        self._echo_batch_progress(processed, failed, start, done=True)
+
+    @staticmethod
+    def _save_images(
+        images: list[Image] | Exception,
+        request: ImageGenerateRequest,
+        output_directory: Path,
+        line: int,
+    ) -> ImageGenerateBatchResponse | Exception:
+        """
+        Write the images generated for a line of a batch run to the output directory
+        :return: Paths of the written images or the exception raised generating them
+        """
+        if isinstance(images, Exception):
+            return images
+        files = []
+        try:
+            for index, image in enumerate(images):
+                suffix = "" if len(images) == 1 else f"-{index + 1}"
+                output_file = output_directory.joinpath(f"{line:06d}{suffix}.{request.format.name}")
+                output_file.write_bytes(
+                    encode_image(image, request.format, request.quality, request.compress_level)
+                )
+                files.append(str(output_file))
+        except Exception as e:
+            return e
+        return ImageGenerateBatchResponse(file=files[0], files=files if len(files) > 1 else None)
+
     @classmethod
     def create(
         cls,
         model: str,
         revision: str | None,
         offload_folder: str | None,
+        max_batch_size: int = 1,
+        batch_timeout: float = 0.0,
+        continuous_batching: bool = False,
+        prefix_cache_size: int = 0,
+        fast_load_cache: Path | None = None,
+        warm_up_inputs: tuple[str, ...] = (),
+        dtype: str = "fp32",
+        quantize: str | None = None,
     ) -> "ImageGenerateModelHandler":
-        return cls(model, revision)
+        return cls(
+            model,
+            revision,
+            max_batch_size,
+            batch_timeout,
+            fast_load_cache,
+            warm_up_inputs,
+            dtype,
+            quantize,
+        )
+
+
+class _ResponseStreamer(BaseStreamer):
+    """
+    Streamer that sends newly generated text to the API process as it is generated.
+    Text which could be the start of a stop string is held back until it is not, and
+    nothing from the first stop string on is sent.
+    """
+
+    def __init__(
+        self,
+        tokenizer,
+        request_id: UUID,
+        response_queue: mp.Queue,
+        skip_prompt: bool,
+        stop: list[str] | None = None,
+    ) -> None:
+        self._tokenizer = tokenizer
+        self._request_id = request_id
+        self._response_queue = response_queue
+        self._skip_prompt = skip_prompt
+        self._stop = stop
+        self._token_ids: list[int] = []
+        self._text = ""
+        self._pending_text = ""
+        self._stopped = False
+
+    def put(self, value) -> None:
+        if self._skip_prompt:
+            self._skip_prompt = False
+            return
+        if self._stopped:
+            return
+        self._token_ids.extend(value.flatten().tolist())
+        text = self._tokenizer.decode(self._token_ids, skip_special_tokens=True)
+        # Hold back incomplete multibyte characters until the next token completes them
+        if text.endswith("\ufffd"):
+            return
+        stop_index = find_stop(text, self._stop, max(len(self._text) - stop_window(self._stop), 0))
+        if stop_index is not None:
+            self._stopped = True
+            self._send(text[:stop_index])
+        else:
+            self._pending_text = text
+            self._send(text[: max(len(text) - stop_window(self._stop) + 1, 0)])
+
+    def end(self) -> None:
+        if not self._stopped:
+            self._send(self._pending_text)
+
+    def _send(self, text: str) -> None:
+        if len(text) > len(self._text):
+            # Only the text crosses the process boundary, so it is not validated here
+            token = TextTransformToken.construct(text=text[len(self._text) :])
+            self._response_queue.put((self._request_id, token, None))
+            self._text = text
+
+
+class DraftModel:
+    """
+    Small model sharing the tokenizer of the model it assists, which drafts tokens for
+    the model to verify together in a single forward pass with assisted generation. The
+    model keeps the drafted tokens up to the first one it would not have generated
+    itself, followed by its own next token, so greedy results are unchanged. Forward
+    passes of both models are counted to report how many drafted tokens were accepted.
+    """
+
+    def __init__(self, model, draft) -> None:
+        """
+        :param model: Model the draft model assists
+        :param draft: Draft model
+        """
+        self.draft = draft
+        self._model_passes = 0
+        self._draft_passes = 0
+        model.register_forward_hook(self._count_model_pass)
+        draft.register_forward_hook(self._count_draft_pass)
+
+    def _count_model_pass(self, *_) -> None:
+        self._model_passes += 1
+
+    def _count_draft_pass(self, *_) -> None:
+        self._draft_passes += 1
+
+    def generate(self, model, input_length: int, **generate_kwargs) -> tuple[Any, int, int, int]:
+        """
+        Generate a single sequence with the draft model drafting tokens
+        :param model: Model the draft model assists
+        :param input_length: Length of the prompt, including padding
+        :param generate_kwargs: Keyword arguments for the generate call
+        :return: Generated sequences and the number of tokens drafted, drafted tokens
+        accepted, and forward passes of the model
+        """
+        model_passes, draft_passes = self._model_passes, self._draft_passes
+        outputs = model.generate(**generate_kwargs, assistant_model=self.draft)
+        model_passes = self._model_passes - model_passes
+        # Each model pass keeps a run of drafted tokens and adds one token of its own
+        accepted = max(outputs.shape[1] - input_length - model_passes, 0)
+        return outputs, self._draft_passes - draft_passes, accepted, model_passes
+
+
+class _CancelledStoppingCriteria(StoppingCriteria):
+    """Stops generation when the request being generated is cancelled"""
+
+    def __init__(self, request_id: UUID, control_messages: ControlMessages) -> None:
+        self._request_id = request_id
+        self._control_messages = control_messages
+
+    def __call__(self, input_ids, scores, **kwargs) -> bool:
+        return self._request_id in self._control_messages
 
 
 class TextTransformModelHandler(ModelHandler):
     """
     Handler for initializing a text transform model and then executing transform
-    requests against the model.
+    requests against the model. With a draft model, requests generated alone are
+    generated with assisted generation, which only supports a single sequence.
     """
 
     def __init__(
@@ -149,50 +771,471 @@ class TextTransformModelHandler(ModelHandler):
         model: str,
         revision: str | None,
         offload_folder: str | None,
+        max_batch_size: int = 1,
+        batch_timeout: float = 0.0,
+        continuous_batching: bool = False,
+        prefix_cache_size: int = 0,
+        fast_load_cache: Path | None = None,
+        warm_up_inputs: tuple[str, ...] = (),
+        dtype: str = "fp32",
+        quantize: str | None = None,
+        draft_model: str | None = None,
+        draft_revision: str | None = None,
     ):
+        if draft_model is not None and continuous_batching:
+            raise ValueError("A draft model cannot be used with continuous batching")
         self._model = model
         self._revision = revision
         self._offload_folder = offload_folder
+        self._max_batch_size = max_batch_size
+        self._batch_timeout = batch_timeout
+        self._continuous_batching = continuous_batching
+        self._prefix_cache_size = prefix_cache_size
+        self._fast_load_cache = fast_load_cache
+        self._warm_up_inputs = warm_up_inputs
+        check_precision(dtype, quantize)
+        self._dtype = dtype
+        self._quantize = quantize
+        self._draft_model = draft_model
+        self._draft_revision = draft_revision
+        self._generation_config: GenerationConfig | None = None
+
+    def prepare(self) -> None:
+        """Load the generation config, which decides whether requests sample by default"""
+        try:
+            self._generation_config = GenerationConfig.from_pretrained(
+                self._model, revision=self._revision
+            )
+        except OSError:
+            # Models without a generation config generate with their model config
+            config = AutoConfig.from_pretrained(
+                self._model, revision=self._revision, trust_remote_code=True
+            )
+            self._generation_config = GenerationConfig.from_model_config(config)
+
+    def is_deterministic(self, request: BaseModel) -> bool:
+        do_sample = request.do_sample  # type: ignore[attr-defined]
+        if do_sample is None:
+            if self._generation_config is None:
+                # Not prepared, so whether the model samples by default is unknown
+                return False
+            do_sample = self._generation_config.do_sample
+        return not do_sample
 
     def _get_model_and_tokenizer(self):
-        tokenizer = AutoTokenizer.from_pretrained(self._model, revision=self._revision)
-        model = AutoModelForCausalLM.from_pretrained(
-            self._model,
-            revision=self._revision,
-            device_map="auto",
-            offload_folder=self._offload_folder,
-            trust_remote_code=True,
-        )
+        with report_loading(self._model):
+            model_path, revision = model_source(self._model, self._revision, self._fast_load_cache)
+            tokenizer = AutoTokenizer.from_pretrained(model_path, revision=revision)
+            # Decoder only models must be padded on the left to generate for batches
+            tokenizer.padding_side = "left"
+            if tokenizer.pad_token is None:
+                tokenizer.pad_token = tokenizer.eos_token
+            model = AutoModelForCausalLM.from_pretrained(
+                model_path,
+                revision=revision,
+                device_map="auto",
+                offload_folder=self._offload_folder,
+                low_cpu_mem_usage=True,
+                trust_remote_code=True,
+                torch_dtype=DTYPES[self._dtype],
+            )
+            model = quantize_module(model, self._quantize)
         return model, tokenizer
 
+    def _get_draft_model(self, model, tokenizer) -> DraftModel | None:
+        """
+        Load the draft model with the same precision as the model
+        :raises ValueError: The draft model does not share the model's tokenizer
+        """
+        if self._draft_model is None:
+            return None
+        with report_loading(self._draft_model):
+            draft_path, revision = model_source(
+                self._draft_model, self._draft_revision, self._fast_load_cache
+            )
+            draft_tokenizer = AutoTokenizer.from_pretrained(draft_path, revision=revision)
+            if draft_tokenizer.get_vocab() != tokenizer.get_vocab():
+                raise ValueError(
+                    f"Draft model {self._draft_model} must share the tokenizer of {self._model}"
+                )
+            draft = AutoModelForCausalLM.from_pretrained(
+                draft_path,
+                revision=revision,
+                device_map="auto",
+                low_cpu_mem_usage=True,
+                trust_remote_code=True,
+                torch_dtype=DTYPES[self._dtype],
+            )
+            draft = quantize_module(draft, self._quantize)
+        return DraftModel(model, draft)
+
+    @staticmethod
+    def _check_sampling(request: TextTransformRequest, generation_config) -> None:
+        """
+        :raises ValueError: The request is for several sequences but leaves do_sample to
+        a generation config which does not sample
+        """
+        do_sample = request.do_sample
+        if do_sample is None:
+            do_sample = generation_config.do_sample
+        if request.num_return_sequences > 1 and not do_sample:
+            raise ValueError(
+                "num_return_sequences greater than 1 requires do_sample as the model does "
+                "not sample by default"
+            )
+
     @staticmethod
-    def _generate_results(model, tokenizer, input_):
-        tensor = tokenizer(input_, return_tensors="pt", return_token_type_ids=False).to(
-            model.device
+    def _batch_key(request: TextTransformRequest) -> tuple:
+        """Requests with the same sampling parameters can be generated together"""
+        return request.do_sample, request.temperature, request.top_p, request.num_return_sequences
+
+    @staticmethod
+    def _generate_results(
+        model,
+        tokenizer,
+        requests: list[TextTransformRequest],
+        timings: list[Timings] | None = None,
+        prefix_cache: PrefixCache | None = None,
+        draft_model: DraftModel | None = None,
+        **generate_kwargs,
+    ) -> list[list[str]]:
+        """
+        Generate text for a batch of requests with the same batch key with a single
+        generate call. Each result is limited to the length it would have had if its
+        request were generated alone and is cut at its first stop string. Generation
+        ends once every sequence has finished.
+        :param timings: Timings for each request which will be updated with the time
+        spent on the batch and the number of tokens generated for the request
+        :param prefix_cache: Cache of prompt KV caches used to prefill a single request
+        generating a single sequence. Padded batches are prefilled by generate.
+        :param draft_model: Model which drafts tokens for a single request generating a
+        single sequence whose prompt was not prefilled from the prefix cache
+        :param generate_kwargs: Additional keyword arguments for the generate call
+        :return: Generated sequences of each request
+        """
+        tokenize_start = time.perf_counter()
+        tensor = tokenizer(
+            [request.input for request in requests],
+            return_tensors="pt",
+            return_token_type_ids=False,
+            padding=True,
+        ).to(model.device)
+        padded_length = tensor["input_ids"].shape[1]
+        input_lengths = [int(length) for length in tensor["attention_mask"].sum(dim=1)]
+        generation_config = model.generation_config
+        # Requests in a group share their sampling parameters
+        TextTransformModelHandler._check_sampling(requests[0], generation_config)
+        max_new_tokens = []
+        for request, input_length in zip(requests, input_lengths, strict=True):
+            if request.max_new_tokens is not None:
+                max_new_tokens.append(request.max_new_tokens)
+            elif generation_config.max_new_tokens is not None:
+                max_new_tokens.append(generation_config.max_new_tokens)
+            else:
+                # Generation always produces at least one token, even for over length inputs
+                max_new_tokens.append(max(generation_config.max_length - input_length, 1))
+        generate_kwargs["pad_token_id"] = tokenizer.pad_token_id
+        generate_kwargs["max_new_tokens"] = max(max_new_tokens)
+        for name in ("do_sample", "temperature", "top_p", "num_return_sequences"):
+            if getattr(requests[0], name) is not None:
+                generate_kwargs[name] = getattr(requests[0], name)
+        sequences = requests[0].num_return_sequences
+        if any(request.stop for request in requests) or len(set(max_new_tokens)) > 1:
+            eos_token_id = generation_config.eos_token_id
+            stopping_criteria = generate_kwargs.pop("stopping_criteria", StoppingCriteriaList())
+            stopping_criteria.append(
+                StopStringCriteria(
+                    tokenizer,
+                    padded_length,
+                    [request.stop for request in requests for _ in range(sequences)],
+                    [limit for limit in max_new_tokens for _ in range(sequences)],
+                    eos_token_id if isinstance(eos_token_id, list) else [eos_token_id],
+                )
+            )
+            generate_kwargs["stopping_criteria"] = stopping_criteria
+        model_start = time.perf_counter()
+        if prefix_cache is not None and len(requests) == 1 and sequences == 1:
+            # Generate runs only the final prompt token when given the cache of the rest
+            past_key_values = prefix_cache.prefill(model, tensor["input_ids"][0, :-1].tolist())
+            if past_key_values is not None:
+                generate_kwargs["past_key_values"] = past_key_values
+        assisted = (
+            draft_model is not None
+            and len(requests) == 1
+            and sequences == 1
+            and "past_key_values" not in generate_kwargs
         )
-        outputs = model.generate(**tensor)
-        results = [tokenizer.decode(output, skip_special_tokens=True) for output in outputs]
+        if assisted:
+            outputs, drafted, accepted, model_passes = draft_model.generate(  # type: ignore
+                model, padded_length, **tensor, **generate_kwargs
+            )
+        else:
+            outputs = model.generate(**tensor, **generate_kwargs)
+        decode_start = time.perf_counter()
+        results: list[list[str]] = [[] for _ in requests]
+        tokens = [0] * len(requests)
+        for row, output in enumerate(outputs):
+            index = row // sequences
+            end = padded_length + max_new_tokens[index]
+            tokens[index] += int((output[padded_length:end] != tokenizer.pad_token_id).sum())
+            output = output[padded_length - input_lengths[index] : end]
+            text = tokenizer.decode(output, skip_special_tokens=True)
+            if requests[index].stop:
+                prompt = tokenizer.decode(output[: input_lengths[index]], skip_special_tokens=True)
+                text = text[: find_stop(text, requests[index].stop, len(prompt))]
+            results[index].append(text)
+        decode_end = time.perf_counter()
+        for timing, token_count in zip(timings or [], tokens, strict=False):
+            timing.tokenize += model_start - tokenize_start
+            timing.model += decode_start - model_start
+            timing.decode += decode_end - decode_start
+            timing.tokens += token_count
+            timing.batch_size = len(requests)
+            if assisted:
+                timing.draft_tokens += drafted
+                timing.accepted_tokens += accepted
+                timing.model_passes += model_passes
         return results
 
-    def start(self, request_queue: mp.Queue, response_queue: mp.Queue) -> None:
+    @staticmethod
+    def _response(sequences: list[str]) -> TextTransformResponse:
+        return TextTransformResponse(
+            generated_text=sequences[0], generated_texts=sequences if len(sequences) > 1 else None
+        )
+
+    def start(
+        self, request_queue: mp.Queue, response_queue: mp.Queue, control_queue: mp.Queue
+    ) -> None:
         model, tokenizer = self._get_model_and_tokenizer()
+        draft_model = self._get_draft_model(model, tokenizer)
+        self._warm_up(
+            self._warm_up_inputs,
+            lambda inputs: self._generate_results(
+                model,
+                tokenizer,
+                [TextTransformRequest(input=input_) for input_ in inputs],
+                draft_model=draft_model,
+            ),
+            response_queue,
+        )
+        control_messages = ControlMessages(control_queue)
+        prefix_cache = PrefixCache(self._prefix_cache_size) if self._prefix_cache_size else None
+        if self._continuous_batching:
+            self._process_continuously(
+                model, tokenizer, request_queue, response_queue, control_messages, prefix_cache
+            )
+        else:
+            self._process_batches(
+                model,
+                tokenizer,
+                request_queue,
+                response_queue,
+                control_messages,
+                prefix_cache,
+                draft_model,
+            )
+
+    def _process_batches(
+        self,
+        model,
+        tokenizer,
+        request_queue: mp.Queue,
+        response_queue: mp.Queue,
+        control_messages: ControlMessages,
+        prefix_cache: PrefixCache | None,
+        draft_model: DraftModel | None = None,
+    ) -> None:
         while True:
-            item: tuple[UUID, TextTransformRequest] = request_queue.get()
-            request_id, request = item
-            try:
-                results = self._generate_results(model, tokenizer, request.input)
+            batch: list[tuple[UUID, TextTransformRequest]] = self._get_request_batch(
+                request_queue, self._max_batch_size, self._batch_timeout
+            )
+            started = time.monotonic()
+            # Requests cancelled while queued are dropped without a response
+            batch = [item for item in batch if item[0] not in control_messages]
+            # Streams are sent token by token which requires generating them alone
+            streams = [item for item in batch if isinstance(item[1], TextTransformStreamRequest)]
+            batch = [item for item in batch if not isinstance(item[1], TextTransformStreamRequest)]
+            control_messages.profiler.start()
+            for group in self._group_requests(batch):
+                timings = [Timings(started=started) for _ in group]
+                try:
+                    results = self._generate_results(
+                        model,
+                        tokenizer,
+                        [request for _, request in group],
+                        timings,
+                        prefix_cache,
+                        draft_model,
+                    )
+                    responses: list[TextTransformResponse | Exception] = [
+                        self._response(sequences) for sequences in results
+                    ]
+                except Exception as e:
+                    responses = [e] * len(group)
+                for (request_id, _), response, timing in zip(
+                    group, responses, timings, strict=True
+                ):
+                    response_queue.put((request_id, response, timing))
+                control_messages.profiler.finished(len(group))
+            for request_id, request in streams:
+                timing = Timings(started=started)
+                try:
+                    streamer = _ResponseStreamer(
+                        tokenizer, request_id, response_queue, True, request.stop
+                    )
+                    stopping_criteria = _CancelledStoppingCriteria(request_id, control_messages)
+                    results = self._generate_results(
+                        model,
+                        tokenizer,
+                        [request],
+                        [timing],
+                        prefix_cache,
+                        draft_model,
+                        streamer=streamer,
+                        stopping_criteria=StoppingCriteriaList([stopping_criteria]),
+                    )
+                    response: TextTransformResponse | Exception = self._response(results[0])
+                except Exception as e:
+                    response = e
+                response_queue.put((request_id, response, timing))
+                control_messages.profiler.finished()
 
-                response: TextTransformResponse | Exception = TextTransformResponse(
-                    generated_text=results[0]
-                )
-            except Exception as e:
-                response = e
-            response_queue.put((request_id, response))
+    def _process_continuously(
+        self,
+        model,
+        tokenizer,
+        request_queue: mp.Queue,
+        response_queue: mp.Queue,
+        control_messages: ControlMessages,
+        prefix_cache: PrefixCache | None,
+    ) -> None:
+        engine = ContinuousBatchingEngine(model, tokenizer, self._max_batch_size, prefix_cache)
+        # Requests for several sequences are generated as one engine sequence each. The
+        # request ID of each such sequence and the results of each such request are kept
+        # until every sequence of the request has finished.
+        sequence_requests: dict[UUID, UUID] = {}
+        request_sequences: dict[UUID, list[tuple[str | Exception, Timings]]] = {}
+        while True:
+            # Only block for requests when there is nothing to generate
+            items: list[tuple[UUID, TextTransformRequest, float | None]] = []
+            if not engine.has_work:
+                items.append(request_queue.get())
+            with contextlib.suppress(queue.Empty):
+                while True:
+                    items.append(request_queue.get(block=False))
+            for request_id, request in self._drop_expired(items):
+                try:
+                    self._check_sampling(request, model.generation_config)
+                except ValueError as e:
+                    response_queue.put((request_id, e, Timings(started=time.monotonic())))
+                    continue
+                streamer = None
+                if isinstance(request, TextTransformStreamRequest):
+                    streamer = _ResponseStreamer(
+                        tokenizer, request_id, response_queue, False, request.stop
+                    )
+                sequence_ids = [request_id]
+                if request.num_return_sequences > 1:
+                    sequence_ids = [uuid4() for _ in range(request.num_return_sequences)]
+                    sequence_requests.update(
+                        (sequence_id, request_id) for sequence_id in sequence_ids
+                    )
+                    request_sequences[request_id] = []
+                for sequence_id in sequence_ids:
+                    engine.add(
+                        sequence_id,
+                        request.input,
+                        max_new_tokens=request.max_new_tokens,
+                        streamer=streamer,
+                        do_sample=request.do_sample,
+                        temperature=request.temperature,
+                        top_p=request.top_p,
+                        stop=request.stop,
+                    )
+            for request_id in control_messages.poll():
+                engine.cancel(request_id)
+                if request_sequences.pop(request_id, None) is not None:
+                    for sequence_id, sequence_request_id in list(sequence_requests.items()):
+                        if sequence_request_id == request_id:
+                            engine.cancel(sequence_id)
+                            del sequence_requests[sequence_id]
+
+            control_messages.profiler.start()
+            for sequence_id, result, timing in engine.step():
+                request_id = sequence_requests.pop(sequence_id, sequence_id)
+                if request_id not in request_sequences:
+                    response: TextTransformResponse | Exception = (
+                        result if isinstance(result, Exception) else self._response([result])
+                    )
+                    response_queue.put((request_id, response, timing))
+                    control_messages.profiler.finished()
+                    continue
+                finished = request_sequences[request_id]
+                finished.append((result, timing))
+                if request_id in sequence_requests.values():
+                    continue
+                del request_sequences[request_id]
+                results = [result_ for result_, _ in finished]
+                errors = [result_ for result_ in results if isinstance(result_, Exception)]
+                response = errors[0] if errors else self._response(results)  # type: ignore
+                timing.tokens = sum(timing_.tokens for _, timing_ in finished)
+                response_queue.put((request_id, response, timing))
+                control_messages.profiler.finished()
 
     def run(self, input_: RunGenerateInput) -> None:  # type: ignore[override]
         model, tokenizer = self._get_model_and_tokenizer()
-        results = self._generate_results(model, tokenizer, input_.input)
-        click.secho(results[0], italic=True)
+        draft_model = self._get_draft_model(model, tokenizer)
+        timings = Timings(started=time.monotonic())
+        results = self._generate_results(
+            model,
+            tokenizer,
+            [TextTransformRequest(input=input_.input)],
+            [timings],
+            draft_model=draft_model,
+        )
+        click.secho(results[0][0], italic=True)
+        if timings.model_passes:
+            click.echo(
+                f"Accepted {timings.accepted_tokens} of {timings.draft_tokens} drafted tokens "
+                f"({timings.accepted_tokens / max(timings.draft_tokens, 1):.0%}), generating "
+                f"{(timings.accepted_tokens + timings.model_passes) / timings.model_passes:.2f} "
+                "tokens per forward pass of the model",
+                err=True,
+            )
+
+    def run_batch(self, input_: RunBatchInput) -> None:
+        model, tokenizer = self._get_model_and_tokenizer()
+        processed = failed = 0
+        start = time.perf_counter()
+        for batch in self._read_request_batches(
+            input_.input_file, TextTransformRequest, input_.batch_size
+        ):
+            # Lines which failed to parse are written back as errors in place
+            responses: list[BaseModel | Exception] = list(batch)
+            requests = [
+                (index, request)
+                for index, request in enumerate(batch)
+                if isinstance(request, TextTransformRequest)
+            ]
+            for group in self._group_requests(requests):
+                try:
+                    results = self._generate_results(
+                        model, tokenizer, [request for _, request in group]
+                    )
+                    group_responses: list[BaseModel | Exception] = [
+                        self._response(sequences) for sequences in results
+                    ]
+                except Exception as e:
+                    group_responses = [e] * len(group)
+                for (index, _), response in zip(group, group_responses, strict=True):
+                    responses[index] = response
+            for response in responses:
+                self._write_batch_response(input_.output_file, response)
+            input_.output_file.flush()
+            processed += len(responses)
+            failed += sum(isinstance(response, Exception) for response in responses)
+            self._echo_batch_progress(processed, failed, start, done=False)
+        self._echo_batch_progress(processed, failed, start, done=True)
 
     @classmethod
     def create(
@@ -200,5 +1243,29 @@ class TextTransformModelHandler(ModelHandler):
         model: str,
         revision: str | None,
         offload_folder: str | None,
+        max_batch_size: int = 1,
+        batch_timeout: float = 0.0,
+        continuous_batching: bool = False,
+        prefix_cache_size: int = 0,
+        fast_load_cache: Path | None = None,
+        warm_up_inputs: tuple[str, ...] = (),
+        dtype: str = "fp32",
+        quantize: str | None = None,
+        draft_model: str | None = None,
+        draft_revision: str | None = None,
     ) -> "TextTransformModelHandler":
-        return cls(model, revision, offload_folder)
+        return cls(
+            model,
+            revision,
+            offload_folder,
+            max_batch_size,
+            batch_timeout,
+            continuous_batching,
+            prefix_cache_size,
+            fast_load_cache,
+            warm_up_inputs,
+            dtype,
+            quantize,
+            draft_model,
+            draft_revision,
+        )
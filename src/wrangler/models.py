@@ -2,11 +2,77 @@
 from enum import Enum
 from typing import Annotated
 
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, root_validator, validator
 
 
 class TextTransformRequest(BaseModel):
     input: Annotated[str, Field(min_length=1, description="Input text")]
+    model: Annotated[
+        str | None,
+        Field(
+            description="Model to send the request to, as MODEL[:REVISION], when the server "
+            "hosts several models. Defaults to the first model the server was started with. "
+            "Servers hosting a single model ignore it."
+        ),
+    ] = None
+    max_new_tokens: Annotated[
+        int | None,
+        Field(
+            ge=1,
+            description="Maximum number of tokens to generate. Defaults to the model's "
+            "generation config.",
+        ),
+    ] = None
+    do_sample: Annotated[
+        bool | None,
+        Field(
+            description="Sample each token rather than choosing the most likely one. "
+            "Defaults to the model's generation config."
+        ),
+    ] = None
+    temperature: Annotated[
+        float | None,
+        Field(gt=0.0, description="Temperature with which tokens are sampled"),
+    ] = None
+    top_p: Annotated[
+        float | None,
+        Field(
+            gt=0.0,
+            le=1.0,
+            description="Sample only from the most likely tokens whose probabilities add "
+            "up to top_p",
+        ),
+    ] = None
+    num_return_sequences: Annotated[
+        int,
+        Field(
+            ge=1,
+            description="Number of sequences to sample. Requires sampling, either with "
+            "do_sample or by the model's generation config.",
+        ),
+    ] = 1
+    stop: Annotated[
+        list[str] | None,
+        Field(
+            description="Generation stops at the first of these strings, which is "
+            "removed from the generated text"
+        ),
+    ] = None
+
+    @validator("stop", each_item=True)
+    @classmethod
+    def _stop_is_not_empty(cls, value):
+        if not value:
+            raise ValueError("Stop strings must not be empty")
+        return value
+
+    @root_validator(skip_on_failure=True)
+    @classmethod
+    def _num_return_sequences_requires_sampling(cls, values):
+        # Left unset, whether to sample is decided by the model's generation config
+        if values["num_return_sequences"] > 1 and values["do_sample"] is False:
+            raise ValueError("num_return_sequences greater than 1 requires do_sample")
+        return values
 
     class Config:
         """TextTransformRequest Config"""
@@ -14,6 +80,8 @@ class TextTransformRequest(BaseModel):
         schema_extra = {
             "example": {
                 "input": "I am so sorry for being",
+                "max_new_tokens": 16,
+                "stop": ["."],
             }
         }
 
@@ -23,6 +91,10 @@ class TextTransformResponse(BaseModel):
         str,
         Field(description="The results from the text transform"),
     ]
+    generated_texts: Annotated[
+        list[str] | None,
+        Field(description="Every sampled sequence when num_return_sequences is above 1"),
+    ] = None
 
     class Config:
         """TextTransformResponse Config"""
@@ -34,21 +106,118 @@ class TextTransformResponse(BaseModel):
         }
 
 
+class TextTransformStreamRequest(TextTransformRequest):
+    """Request schema for text transforms streamed as the text is generated"""
+
+    @validator("num_return_sequences")
+    @classmethod
+    def _single_sequence(cls, value):
+        if value != 1:
+            raise ValueError("Only a single sequence can be streamed")
+        return value
+
+    class Config:
+        """TextTransformStreamRequest Config"""
+
+        schema_extra = {
+            "example": {
+                "input": "I am so sorry for being",
+            }
+        }
+
+
+class TextTransformToken(BaseModel):
+    """Streamed chunk of generated text"""
+
+    text: Annotated[
+        str,
+        Field(description="Text generated since the previous chunk"),
+    ]
+
+    class Config:
+        """TextTransformToken Config"""
+
+        schema_extra = {
+            "example": {
+                "text": " so",
+            }
+        }
+
+
 class ImageFormat(str, Enum):
     """Image format"""
 
     png = "PNG"
     jpg = "JPEG"
     gif = "GIF"
+    webp = "WEBP"
 
 
 class ImageGenerateRequest(BaseModel):
     """Request schema for generating images from text"""
 
     input: Annotated[str, Field(description="Description of the image to generate")]
+    model: Annotated[
+        str | None,
+        Field(
+            description="Model to send the request to, as MODEL[:REVISION], when the server "
+            "hosts several models. Defaults to the first model the server was started with. "
+            "Servers hosting a single model ignore it."
+        ),
+    ] = None
     format: Annotated[
         ImageFormat, Field(description="Format of the image to return")
     ] = ImageFormat.png
+    quality: Annotated[
+        int | None,
+        Field(
+            ge=1,
+            le=100,
+            description="Quality of JPEG and WebP images from 1 to 100. Defaults to the "
+            "encoder's. Ignored by other formats.",
+        ),
+    ] = None
+    compress_level: Annotated[
+        int | None,
+        Field(
+            ge=0,
+            le=9,
+            description="Compression level of PNG images from 0, fastest, to 9, smallest. "
+            "Defaults to the encoder's. Ignored by other formats.",
+        ),
+    ] = None
+    num_images_per_prompt: Annotated[
+        int, Field(ge=1, description="Number of images to generate from the input")
+    ] = 1
+    num_inference_steps: Annotated[
+        int | None,
+        Field(ge=1, description="Number of denoising steps. Defaults to the pipeline's."),
+    ] = None
+    width: Annotated[
+        int | None,
+        Field(
+            ge=8,
+            multiple_of=8,
+            description="Width of the image in pixels. Defaults to the pipeline's.",
+        ),
+    ] = None
+    height: Annotated[
+        int | None,
+        Field(
+            ge=8,
+            multiple_of=8,
+            description="Height of the image in pixels. Defaults to the pipeline's.",
+        ),
+    ] = None
+    seed: Annotated[
+        int | None,
+        Field(
+            ge=0,
+            lt=2**63,
+            description="Seed from which the images are generated. The same request with "
+            "the same seed generates the same images. Random by default.",
+        ),
+    ] = None
 
     class Config:
         """ImageGenerateRequest Config"""
@@ -57,6 +226,8 @@ class ImageGenerateRequest(BaseModel):
             "example": {
                 "input": "A cowboy riding a horse through the desert southwest",
                 "format": "PNG",
+                "num_inference_steps": 25,
+                "seed": 42,
             }
         }
 
@@ -66,6 +237,10 @@ class ImageGenerateResponse(BaseModel):
 
     image: Annotated[str, Field(description="Base64 encoded image data")]
     format: Annotated[ImageFormat, Field(description="Format of the image")]
+    images: Annotated[
+        list[str] | None,
+        Field(description="Every generated image when num_images_per_prompt is above 1"),
+    ] = None
 
     class Config:
         """ImageGenerateResponse Config"""
@@ -76,3 +251,22 @@ class ImageGenerateResponse(BaseModel):
                 "format": "PNG",
             }
         }
+
+
+class ImageGenerateBatchResponse(BaseModel):
+    """Result of an image generated by a batch run"""
+
+    file: Annotated[str, Field(description="Path of the file the image was written to")]
+    files: Annotated[
+        list[str] | None,
+        Field(description="Path of every generated image when num_images_per_prompt is above 1"),
+    ] = None
+
+    class Config:
+        """ImageGenerateBatchResponse Config"""
+
+        schema_extra = {
+            "example": {
+                "file": "images/000001.png",
+            }
+        }
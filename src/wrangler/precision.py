@@ -0,0 +1,69 @@
+"""Weight precision and dynamic quantization of models for CPU inference"""
+import torch
+from torch import nn
+from transformers.pytorch_utils import Conv1D
+
+# Names of the dtypes in which model weights may be loaded
+DTYPES = {"fp32": torch.float32, "bf16": torch.bfloat16, "fp16": torch.float16}
+
+# Names of the methods with which model weights may be quantized
+QUANTIZATIONS = ("dynamic-int8",)
+
+
+def check_precision(dtype: str, quantize: str | None) -> None:
+    """
+    Raise a ValueError unless a model can be loaded in the dtype and quantized with the
+    quantization method
+    :param dtype: Name of the dtype in which to load weights
+    :param quantize: Name of the quantization method or None
+    """
+    if dtype not in DTYPES:
+        raise ValueError(f"Unknown dtype {dtype}, expected one of {', '.join(DTYPES)}")
+    if quantize is None:
+        return
+    if quantize not in QUANTIZATIONS:
+        raise ValueError(
+            f"Unknown quantization {quantize}, expected one of {', '.join(QUANTIZATIONS)}"
+        )
+    if dtype != "fp32":
+        # Dynamically quantized layers take and return fp32 activations
+        raise ValueError(f"{quantize} quantization requires fp32 weights, not {dtype}")
+
+
+def quantize_module(module: nn.Module, quantize: str | None) -> nn.Module:
+    """
+    Quantize the linear layers of a module in place. Weights are stored as int8 and
+    activations are quantized on the fly, so matrix multiplications run as int8 on the
+    CPU and the other layers keep their fp32 weights.
+    :param module: Module with fp32 weights
+    :param quantize: Name of the quantization method or None to leave the module as it is
+    :return: The quantized module
+    """
+    if quantize is None:
+        return module
+    check_precision("fp32", quantize)
+    _replace_conv1d(module)
+    # The output embeddings of language models are often tied to the input embeddings,
+    # and the logits they produce are the most sensitive to quantization error
+    output_embeddings = getattr(module, "get_output_embeddings", lambda: None)()
+    layers = {
+        name
+        for name, child in module.named_modules()
+        if isinstance(child, nn.Linear) and child is not output_embeddings
+    }
+    return torch.ao.quantization.quantize_dynamic(module, layers, dtype=torch.qint8, inplace=True)
+
+
+def _replace_conv1d(module: nn.Module) -> None:
+    """
+    Replace the Conv1D layers of GPT-2 style models, which are linear layers with
+    transposed weights, with the equivalent nn.Linear layers so they are quantized
+    """
+    for name, child in module.named_children():
+        if isinstance(child, Conv1D):
+            linear = nn.Linear(*child.weight.shape, dtype=child.weight.dtype)
+            linear.weight = nn.Parameter(child.weight.detach().t().contiguous())
+            linear.bias = child.bias
+            setattr(module, name, linear)
+        else:
+            _replace_conv1d(child)
@@ -0,0 +1,144 @@
+"""Reuse of the KV cache of prompt prefixes shared across requests"""
+from collections import OrderedDict
+
+import torch
+
+# Legacy transformers cache format: a (key, value) tensor pair per layer. Each tensor
+# has the shape [batch, heads, sequence, head dimensions].
+PastKeyValues = tuple[tuple[torch.Tensor, torch.Tensor], ...]
+
+
+class _Node:
+    """Trie node for a token following the tokens of its ancestors"""
+
+    def __init__(self) -> None:
+        self.children: dict[int, _Node] = {}
+        # Any cached prefix passing through this node. Its KV cache holds this node's
+        # prefix as its leading entries.
+        self.entry: tuple[int, ...] | None = None
+
+
+class PrefixCache:
+    """
+    KV caches of previously prefilled token sequences held in a trie of their tokens.
+    A new sequence reuses the KV cache of the longest prefix it shares with any cached
+    sequence, so only the tokens after the shared prefix need to be prefilled. The least
+    recently used sequences are evicted to keep the cached tensors within the budget.
+    """
+
+    def __init__(self, max_bytes: int) -> None:
+        """
+        :param max_bytes: Maximum combined size of the cached KV tensors
+        """
+        self._max_bytes = max_bytes
+        self._root = _Node()
+        self._entries: OrderedDict[tuple[int, ...], tuple[PastKeyValues, int]] = OrderedDict()
+        self._size = 0
+
+    @property
+    def size(self) -> int:
+        """Combined size in bytes of the cached KV tensors"""
+        return self._size
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def lookup(self, token_ids: list[int]) -> tuple[int, PastKeyValues | None]:
+        """
+        Find the longest cached prefix of a token sequence
+        :param token_ids: Tokens of the sequence
+        :return: Length of the prefix and its KV cache, or 0 and None if no prefix is
+        cached
+        """
+        node = self._root
+        length = 0
+        for token_id in token_ids:
+            child = node.children.get(token_id)
+            if child is None or child.entry is None:
+                break
+            node = child
+            length += 1
+        if not length:
+            return 0, None
+        past_key_values, _ = self._entries[node.entry]  # type: ignore[index]
+        self._entries.move_to_end(node.entry)  # type: ignore[arg-type]
+        return length, tuple(
+            (key[:, :, :length], value[:, :, :length]) for key, value in past_key_values
+        )
+
+    def insert(self, token_ids: list[int], past_key_values: PastKeyValues) -> None:
+        """
+        Cache the KV cache of a token sequence, evicting the least recently used
+        sequences to make room. Sequences larger than the budget are not cached.
+        :param token_ids: Tokens of the sequence
+        :param past_key_values: KV cache whose leading entries are for the tokens
+        """
+        entry = tuple(token_ids)
+        if not entry:
+            return
+        length, _ = self.lookup(token_ids)
+        if length == len(entry):
+            # Already held as the prefix of a cached sequence
+            return
+        # Copied when trimmed so the cache does not keep the rest of the tensors alive
+        past_key_values = tuple(
+            (key[:, :, : len(entry)].contiguous(), value[:, :, : len(entry)].contiguous())
+            for key, value in past_key_values
+        )
+        size = sum(
+            tensor.element_size() * tensor.nelement()
+            for layer in past_key_values
+            for tensor in layer
+        )
+        if size > self._max_bytes:
+            return
+        while self._size + size > self._max_bytes:
+            self._evict(next(iter(self._entries)))
+        self._entries[entry] = (past_key_values, size)
+        self._size += size
+        node = self._root
+        for depth, token_id in enumerate(entry, start=1):
+            node = node.children.setdefault(token_id, _Node())
+            if node.entry is not None and len(node.entry) == depth:
+                # A cached prefix of this sequence is no longer needed
+                _, prefix_size = self._entries.pop(node.entry)
+                self._size -= prefix_size
+            node.entry = entry
+
+    def _evict(self, entry: tuple[int, ...]) -> None:
+        _, size = self._entries.pop(entry)
+        self._size -= size
+        path = [self._root]
+        for token_id in entry:
+            path.append(path[-1].children[token_id])
+        # From the leaf up, hand each node to another entry below it or prune it
+        for depth in range(len(entry), 0, -1):
+            node = path[depth]
+            if node.entry == entry:
+                node.entry = next(
+                    (child.entry for child in node.children.values() if child.entry), None
+                )
+            if node.entry is None and not node.children:
+                del path[depth - 1].children[entry[depth - 1]]
+
+    @torch.inference_mode()
+    def prefill(self, model, token_ids: list[int]) -> PastKeyValues | None:
+        """
+        KV cache of a token sequence, running the model only on the tokens after the
+        longest cached prefix. The sequence is then cached.
+        :param model: Model whose KV cache is held
+        :param token_ids: Tokens of the sequence
+        :return: KV cache for every token or None if the sequence is empty
+        """
+        cached_length, past_key_values = self.lookup(token_ids)
+        if cached_length < len(token_ids):
+            device = model.device
+            outputs = model(
+                input_ids=torch.tensor([token_ids[cached_length:]], device=device),
+                past_key_values=past_key_values,
+                position_ids=torch.arange(cached_length, len(token_ids), device=device)[None],
+                use_cache=True,
+            )
+            past_key_values = outputs.past_key_values
+            self.insert(token_ids, past_key_values)
+        return past_key_values
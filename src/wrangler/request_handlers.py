@@ -1,19 +1,36 @@
 """Request Handlers"""
 import asyncio
-import queue
+import base64
+import contextlib
+import functools
+import json
+import math
+import os
+import time
 from asyncio import Future
-import multiprocessing as mp
-from typing import Generic, TypeVar
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator, Generic, Iterator, TypeVar
 from uuid import UUID, uuid4
 
+from fastapi import HTTPException, Request
+from fastapi.responses import Response, StreamingResponse
 from pydantic import BaseModel
+from starlette.background import BackgroundTask
 
+from wrangler.cache import ResponseCache
+from wrangler.hosting import ModelPool, UnknownModelError
+from wrangler.images import MEDIA_TYPES, SharedImage
+from wrangler.metrics import Metrics
 from wrangler.models import (
     TextTransformRequest,
     TextTransformResponse,
+    TextTransformStreamRequest,
+    ImageFormat,
     ImageGenerateRequest,
     ImageGenerateResponse,
 )
+from wrangler.tracing import Tracer
+from wrangler.workers import QueueFullError, WorkerPool, WorkerPoolFailedError
 
 T1 = TypeVar("T1")
 T2 = TypeVar("T2")
@@ -22,39 +39,248 @@ T2 = TypeVar("T2")
 class RequestHandler(Generic[T1, T2]):
     """
     Callable class that handles sending requests to and receiving responses from the
-    model handler's process
+    model handler's process. Each request is removed from the request future map once it
+    is complete. Requests which time out or whose client disconnects are cancelled in the
+    model handler's process. Requests are rejected with a 429 when the worker pool is
+    full, a 503 when no model process is running or the model processes failed to
+    start, and a 404 when the server does not
+    host the requested model. Responses to deterministic requests are served from the
+    response cache when possible. The result of each request is counted in the metrics
+    and its handling is recorded as the root span of its trace.
     """
 
     def __init__(
         self,
-        request_queue: mp.Queue,
-        request_future_map: dict[UUID, Future[T2]],
+        worker_pool: WorkerPool | ModelPool,
+        request_future_map: dict[UUID, Future[T2] | asyncio.Queue[BaseModel | Exception]],
+        timeout: float | None = None,
+        metrics: Metrics | None = None,
+        response_cache: ResponseCache | None = None,
+        tracer: Tracer | None = None,
     ) -> None:
-        self._request_queue = request_queue
+        """
+        :param worker_pool: Pool of model processes, or of the pools of several models,
+        to which requests are sent
+        :param request_future_map: Map of request IDs to the futures awaiting responses
+        :param timeout: Maximum number of seconds to wait for a response
+        :param metrics: Metrics in which to count request results
+        :param response_cache: Cache of responses checked before requests are sent to
+        the model
+        :param tracer: Tracer in which to record the spans of each request
+        """
+        self._worker_pool = worker_pool
         self._request_future_map = request_future_map
+        self._timeout = timeout
+        self._metrics = metrics
+        self._response_cache = response_cache
+        self._tracer = tracer
 
-    async def __call__(self, request: T1) -> T2:
-        future: Future[BaseModel] = asyncio.get_running_loop().create_future()
+    async def __call__(self, request: T1, http_request: Request) -> T2:
         request_id = uuid4()
+        with self._traced(request_id):
+            return await self._handle(request_id, request, http_request)
+
+    async def _handle(self, request_id: UUID, request: T1, http_request: Request) -> T2:
+        cache_key = None
+        if self._response_cache is not None:
+            cache_key = self._response_cache.key(request)  # type: ignore[arg-type]
+        if cache_key is not None:
+            cached = self._response_cache.get(cache_key)  # type: ignore[union-attr]
+            if cached is not None:
+                self._count("success")
+                return cached  # type: ignore[return-value]
+        future: Future[T2] = asyncio.get_running_loop().create_future()
+        self._submit(request_id, request)  # type: ignore[arg-type]
         self._request_future_map[request_id] = future
-        sent = False
-        while not sent:
-            try:
-                self._request_queue.put((request_id, request), block=False)
-                sent = True
-            except queue.Full:
-                await asyncio.sleep(0)
-        return await future
+        disconnected = asyncio.ensure_future(self._wait_for_disconnect(http_request))
+        try:
+            await asyncio.wait(
+                {future, disconnected}, timeout=self._timeout, return_when=asyncio.FIRST_COMPLETED
+            )
+            if future.done():
+                if future.exception() is not None:
+                    self._count("error")
+                else:
+                    self._count("success")
+                    if cache_key is not None:
+                        self._response_cache.put(  # type: ignore[union-attr]
+                            cache_key, future.result()  # type: ignore[arg-type]
+                        )
+                return future.result()
+            if disconnected.done():
+                self._count("disconnected")
+                raise HTTPException(status_code=499, detail="Client closed request")
+            self._count("timeout")
+            raise HTTPException(status_code=504, detail="Timed out waiting for the model")
+        finally:
+            disconnected.cancel()
+            del self._request_future_map[request_id]
+            if not future.done():
+                future.cancel()
+                self._worker_pool.cancel(request_id)
+
+    def _submit(self, request_id: UUID, request: BaseModel) -> None:
+        """
+        Admit a request to the worker pool with a deadline of the request timeout
+        :raises HTTPException: The request was rejected as the server is saturated
+        """
+        # A failed pool will not recover, so it rejects requests without a Retry-After
+        if not self._worker_pool.available and not self._worker_pool.failed:
+            self._count("unavailable")
+            raise HTTPException(
+                status_code=503,
+                detail="No model process is available",
+                headers={"Retry-After": str(math.ceil(self._worker_pool.restart_delay))},
+            )
+        deadline = None if self._timeout is None else time.monotonic() + self._timeout
+        try:
+            self._worker_pool.submit(request_id, request, deadline)
+        except UnknownModelError as e:
+            self._count("unknown_model")
+            raise HTTPException(status_code=404, detail=str(e)) from None
+        except WorkerPoolFailedError as e:
+            self._count("unavailable")
+            raise HTTPException(status_code=503, detail=str(e)) from None
+        except QueueFullError:
+            self._count("rejected")
+            raise HTTPException(
+                status_code=429,
+                detail="Too many requests are waiting on the model",
+                headers={"Retry-After": "1"},
+            ) from None
+
+    @contextlib.contextmanager
+    def _traced(self, request_id: UUID) -> Iterator[None]:
+        """Record the root span of a request around its handling"""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self._trace_request(request_id, start)
+
+    def _trace_request(self, request_id: UUID, start: float) -> None:
+        """Record the root span of a request which began at the time.monotonic value"""
+        if self._tracer is not None:
+            self._tracer.span(
+                request_id,
+                "request",
+                start,
+                time.monotonic(),
+                parent=None,
+                attributes={"handler": type(self).__name__},
+            )
+
+    def _count(self, result: str) -> None:
+        if self._metrics is not None:
+            self._metrics.requests.inc(result=result)
+
+    @staticmethod
+    async def _wait_for_disconnect(http_request: Request) -> None:
+        # The request body has already been received so only a disconnect can arrive
+        while (await http_request.receive())["type"] != "http.disconnect":
+            pass
 
 
 class ImageGenerateRequestHandler(RequestHandler):
     """
-    Class necessary to properly generate request/response OpenAPI docs.
-    Just acts as a passthrough.
+    Callable class that encodes images generated by the model handler's process. A single
+    image is returned as the raw encoded bytes when the Accept header includes an image
+    media type. Otherwise, and whenever several images were requested, images are
+    returned base64 encoded in JSON. Images are encoded concurrently by a pool of threads,
+    as PIL releases the GIL while encoding, so encoding neither blocks the event loop nor
+    holds up the model processes, which generate the next images meanwhile.
     """
 
-    async def __call__(self, request: ImageGenerateRequest) -> ImageGenerateResponse:
-        return await super().__call__(request)
+    def __init__(
+        self,
+        worker_pool: WorkerPool | ModelPool,
+        request_future_map: dict[UUID, Future | asyncio.Queue[BaseModel | Exception]],
+        timeout: float | None = None,
+        metrics: Metrics | None = None,
+        response_cache: ResponseCache | None = None,
+        tracer: Tracer | None = None,
+        encode_workers: int | None = None,
+    ) -> None:
+        """
+        :param encode_workers: Number of threads that encode images. Defaults to the
+        number of CPUs.
+        """
+        super().__init__(worker_pool, request_future_map, timeout, metrics, response_cache, tracer)
+        self._encoder = ThreadPoolExecutor(
+            max_workers=encode_workers or os.cpu_count(), thread_name_prefix="image-encoder"
+        )
+
+    async def __call__(  # type: ignore[override]
+        self, request: ImageGenerateRequest, http_request: Request
+    ) -> ImageGenerateResponse:
+        request_id = uuid4()
+        with self._traced(request_id):
+            shared_images: list[SharedImage] = await self._handle(request_id, request, http_request)
+            return await self._encode(request_id, request, http_request, shared_images)
+
+    async def _encode(
+        self,
+        request_id: UUID,
+        request: ImageGenerateRequest,
+        http_request: Request,
+        shared_images: list[SharedImage],
+    ) -> ImageGenerateResponse:
+        image_format = None
+        if len(shared_images) == 1:
+            image_format = self._accepted_format(http_request, request.format)
+        loop = asyncio.get_running_loop()
+        encode_start = time.monotonic()
+        images = await asyncio.gather(
+            *(
+                loop.run_in_executor(
+                    self._encoder,
+                    functools.partial(
+                        shared_image.encode,
+                        image_format or request.format,
+                        quality=request.quality,
+                        compress_level=request.compress_level,
+                    ),
+                )
+                for shared_image in shared_images
+            )
+        )
+        encode_end = time.monotonic()
+        if self._metrics is not None:
+            self._metrics.image_encode.observe(encode_end - encode_start)
+        if self._tracer is not None:
+            self._tracer.span(
+                request_id,
+                "image encode",
+                encode_start,
+                encode_end,
+                attributes={"images": len(images)},
+            )
+        if image_format is not None:
+            return Response(content=images[0], media_type=MEDIA_TYPES[image_format])  # type: ignore
+        encoded = [base64.b64encode(image).decode() for image in images]
+        return ImageGenerateResponse(
+            image=encoded[0], format=request.format, images=encoded if len(encoded) > 1 else None
+        )
+
+    @staticmethod
+    def _accepted_format(
+        http_request: Request, requested_format: ImageFormat
+    ) -> ImageFormat | None:
+        """
+        Image format to return as raw bytes based on the Accept header. The requested
+        format is preferred when it is acceptable.
+        :return: Format to return or None if the image should be returned as JSON
+        """
+        media_types = {
+            media_type.split(";")[0].strip()
+            for media_type in http_request.headers.get("accept", "").split(",")
+        }
+        if MEDIA_TYPES[requested_format] in media_types or "image/*" in media_types:
+            return requested_format
+        for image_format, media_type in MEDIA_TYPES.items():
+            if media_type in media_types:
+                return image_format
+        return None
 
 
 class TextTransformRequestHandler(RequestHandler):
@@ -63,5 +289,74 @@ class TextTransformRequestHandler(RequestHandler):
     Just acts as a passthrough.
     """
 
-    async def __call__(self, request: TextTransformRequest) -> TextTransformResponse:
-        return await super().__call__(request)
+    async def __call__(
+        self, request: TextTransformRequest, http_request: Request
+    ) -> TextTransformResponse:
+        return await super().__call__(request, http_request)
+
+
+class TextTransformStreamRequestHandler(RequestHandler):
+    """
+    Callable class that streams text transform results as newline delimited JSON. Each
+    line contains the text generated since the previous line. The final line contains
+    the complete generated text, or an error if generation failed or timed out.
+    Generation is cancelled if the client disconnects or the request times out.
+    """
+
+    async def __call__(  # type: ignore[override]
+        self, request: TextTransformStreamRequest
+    ) -> StreamingResponse:
+        stream: asyncio.Queue[BaseModel | Exception] = asyncio.Queue()
+        request_id = uuid4()
+        start = time.monotonic()
+        self._submit(request_id, request)
+        self._request_future_map[request_id] = stream
+        return StreamingResponse(
+            self._stream(request_id, stream, start),
+            media_type="application/x-ndjson",
+            # Closes streams whose client disconnected before the body was first iterated
+            background=BackgroundTask(self._close_stream, request_id, start),
+        )
+
+    async def _stream(
+        self, request_id: UUID, stream: asyncio.Queue[BaseModel | Exception], start: float
+    ) -> AsyncIterator[str]:
+        finished = False
+        result = None
+        deadline = None if self._timeout is None else time.monotonic() + self._timeout
+        try:
+            while not finished:
+                try:
+                    response = await asyncio.wait_for(
+                        stream.get(), None if deadline is None else deadline - time.monotonic()
+                    )
+                except asyncio.TimeoutError:
+                    result = "timeout"
+                    yield json.dumps({"error": "Timed out waiting for the model"}) + "\n"
+                    break
+                if isinstance(response, Exception):
+                    finished = True
+                    result = "error"
+                    yield json.dumps({"error": str(response)}) + "\n"
+                else:
+                    finished = isinstance(response, TextTransformResponse)
+                    if finished:
+                        result = "success"
+                    yield response.json(exclude_none=True) + "\n"
+        finally:
+            self._close_stream(request_id, start, result, finished)
+
+    def _close_stream(
+        self, request_id: UUID, start: float, result: str | None = None, finished: bool = False
+    ) -> None:
+        """
+        Remove a stream from the request future map, cancelling its request unless it
+        finished. Only the first call for a stream has any effect.
+        :param result: Result to count, which is a disconnect if the stream ended early
+        """
+        if self._request_future_map.pop(request_id, None) is None:
+            return
+        self._count(result or "disconnected")
+        if not finished:
+            self._worker_pool.cancel(request_id)
+        self._trace_request(request_id, start)
@@ -0,0 +1,74 @@
+"""Stopping generation at stop strings and per sequence token limits"""
+from transformers import StoppingCriteria
+
+
+def find_stop(text: str, stop: list[str] | None, start: int = 0) -> int | None:
+    """
+    Find the earliest stop string in a text
+    :param text: Text to search
+    :param stop: Stop strings to search for
+    :param start: Index of the text from which to search
+    :return: Index at which the earliest stop string begins or None if there is none
+    """
+    indices = [index for index in (text.find(string, start) for string in stop or []) if index >= 0]
+    return min(indices) if indices else None
+
+
+def stop_window(stop: list[str] | None) -> int:
+    """
+    Number of trailing tokens to decode to find a stop string ending at the latest
+    token, assuming every token decodes to at least one character
+    """
+    return max((len(string) for string in stop or []), default=0)
+
+
+class StopStringCriteria(StoppingCriteria):
+    """
+    Stops generating a batch once every sequence has generated one of its stop strings,
+    its end of sequence token, or its maximum number of new tokens. Sequences which
+    finish early keep generating with the rest of the batch, so their results must
+    still be cut at the stop string and token limit. Each call checks every token added
+    since the last, as assisted generation may add several tokens at a time.
+    """
+
+    def __init__(
+        self,
+        tokenizer,
+        prompt_length: int,
+        stops: list[list[str] | None],
+        max_new_tokens: list[int],
+        eos_token_ids: list[int],
+    ) -> None:
+        """
+        :param tokenizer: Tokenizer with which to decode generated tokens
+        :param prompt_length: Length of the padded prompts preceding the generated tokens
+        :param stops: Stop strings of each sequence in the batch
+        :param max_new_tokens: Maximum number of new tokens of each sequence in the batch
+        :param eos_token_ids: Tokens which end a sequence
+        """
+        self._tokenizer = tokenizer
+        self._prompt_length = prompt_length
+        self._stops = stops
+        self._max_new_tokens = max_new_tokens
+        self._eos_token_ids = set(eos_token_ids)
+        self._finished = [False] * len(stops)
+        # Number of generated tokens of each sequence already checked
+        self._checked = [0] * len(stops)
+
+    def __call__(self, input_ids, scores, **kwargs) -> bool:
+        generated = input_ids[:, self._prompt_length :]
+        for row, stop in enumerate(self._stops):
+            if self._finished[row]:
+                continue
+            token_ids = generated[row]
+            checked, self._checked[row] = self._checked[row], len(token_ids)
+            if len(token_ids) >= self._max_new_tokens[row] or any(
+                int(token_id) in self._eos_token_ids for token_id in token_ids[checked:]
+            ):
+                self._finished[row] = True
+            elif stop:
+                # A stop string ending at the first new token may begin in earlier tokens
+                start = max(checked - stop_window(stop) + 1, 0)
+                tail = self._tokenizer.decode(token_ids[start:], skip_special_tokens=True)
+                self._finished[row] = find_stop(tail, stop) is not None
+        return all(self._finished)
@@ -0,0 +1,238 @@
+"""Per-request traces of the API and model processes exported to a file"""
+import hashlib
+import json
+import os
+import queue
+import threading
+import time
+from pathlib import Path
+from typing import Any, TextIO
+from uuid import UUID
+
+from wrangler.metrics import Timings
+
+TRACE_FORMATS = ("chrome", "otlp")
+
+API_PROCESS = "API"
+
+
+def _span_id(request_id: UUID, name: str) -> str:
+    """Span ID derived from the request and span name, so children can name their parent"""
+    return hashlib.blake2b(request_id.bytes + name.encode(), digest_size=8).hexdigest()
+
+
+class Tracer:
+    """
+    Records spans of each request and appends them to a trace file as they complete,
+    so a trace can be read while the server runs. Chrome traces are a JSON array of
+    trace events, which the Chrome trace viewer and Perfetto read even before the
+    closing bracket is written. OTLP traces are JSON lines, each an OTLP trace export
+    request, as written by the OpenTelemetry collector's file exporter. Times are
+    time.monotonic values, which are shared by the API and model processes. Spans are
+    written by a background thread, so recording one never waits on the file.
+    """
+
+    def __init__(self, path: Path, format_: str = "chrome") -> None:
+        """
+        :param path: File to write the trace to. It is replaced.
+        :param format_: chrome or otlp
+        """
+        if format_ not in TRACE_FORMATS:
+            raise ValueError(f"Trace format must be one of {', '.join(TRACE_FORMATS)}")
+        self._format = format_
+        self._file: TextIO = path.open("w")
+        self._wall_offset_ns = time.time_ns() - time.monotonic_ns()
+        self._processes: dict[str, int] = {}
+        self._events_written = 0
+        if format_ == "chrome":
+            self._file.write("[")
+        self._closed = False
+        # Arguments of each span to write, followed by None once closed
+        self._spans: queue.Queue[tuple | None] = queue.Queue()
+        self._writer = threading.Thread(target=self._write, name="Trace Writer", daemon=True)
+        self._writer.start()
+
+    def span(
+        self,
+        request_id: UUID,
+        name: str,
+        start: float,
+        end: float,
+        process: str = API_PROCESS,
+        parent: str | None = "request",
+        attributes: dict[str, Any] | None = None,
+    ) -> None:
+        """
+        Record a span of a request
+        :param request_id: Request the span belongs to, which identifies the trace
+        :param name: Name of the span, unique within the request
+        :param start: time.monotonic value when the span started
+        :param end: time.monotonic value when the span ended
+        :param process: Process the span ran in
+        :param parent: Name of the parent span or None for the root span
+        :param attributes: Additional attributes of the span
+        """
+        if self._closed:
+            return
+        attributes = {"request_id": str(request_id), **(attributes or {})}
+        self._spans.put((request_id, name, start, end, process, parent, attributes))
+
+    def model_spans(
+        self,
+        request_id: UUID,
+        process: str,
+        submitted: float,
+        timings: Timings,
+        received: float,
+    ) -> None:
+        """
+        Record the spans of a request's trip through a model process. The model process
+        reports the total time of each phase, so tokenize, generate and decode are laid
+        out one after another from when it began processing the request.
+        :param request_id: Request the spans belong to
+        :param process: Model process that handled the request
+        :param submitted: time.monotonic value when the request was sent to the process
+        :param timings: Timings the model process reported with the response
+        :param received: time.monotonic value when the response was read from the process
+        """
+        sent = timings.sent or timings.started
+        self.span(request_id, "queue", submitted, timings.started, API_PROCESS)
+        self.span(
+            request_id,
+            "model",
+            timings.started,
+            sent,
+            process,
+            attributes={"batch_size": timings.batch_size, "tokens": timings.tokens},
+        )
+        start = timings.started
+        for name, duration in (
+            ("tokenize", timings.tokenize),
+            ("generate", timings.model),
+            ("decode", timings.decode),
+        ):
+            if duration:
+                self.span(request_id, name, start, start + duration, process, parent="model")
+                start += duration
+        self.span(request_id, "response hop", sent, received, API_PROCESS)
+        self.span(request_id, "event loop", received, time.monotonic(), API_PROCESS)
+
+    def flush(self) -> None:
+        """Wait until every span recorded so far has been written to the trace file"""
+        self._spans.join()
+
+    def close(self) -> None:
+        """Write the remaining spans, then finish and close the trace file"""
+        if self._closed:
+            return
+        self._closed = True
+        self._spans.put(None)
+        self._writer.join()
+
+    def _write(self) -> None:
+        """Writes spans as they are recorded, flushing the file once none are waiting"""
+        while True:
+            span = self._spans.get()
+            if span is None:
+                if self._format == "chrome":
+                    self._file.write("\n]\n")
+                self._file.close()
+                self._spans.task_done()
+                return
+            request_id, name, start, end, process, parent, attributes = span
+            if self._format == "chrome":
+                self._write_chrome(request_id, name, start, end, process, attributes)
+            else:
+                self._write_otlp(request_id, name, start, end, process, parent, attributes)
+            if self._spans.qsize() == 0:
+                self._file.flush()
+            self._spans.task_done()
+
+    def _process_id(self, process: str) -> int:
+        if process not in self._processes:
+            self._processes[process] = len(self._processes)
+            if self._format == "chrome":
+                self._write_event(
+                    {
+                        "name": "process_name",
+                        "ph": "M",
+                        "pid": self._processes[process],
+                        "args": {"name": process},
+                    }
+                )
+        return self._processes[process]
+
+    def _write_event(self, event: dict[str, Any]) -> None:
+        separator = "\n" if not self._events_written else ",\n"
+        self._file.write(separator + json.dumps(event, separators=(",", ":")))
+        self._events_written += 1
+
+    def _write_chrome(
+        self,
+        request_id: UUID,
+        name: str,
+        start: float,
+        end: float,
+        process: str,
+        attributes: dict[str, Any],
+    ) -> None:
+        # Async events nest by time within the request, keeping concurrent requests apart
+        event = {
+            "name": name,
+            "cat": "request",
+            "id": request_id.hex,
+            "pid": self._process_id(process),
+            "tid": 0,
+        }
+        self._write_event({**event, "ph": "b", "ts": start * 1e6, "args": attributes})
+        self._write_event({**event, "ph": "e", "ts": max(start, end) * 1e6})
+
+    def _write_otlp(
+        self,
+        request_id: UUID,
+        name: str,
+        start: float,
+        end: float,
+        process: str,
+        parent: str | None,
+        attributes: dict[str, Any],
+    ) -> None:
+        span = {
+            "traceId": request_id.hex,
+            "spanId": _span_id(request_id, name),
+            "name": name,
+            "kind": 1,
+            "startTimeUnixNano": str(int(start * 1e9) + self._wall_offset_ns),
+            "endTimeUnixNano": str(int(max(start, end) * 1e9) + self._wall_offset_ns),
+            "attributes": [
+                {"key": key, "value": _otlp_value(value)} for key, value in attributes.items()
+            ],
+        }
+        if parent is not None:
+            span["parentSpanId"] = _span_id(request_id, parent)
+        resource = {
+            "attributes": [
+                {"key": "service.name", "value": {"stringValue": "wrangler"}},
+                {"key": "process.label", "value": {"stringValue": process}},
+                {"key": "process.pid", "value": {"intValue": str(os.getpid())}},
+            ]
+        }
+        request = {
+            "resourceSpans": [
+                {
+                    "resource": resource,
+                    "scopeSpans": [{"scope": {"name": "wrangler"}, "spans": [span]}],
+                }
+            ]
+        }
+        self._file.write(json.dumps(request, separators=(",", ":")) + "\n")
+
+
+def _otlp_value(value: Any) -> dict[str, Any]:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
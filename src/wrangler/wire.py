@@ -0,0 +1,278 @@
+"""
+Compact binary framing of the requests and responses exchanged with model processes
+
+Every frame starts with a one byte message type and the 16 byte request ID, followed by
+a payload whose layout depends on the type. Text is sent as raw UTF-8 and timings as
+packed doubles and integers, so tokens and results cross the process boundary without
+pickling and are only built into pydantic models by the API process. Exceptions, which
+are rare, are pickled.
+"""
+import json
+import math
+import multiprocessing as mp
+import pickle
+import struct
+import threading
+import time
+from enum import Enum, IntEnum
+from typing import Any
+from uuid import UUID
+
+from pydantic import BaseModel
+
+from wrangler.images import SharedImage
+from wrangler.metrics import Timings
+from wrangler.model_handlers import ModelReady
+from wrangler.models import (
+    ImageFormat,
+    ImageGenerateRequest,
+    TextTransformRequest,
+    TextTransformResponse,
+    TextTransformStreamRequest,
+    TextTransformToken,
+)
+
+_HEADER = struct.Struct("<B16s")
+_DEADLINE = struct.Struct("<dB")
+_TIMINGS = struct.Struct("<4d2qd3q")
+_COUNT = struct.Struct("<I")
+_IMAGE = struct.Struct("<2I")
+
+_NO_REQUEST_ID = bytes(16)
+
+# Request types by their code on the wire
+_REQUEST_TYPES: list[type[BaseModel]] = [
+    TextTransformRequest,
+    TextTransformStreamRequest,
+    ImageGenerateRequest,
+]
+
+
+class _MessageType(IntEnum):
+    REQUEST = 1
+    TOKEN = 2
+    TEXT = 3
+    IMAGES = 4
+    READY = 5
+    PICKLED = 6
+
+
+def encode_request(request_id: UUID, request: BaseModel, deadline: float | None) -> bytes:
+    """
+    Frame a request for a model process
+    :param request_id: ID with which the response will be returned
+    :param request: Validated request
+    :param deadline: time.monotonic value after which the request is dropped or None
+    """
+    return b"".join(
+        (
+            _HEADER.pack(_MessageType.REQUEST, request_id.bytes),
+            _DEADLINE.pack(
+                math.nan if deadline is None else deadline, _REQUEST_TYPES.index(type(request))
+            ),
+            json.dumps(request.dict(exclude_defaults=True), separators=(",", ":")).encode(),
+        )
+    )
+
+
+def decode_request(frame: bytes) -> tuple[UUID, BaseModel, float | None]:
+    """
+    Request ID, request and deadline of a request frame. The request was validated by
+    the API process so it is rebuilt without validating it again.
+    """
+    _, request_id = _HEADER.unpack_from(frame)
+    deadline, request_type = _DEADLINE.unpack_from(frame, _HEADER.size)
+    request_class = _REQUEST_TYPES[request_type]
+    fields = json.loads(frame[_HEADER.size + _DEADLINE.size :])
+    for name, value in fields.items():
+        field_type = request_class.__fields__[name].type_
+        if isinstance(field_type, type) and issubclass(field_type, Enum):
+            fields[name] = field_type(value)
+    request = request_class.construct(**fields)
+    return UUID(bytes=request_id), request, None if math.isnan(deadline) else deadline
+
+
+def encode_response(request_id: UUID | None, response: Any, timings: Timings | None) -> bytes:
+    """
+    Frame a response from a model process
+    :param request_id: ID of the request or None for messages about the model itself
+    :param response: Streamed token, text transform response, shared images, ModelReady,
+    or exception
+    :param timings: Timings measured for the request or None
+    """
+    header_id = _NO_REQUEST_ID if request_id is None else request_id.bytes
+    if isinstance(response, TextTransformToken):
+        return _HEADER.pack(_MessageType.TOKEN, header_id) + response.text.encode()
+    if isinstance(response, ModelReady):
+        return _HEADER.pack(_MessageType.READY, header_id)
+    if timings is not None and isinstance(response, TextTransformResponse):
+        texts = response.generated_texts or [response.generated_text]
+        return b"".join(
+            (
+                _HEADER.pack(_MessageType.TEXT, header_id),
+                _pack_timings(timings),
+                _COUNT.pack(len(texts)),
+                *(_pack_text(text) for text in texts),
+            )
+        )
+    if (
+        timings is not None
+        and isinstance(response, list)
+        and all(isinstance(image, SharedImage) for image in response)
+    ):
+        return b"".join(
+            (
+                _HEADER.pack(_MessageType.IMAGES, header_id),
+                _pack_timings(timings),
+                _COUNT.pack(len(response)),
+                *(_pack_image(image) for image in response),
+            )
+        )
+    return _HEADER.pack(_MessageType.PICKLED, header_id) + pickle.dumps((response, timings))
+
+
+def decode_response(frame: bytes) -> tuple[UUID | None, Any, Timings | None]:
+    """Request ID, response and timings of a response frame"""
+    message_type, header_id = _HEADER.unpack_from(frame)
+    request_id = None if header_id == _NO_REQUEST_ID else UUID(bytes=header_id)
+    offset = _HEADER.size
+    if message_type == _MessageType.TOKEN:
+        return request_id, TextTransformToken.construct(text=frame[offset:].decode()), None
+    if message_type == _MessageType.READY:
+        return request_id, ModelReady(), None
+    if message_type == _MessageType.PICKLED:
+        response, timings = pickle.loads(frame[offset:])
+        return request_id, response, timings
+    timings = Timings(*_TIMINGS.unpack_from(frame, offset))
+    offset += _TIMINGS.size
+    (count,) = _COUNT.unpack_from(frame, offset)
+    offset += _COUNT.size
+    if message_type == _MessageType.TEXT:
+        texts = []
+        for _ in range(count):
+            text, offset = _unpack_text(frame, offset)
+            texts.append(text)
+        response = TextTransformResponse.construct(
+            generated_text=texts[0], generated_texts=texts if count > 1 else None
+        )
+        return request_id, response, timings
+    images = []
+    for _ in range(count):
+        width, height = _IMAGE.unpack_from(frame, offset)
+        offset += _IMAGE.size
+        name, offset = _unpack_text(frame, offset)
+        mode, offset = _unpack_text(frame, offset)
+        image_format, offset = _unpack_text(frame, offset)
+        images.append(SharedImage(name, mode, (width, height), ImageFormat(image_format)))
+    return request_id, images, timings
+
+
+def _pack_timings(timings: Timings) -> bytes:
+    return _TIMINGS.pack(
+        timings.started,
+        timings.model,
+        timings.tokenize,
+        timings.decode,
+        timings.tokens,
+        timings.batch_size,
+        timings.sent,
+        timings.draft_tokens,
+        timings.accepted_tokens,
+        timings.model_passes,
+    )
+
+
+def _pack_text(text: str) -> bytes:
+    encoded = text.encode()
+    return _COUNT.pack(len(encoded)) + encoded
+
+
+def _unpack_text(frame: bytes, offset: int) -> tuple[str, int]:
+    (length,) = _COUNT.unpack_from(frame, offset)
+    offset += _COUNT.size
+    return frame[offset : offset + length].decode(), offset + length
+
+
+def _pack_image(image: SharedImage) -> bytes:
+    return b"".join(
+        (
+            _IMAGE.pack(*image.size),
+            _pack_text(image.name),
+            _pack_text(image.mode),
+            _pack_text(image.format.value),
+        )
+    )
+
+
+class RequestChannel:
+    """
+    Sends request frames to a model process. Frames are buffered by a multiprocessing
+    queue's feeder thread so the event loop never blocks on a full pipe while the model
+    process is busy.
+    """
+
+    def __init__(self) -> None:
+        self._queue: mp.Queue = mp.Queue()
+
+    def put(self, item: tuple[UUID, BaseModel, float | None]) -> None:
+        """
+        Send a request
+        :param item: Request ID, request and deadline
+        """
+        self._queue.put(encode_request(*item))
+
+    def get(self, block: bool = True, timeout: float | None = None):
+        """
+        Receive the next request
+        :raises queue.Empty: No request arrived before the timeout
+        """
+        return decode_request(self._queue.get(block, timeout))
+
+
+class ResponseChannel:
+    """
+    Sends response frames from a model process over a pipe read by a thread of the API
+    process. The API process closes its end for writing once the model process has
+    started, so reading raises EOFError once the model process exits.
+    """
+
+    def __init__(self) -> None:
+        self._reader, self._writer = mp.Pipe(duplex=False)
+        self._lock = threading.Lock()
+
+    def __getstate__(self) -> dict:
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def put(self, item: tuple[UUID | None, Any, Timings | None]) -> None:
+        """
+        Send a response
+        :param item: Request ID, response and timings, whose sent time is set
+        """
+        if item[2] is not None:
+            item[2].sent = time.monotonic()
+        frame = encode_response(*item)
+        # Threads of a model process must not interleave frames
+        with self._lock:
+            self._writer.send_bytes(frame)
+
+    def get(self) -> tuple[UUID | None, Any, Timings | None]:
+        """
+        Receive the next response
+        :raises EOFError: The model process has exited
+        """
+        return decode_response(self._reader.recv_bytes())
+
+    def close_writer(self) -> None:
+        """Close this process's end for writing once the model process holds its own"""
+        self._writer.close()
+
+    def close(self) -> None:
+        """Close both ends of the pipe"""
+        self._reader.close()
+        self._writer.close()
@@ -0,0 +1,431 @@
+"""Model worker process pool"""
+import asyncio
+import multiprocessing as mp
+import os
+import signal
+import threading
+import time
+from multiprocessing import resource_tracker
+from pathlib import Path
+from typing import Callable
+from uuid import UUID
+
+import click
+import torch
+from pydantic import BaseModel
+
+from wrangler.metrics import Metrics, Timings
+from wrangler.model_handlers import ModelHandler, ModelReady, ProfileRequests
+from wrangler.models import TextTransformToken
+from wrangler.tracing import Tracer
+from wrangler.wire import RequestChannel, ResponseChannel
+
+
+class WorkerExitedError(RuntimeError):
+    """The model worker process handling a request exited before responding"""
+
+
+class QueueFullError(RuntimeError):
+    """The worker pool already has the maximum number of outstanding requests"""
+
+
+class WorkerPoolFailedError(RuntimeError):
+    """Every worker of the pool repeatedly failed to start and is no longer restarted"""
+
+
+def _exit_with_parent(parent_pid: int, interval: float = 1.0) -> None:
+    """Exit the worker once the API process has exited, even if it was killed"""
+    while os.getppid() == parent_pid:
+        time.sleep(interval)
+    os._exit(1)
+
+
+def _run_worker(
+    model_handler: ModelHandler,
+    threads: int | None,
+    cpus: set[int] | None,
+    request_queue: RequestChannel,
+    response_queue: ResponseChannel,
+    control_queue: mp.Queue,
+    parent_pid: int,
+) -> None:
+    # Forked workers inherit the event loop's handlers, which ignore these signals
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    threading.Thread(target=_exit_with_parent, args=(parent_pid,), daemon=True).start()
+    if cpus:
+        os.sched_setaffinity(0, cpus)
+    if threads:
+        torch.set_num_threads(threads)
+    model_handler.start(request_queue, response_queue, control_queue)
+
+
+class _Worker:
+    """A model worker process and the state needed to communicate with it"""
+
+    def __init__(self, index: int, threads: int | None, cpus: set[int] | None) -> None:
+        self.index = index
+        self.threads = threads
+        self.cpus = cpus
+        self.request_ids: set[UUID] = set()
+        self.request_queue = RequestChannel()
+        self.response_queue = ResponseChannel()
+        self.control_queue: mp.Queue = mp.Queue()
+        self.process: mp.Process | None = None
+        self.responder: threading.Thread | None = None
+        self.ready = False
+        self.started = 0.0
+        # Consecutive exits soon after starting, which lengthen the restart delay
+        self.exits = 0
+        # Consecutive exits before the model loaded and warmed up
+        self.start_failures = 0
+        self.failed = False
+
+
+class WorkerPool:
+    """
+    Runs a model handler in one or more worker processes. Requests are dispatched to the
+    worker with the fewest outstanding requests. Each worker has its own channels, which
+    carry requests and responses in the compact wire format, and a thread that blocks on
+    the worker's response channel, handing responses to the event loop. Workers that
+    exit are restarted and their outstanding requests are failed with a
+    WorkerExitedError. A worker is ready once its model has loaded and warmed up.
+    Workers that keep exiting are restarted after exponentially longer delays, and a
+    worker that repeatedly exits before it is ready is no longer restarted. Once every
+    worker has failed, the pool rejects requests with a WorkerPoolFailedError.
+    """
+
+    def __init__(
+        self,
+        model_handler: ModelHandler,
+        on_response: Callable[[UUID, BaseModel | Exception], None],
+        workers: int = 1,
+        threads_per_worker: int | None = None,
+        pin_workers: bool = False,
+        restart_delay: float = 1.0,
+        max_queue_depth: int | None = None,
+        metrics: Metrics | None = None,
+        tracer: Tracer | None = None,
+        max_restart_delay: float = 60.0,
+        backoff_reset: float = 60.0,
+        max_start_failures: int = 5,
+    ) -> None:
+        """
+        :param model_handler: Handler to start in each worker process
+        :param on_response: Called on the event loop with each response from a worker
+        :param workers: Number of worker processes
+        :param threads_per_worker: Number of torch threads for each worker. Defaults to
+        the available CPUs divided by the number of workers when there are multiple
+        workers.
+        :param pin_workers: Pin each worker to its own set of CPUs
+        :param restart_delay: Seconds to wait before restarting a worker that exited. It
+        doubles with each consecutive exit of the worker.
+        :param max_queue_depth: Maximum number of outstanding requests. Additional
+        requests are rejected with a QueueFullError. Unlimited by default.
+        :param metrics: Metrics in which to record the timings workers report
+        :param tracer: Tracer in which to record each request's trip through the workers
+        :param max_restart_delay: Longest delay before restarting a worker
+        :param backoff_reset: Seconds a worker must run before its restart delay resets
+        :param max_start_failures: Consecutive exits of a worker before it is ready after
+        which it is no longer restarted
+        """
+        self._model_handler = model_handler
+        self._on_response = on_response
+        self._restart_delay = restart_delay
+        self._max_restart_delay = max_restart_delay
+        self._backoff_reset = backoff_reset
+        self._max_start_failures = max_start_failures
+        self._max_queue_depth = max_queue_depth
+        self._metrics = metrics
+        self._tracer = tracer
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._stopping = False
+        self._request_workers: dict[UUID, _Worker] = {}
+        self._submitted: dict[UUID, float] = {}
+        self._pending: list[tuple[UUID, BaseModel, float | None]] = []
+
+        available_cpus = sorted(os.sched_getaffinity(0))
+        if threads_per_worker is None and workers > 1:
+            threads_per_worker = max(1, len(available_cpus) // workers)
+        self._workers = []
+        for index in range(workers):
+            cpus = None
+            if pin_workers:
+                cpu_count = threads_per_worker or max(1, len(available_cpus) // workers)
+                start = index * cpu_count % len(available_cpus)
+                cpus = set(available_cpus[start : start + cpu_count])
+            self._workers.append(_Worker(index, threads_per_worker, cpus))
+
+    @property
+    def in_flight(self) -> int:
+        """Number of requests submitted to the pool that have not been responded to"""
+        return len(self._request_workers) + len(self._pending)
+
+    @property
+    def available(self) -> bool:
+        """Is at least one worker process running"""
+        return any(worker.process is not None for worker in self._workers)
+
+    @property
+    def failed(self) -> bool:
+        """Has every worker repeatedly failed to start, so that none will be restarted"""
+        return all(worker.failed for worker in self._workers)
+
+    @property
+    def ready(self) -> int:
+        """Number of worker processes which have loaded and warmed up their model"""
+        return sum(worker.ready for worker in self._workers)
+
+    def memory_usage(self) -> dict[str, float]:
+        """
+        Resident set size in bytes of each running worker process, keyed by worker
+        index. Empty on platforms without /proc.
+        """
+        usage = {}
+        for worker in self._workers:
+            if worker.process is None:
+                continue
+            try:
+                with open(f"/proc/{worker.process.pid}/statm") as statm:
+                    pages = int(statm.read().split()[1])
+            except (OSError, IndexError, ValueError):
+                continue
+            usage[str(worker.index)] = float(pages * os.sysconf("SC_PAGE_SIZE"))
+        return usage
+
+    @property
+    def restart_delay(self) -> float:
+        """Seconds to wait before restarting a worker that exited"""
+        return self._restart_delay
+
+    def start(self, loop: asyncio.AbstractEventLoop) -> None:
+        """
+        Start all worker processes
+        :param loop: Event loop on which responses and worker exits are handled
+        """
+        self._loop = loop
+        self._stopping = False
+        for worker in self._workers:
+            worker.exits = worker.start_failures = 0
+            worker.failed = False
+        # Workers share this process's tracker so shared memory they create and hand off
+        # is cleaned up when the server exits rather than when the worker does
+        resource_tracker.ensure_running()
+        for worker in self._workers:
+            self._start_worker(worker)
+
+    def stop(self) -> None:
+        """Stop all worker processes. The pool may be started again."""
+        self._join(self._terminate())
+
+    def stop_in_background(self) -> asyncio.Future:
+        """
+        Stop all worker processes, waiting for them to exit on the event loop's default
+        executor rather than on the event loop. Requests submitted in the meantime wait
+        until the pool is started again.
+        :return: Future which completes once every worker process has exited
+        """
+        stopped = self._terminate()
+        return self._loop.run_in_executor(None, self._join, stopped)  # type: ignore[union-attr]
+
+    def _terminate(self) -> list[tuple[mp.Process, threading.Thread]]:
+        """Signal every worker process to exit and detach it from the pool"""
+        self._stopping = True
+        stopped = []
+        for worker in self._workers:
+            if worker.process is None:
+                continue
+            self._loop.remove_reader(worker.process.sentinel)  # type: ignore[union-attr]
+            worker.process.terminate()
+            stopped.append((worker.process, worker.responder))
+            worker.process = None
+            worker.ready = False
+        return stopped  # type: ignore[return-value]
+
+    @staticmethod
+    def _join(stopped: list[tuple[mp.Process, threading.Thread]]) -> None:
+        for process, responder in stopped:
+            process.join()
+            # The responder exits once it has read every response the worker sent
+            responder.join()
+
+    def submit(self, request_id: UUID, request: BaseModel, deadline: float | None = None) -> None:
+        """
+        Send a request to the worker with the fewest outstanding requests
+        :param request_id: ID with which the response will be returned
+        :param request: Request for the model handler
+        :param deadline: time.monotonic value after which the worker will drop the
+        request rather than process it
+        :raises WorkerPoolFailedError: Every worker failed to start
+        :raises QueueFullError: The pool has the maximum number of outstanding requests
+        """
+        if self.failed:
+            raise WorkerPoolFailedError("The model processes repeatedly failed to start")
+        if self._max_queue_depth is not None and self.in_flight >= self._max_queue_depth:
+            raise QueueFullError(f"{self.in_flight} requests are already outstanding")
+        self._submitted[request_id] = time.monotonic()
+        self._dispatch(request_id, request, deadline)
+
+    def _dispatch(self, request_id: UUID, request: BaseModel, deadline: float | None) -> None:
+        workers = [worker_ for worker_ in self._workers if worker_.process is not None]
+        if not workers:
+            # Every worker is restarting; the request is sent once one is back up
+            self._pending.append((request_id, request, deadline))
+            return
+        worker = min(workers, key=lambda worker_: len(worker_.request_ids))
+        worker.request_ids.add(request_id)
+        self._request_workers[request_id] = worker
+        worker.request_queue.put((request_id, request, deadline))
+
+    def cancel(self, request_id: UUID) -> None:
+        """
+        Tell the worker handling a request that the response is no longer needed
+        :param request_id: ID of the request to cancel
+        """
+        self._pending = [item for item in self._pending if item[0] != request_id]
+        self._submitted.pop(request_id, None)
+        worker = self._request_workers.pop(request_id, None)
+        if worker is not None:
+            worker.request_ids.discard(request_id)
+            worker.control_queue.put(request_id)
+
+    def profile(self, requests: int, directory: Path) -> int:
+        """
+        Ask each running worker to profile its next requests with torch.profiler
+        :param requests: Number of requests each worker profiles
+        :param directory: Directory to which workers write their profiles
+        :return: Number of workers asked to profile
+        """
+        workers = [worker for worker in self._workers if worker.process is not None]
+        for worker in workers:
+            worker.control_queue.put(ProfileRequests(requests, directory))
+        return len(workers)
+
+    def _start_worker(self, worker: _Worker) -> None:
+        if self._stopping:
+            # A restart scheduled before the pool was stopped
+            return
+        worker.request_queue = RequestChannel()
+        worker.response_queue = ResponseChannel()
+        worker.control_queue = mp.Queue()
+        worker.process = mp.Process(
+            target=_run_worker,
+            args=(
+                self._model_handler,
+                worker.threads,
+                worker.cpus,
+                worker.request_queue,
+                worker.response_queue,
+                worker.control_queue,
+                os.getpid(),
+            ),
+            name=f"Model Request Processor {worker.index}",
+        )
+        worker.process.start()
+        worker.started = time.monotonic()
+        worker.response_queue.close_writer()
+        worker.responder = threading.Thread(
+            target=self._respond,
+            args=(worker, worker.response_queue),
+            name=f"Model Response Processor {worker.index}",
+            daemon=True,
+        )
+        worker.responder.start()
+        self._loop.add_reader(  # type: ignore[union-attr]
+            worker.process.sentinel, self._handle_exit, worker
+        )
+        pending, self._pending = self._pending, []
+        for request_id, request, deadline in pending:
+            self._dispatch(request_id, request, deadline)
+
+    def _respond(self, worker: _Worker, response_queue: ResponseChannel) -> None:
+        """Blocks on a worker's response channel until the worker exits"""
+        while True:
+            try:
+                request_id, response, timings = response_queue.get()
+            except EOFError:
+                break
+            received = time.monotonic()
+            if isinstance(response, ModelReady):
+                self._loop.call_soon_threadsafe(  # type: ignore[union-attr]
+                    self._handle_ready, worker
+                )
+                continue
+            self._loop.call_soon_threadsafe(  # type: ignore[union-attr]
+                self._handle_response, worker, request_id, response, timings, received
+            )
+
+    @staticmethod
+    def _handle_ready(worker: _Worker) -> None:
+        # A worker which has since exited reports ready again once restarted
+        if worker.process is not None:
+            worker.ready = True
+            worker.start_failures = 0
+
+    def _handle_response(
+        self,
+        worker: _Worker,
+        request_id: UUID,
+        response: BaseModel | Exception,
+        timings: Timings | None,
+        received: float,
+    ) -> None:
+        # Streamed tokens are followed by a final response for the same request
+        if not isinstance(response, TextTransformToken):
+            worker.request_ids.discard(request_id)
+            self._request_workers.pop(request_id, None)
+            submitted = self._submitted.pop(request_id, None)
+            if timings is not None and submitted is not None:
+                if self._metrics is not None:
+                    self._metrics.observe_timings(timings, submitted)
+                if self._tracer is not None:
+                    self._tracer.model_spans(
+                        request_id, f"Model worker {worker.index}", submitted, timings, received
+                    )
+        self._on_response(request_id, response)
+
+    def _handle_exit(self, worker: _Worker) -> None:
+        process, worker.process = worker.process, None
+        ready, worker.ready = worker.ready, False
+        self._loop.remove_reader(process.sentinel)  # type: ignore[union-attr]
+        process.join()  # type: ignore[union-attr]
+        if self._stopping:
+            return
+        request_ids, worker.request_ids = worker.request_ids, set()
+        for request_id in request_ids:
+            del self._request_workers[request_id]
+            self._submitted.pop(request_id, None)
+            self._on_response(
+                request_id,
+                WorkerExitedError(
+                    f"Model worker {worker.index} exited with code "
+                    f"{process.exitcode}"  # type: ignore[union-attr]
+                ),
+            )
+        if not ready:
+            worker.start_failures += 1
+            if worker.start_failures >= self._max_start_failures:
+                self._fail(worker)
+                return
+        if time.monotonic() - worker.started >= self._backoff_reset:
+            worker.exits = 0
+        worker.exits += 1
+        delay = min(self._restart_delay * 2 ** (worker.exits - 1), self._max_restart_delay)
+        self._loop.call_later(delay, self._start_worker, worker)  # type: ignore[union-attr]
+
+    def _fail(self, worker: _Worker) -> None:
+        """Stop restarting a worker that keeps exiting before it is ready"""
+        worker.failed = True
+        click.echo(
+            f"Model worker {worker.index} exited {worker.start_failures} times before it was "
+            "ready and will not be restarted",
+            err=True,
+        )
+        if not self.failed:
+            return
+        pending, self._pending = self._pending, []
+        for request_id, _, _ in pending:
+            self._submitted.pop(request_id, None)
+            self._on_response(
+                request_id, WorkerPoolFailedError("The model processes repeatedly failed to start")
+            )
@@ -1,3 +1,6 @@
+import json
+import subprocess
+import sys
 import unittest
 from pathlib import Path
 from unittest.mock import patch, ANY
@@ -5,8 +8,10 @@ from unittest.mock import patch, ANY
 from click.testing import CliRunner
 from wrangler.__main__ import main
 from wrangler.model_handlers import TextTransformModelHandler, ImageGenerateModelHandler
+from wrangler.models import ImageFormat
 from wrangler.request_handlers import (
     TextTransformRequestHandler,
+    TextTransformStreamRequestHandler,
     ImageGenerateRequestHandler,
 )
 
@@ -14,15 +19,93 @@ from wrangler.request_handlers import (
 class CLITestCase(unittest.TestCase):
     def setUp(self) -> None:
         self._runner = CliRunner()
-        patcher = patch("wrangler.__main__.cli_serve")
+        patcher = patch("wrangler.cli.serve")
         self._serve_patch = patcher.start()
         self.addCleanup(patcher.stop)
-        patcher = patch("wrangler.__main__.cli_run")
+        patcher = patch("wrangler.cli.run")
         self._run_patch = patcher.start()
         self.addCleanup(patcher.stop)
-        patcher = patch("wrangler.__main__.cli_run_image")
+        patcher = patch("wrangler.cli.run_image_generate")
         self._run_image_patch = patcher.start()
         self.addCleanup(patcher.stop)
+        patcher = patch("wrangler.cli.run_image_generate_prompts")
+        self._run_image_prompts_patch = patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = patch("wrangler.cli.run_batch")
+        self._run_batch_patch = patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = patch("wrangler.cli.run_image_generate_batch")
+        self._run_image_batch_patch = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _bench_patch(self):
+        patcher = patch("wrangler.bench.bench", return_value={"requests": 10})
+        self.addCleanup(patcher.stop)
+        return patcher.start()
+
+    def test_main_bench_starts_a_server_with_the_serve_arguments(self):
+        bench_patch = self._bench_patch()
+        result = self._runner.invoke(
+            main,
+            [
+                "bench",
+                "--requests",
+                "10",
+                "--concurrency",
+                "4",
+                "--stream-fraction",
+                "0.5",
+                "text-transform",
+                "model",
+                "--max-batch-size",
+                "4",
+            ],
+        )
+        self.assertEqual(0, result.exit_code, result.output)
+        bench_patch.assert_called_once_with(
+            task="text-transform",
+            url=None,
+            serve_args=("model", "--max-batch-size", "4"),
+            requests=10,
+            concurrency=4,
+            bodies=None,
+            stream_fraction=0.5,
+            startup_timeout=600.0,
+        )
+        self.assertEqual({"requests": 10}, json.loads(result.output))
+
+    def test_main_bench_targets_a_url_with_requests_from_a_file(self):
+        bench_patch = self._bench_patch()
+        with self._runner.isolated_filesystem():
+            Path("requests.jsonl").write_text('{"input": "a"}\n\n{"input": "b", "seed": 1}\n')
+            result = self._runner.invoke(
+                main,
+                [
+                    "bench",
+                    "--url",
+                    "http://server:8000",
+                    "--requests-file",
+                    "requests.jsonl",
+                    "image-generate",
+                ],
+            )
+        self.assertEqual(0, result.exit_code, result.output)
+        self.assertEqual("http://server:8000", bench_patch.call_args.kwargs["url"])
+        self.assertEqual(
+            [{"input": "a"}, {"input": "b", "seed": 1}], bench_patch.call_args.kwargs["bodies"]
+        )
+
+    def test_main_bench_requires_either_serve_arguments_or_a_url(self):
+        bench_patch = self._bench_patch()
+        for arguments in (
+            ["text-transform"],
+            ["--url", "http://server:8000", "text-transform", "model"],
+            ["--stream-fraction", "0.5", "image-generate", "model"],
+        ):
+            with self.subTest(arguments=arguments):
+                result = self._runner.invoke(main, ["bench", *arguments])
+                self.assertEqual(2, result.exit_code, result.output)
+        bench_patch.assert_not_called()
 
     def test_main_is_group(self):
         result = self._runner.invoke(main)
@@ -48,10 +131,33 @@ class CLITestCase(unittest.TestCase):
             model_identifier=ANY,
             model_revision=ANY,
             model_offload_folder=None,
+            model_max_batch_size=1,
+            model_batch_timeout=0.0,
+            model_continuous_batching=False,
+            model_workers=1,
+            model_threads_per_worker=None,
+            model_pin_workers=False,
+            request_timeout=None,
+            max_queue_depth=None,
             request_handler_class=TextTransformRequestHandler,
+            stream_request_handler_class=TextTransformStreamRequestHandler,
             webserver_bind="127.0.0.1:8000",
             webserver_access_log="-",
             webserver_error_log="-",
+            response_cache_size=0,
+            response_cache_ttl=None,
+            model_prefix_cache_size=0,
+            model_fast_load_cache=None,
+            model_dtype="fp32",
+            model_quantize=None,
+            model_warm_up_inputs=(),
+            model_additional_identifiers=(),
+            model_max_memory=None,
+            trace_file=None,
+            trace_format="chrome",
+            profile_directory=None,
+            model_draft_identifier=None,
+            model_draft_revision=None,
         )
 
     def test_main_serve_text_transform_splits_model_identifier_and_revision(self):
@@ -63,10 +169,33 @@ class CLITestCase(unittest.TestCase):
             model_identifier="model",
             model_revision="revision",
             model_offload_folder=ANY,
+            model_max_batch_size=ANY,
+            model_batch_timeout=ANY,
+            model_continuous_batching=ANY,
+            model_workers=ANY,
+            model_threads_per_worker=ANY,
+            model_pin_workers=ANY,
+            request_timeout=ANY,
+            max_queue_depth=ANY,
             request_handler_class=ANY,
+            stream_request_handler_class=ANY,
             webserver_bind=ANY,
             webserver_access_log=ANY,
             webserver_error_log=ANY,
+            response_cache_size=ANY,
+            response_cache_ttl=ANY,
+            model_prefix_cache_size=ANY,
+            model_fast_load_cache=None,
+            model_dtype="fp32",
+            model_quantize=None,
+            model_warm_up_inputs=(),
+            model_additional_identifiers=(),
+            model_max_memory=None,
+            trace_file=None,
+            trace_format="chrome",
+            profile_directory=None,
+            model_draft_identifier=None,
+            model_draft_revision=None,
         )
 
     def test_main_serve_text_transform_defaults_model_revision_to_none(self):
@@ -78,10 +207,33 @@ class CLITestCase(unittest.TestCase):
             model_identifier="model",
             model_revision=None,
             model_offload_folder=ANY,
+            model_max_batch_size=ANY,
+            model_batch_timeout=ANY,
+            model_continuous_batching=ANY,
+            model_workers=ANY,
+            model_threads_per_worker=ANY,
+            model_pin_workers=ANY,
+            request_timeout=ANY,
+            max_queue_depth=ANY,
             request_handler_class=ANY,
+            stream_request_handler_class=ANY,
             webserver_bind=ANY,
             webserver_access_log=ANY,
             webserver_error_log=ANY,
+            response_cache_size=ANY,
+            response_cache_ttl=ANY,
+            model_prefix_cache_size=ANY,
+            model_fast_load_cache=None,
+            model_dtype="fp32",
+            model_quantize=None,
+            model_warm_up_inputs=(),
+            model_additional_identifiers=(),
+            model_max_memory=None,
+            trace_file=None,
+            trace_format="chrome",
+            profile_directory=None,
+            model_draft_identifier=None,
+            model_draft_revision=None,
         )
 
     def test_main_serve_text_transform_passes_options(self):
@@ -97,9 +249,39 @@ class CLITestCase(unittest.TestCase):
                 "access_log",
                 "--error-log",
                 "error_log",
+                "--workers",
+                "4",
+                "--threads-per-worker",
+                "2",
+                "--pin-workers",
+                "--request-timeout",
+                "30",
+                "--max-queue-depth",
+                "64",
+                "--warm-up-input",
+                "first",
+                "--warm-up-input",
+                "second",
+                "--trace-file",
+                "trace.jsonl",
+                "--trace-format",
+                "otlp",
+                "--profile-dir",
+                "profiles",
                 "text-transform",
                 "--model-offload-folder",
                 "model_offload_folder",
+                "--max-batch-size",
+                "8",
+                "--batch-timeout",
+                "2.5",
+                "--continuous-batching",
+                "--response-cache-size",
+                "1048576",
+                "--response-cache-ttl",
+                "60",
+                "--prefix-cache-size",
+                "2097152",
                 "model",
             ],
         )
@@ -110,11 +292,52 @@ class CLITestCase(unittest.TestCase):
             model_identifier=ANY,
             model_revision=ANY,
             model_offload_folder=Path("model_offload_folder"),
+            model_max_batch_size=8,
+            model_batch_timeout=2.5,
+            model_continuous_batching=True,
+            model_workers=4,
+            model_threads_per_worker=2,
+            model_pin_workers=True,
+            request_timeout=30.0,
+            max_queue_depth=64,
             request_handler_class=ANY,
+            stream_request_handler_class=ANY,
             webserver_bind="bind",
             webserver_access_log="access_log",
             webserver_error_log="error_log",
+            response_cache_size=1048576,
+            response_cache_ttl=60.0,
+            model_prefix_cache_size=2097152,
+            model_fast_load_cache=None,
+            model_dtype="fp32",
+            model_quantize=None,
+            model_warm_up_inputs=("first", "second"),
+            model_additional_identifiers=(),
+            model_max_memory=None,
+            trace_file=Path("trace.jsonl"),
+            trace_format="otlp",
+            profile_directory=Path("profiles"),
+            model_draft_identifier=None,
+            model_draft_revision=None,
+        )
+
+    def test_main_serve_text_transform_passes_draft_model(self):
+        result = self._runner.invoke(
+            main, ["serve", "text-transform", "--draft-model", "draft:revision", "model"]
         )
+        self.assertEqual(0, result.exit_code, result.output)
+        kwargs = self._serve_patch.call_args.kwargs
+        self.assertEqual("draft", kwargs["model_draft_identifier"])
+        self.assertEqual("revision", kwargs["model_draft_revision"])
+
+    def test_main_serve_text_transform_rejects_draft_model_with_continuous_batching(self):
+        result = self._runner.invoke(
+            main,
+            ["serve", "text-transform", "--draft-model", "draft", "--continuous-batching", "model"],
+        )
+        self.assertNotEqual(0, result.exit_code)
+        self.assertIn("--draft-model cannot be used with --continuous-batching", result.output)
+        self._serve_patch.assert_not_called()
 
     def test_main_serve_image_generate_is_command_requiring_arguments(self):
         result = self._runner.invoke(main, ["serve", "image-generate"])
@@ -130,10 +353,29 @@ class CLITestCase(unittest.TestCase):
             model_identifier=ANY,
             model_revision=ANY,
             model_offload_folder=None,
+            model_max_batch_size=1,
+            model_batch_timeout=0.0,
+            model_continuous_batching=False,
+            model_workers=1,
+            model_threads_per_worker=None,
+            model_pin_workers=False,
+            request_timeout=None,
+            max_queue_depth=None,
             request_handler_class=ImageGenerateRequestHandler,
+            stream_request_handler_class=None,
             webserver_bind="127.0.0.1:8000",
             webserver_access_log="-",
             webserver_error_log="-",
+            model_fast_load_cache=None,
+            model_dtype="fp32",
+            model_quantize=None,
+            model_warm_up_inputs=(),
+            model_additional_identifiers=(),
+            model_max_memory=None,
+            trace_file=None,
+            trace_format="chrome",
+            profile_directory=None,
+            image_encode_workers=None,
         )
 
     def test_main_serve_image_generate_splits_model_identifier_and_revision(self):
@@ -145,10 +387,29 @@ class CLITestCase(unittest.TestCase):
             model_identifier="model",
             model_revision="revision",
             model_offload_folder=None,
+            model_max_batch_size=ANY,
+            model_batch_timeout=ANY,
+            model_continuous_batching=ANY,
+            model_workers=ANY,
+            model_threads_per_worker=ANY,
+            model_pin_workers=ANY,
+            request_timeout=ANY,
+            max_queue_depth=ANY,
             request_handler_class=ANY,
+            stream_request_handler_class=ANY,
             webserver_bind=ANY,
             webserver_access_log=ANY,
             webserver_error_log=ANY,
+            model_fast_load_cache=None,
+            model_dtype="fp32",
+            model_quantize=None,
+            model_warm_up_inputs=(),
+            model_additional_identifiers=(),
+            model_max_memory=None,
+            trace_file=None,
+            trace_format="chrome",
+            profile_directory=None,
+            image_encode_workers=None,
         )
 
     def test_main_serve_image_generate_defaults_model_revision_to_none(self):
@@ -160,10 +421,29 @@ class CLITestCase(unittest.TestCase):
             model_identifier="model",
             model_revision=None,
             model_offload_folder=ANY,
+            model_max_batch_size=ANY,
+            model_batch_timeout=ANY,
+            model_continuous_batching=ANY,
+            model_workers=ANY,
+            model_threads_per_worker=ANY,
+            model_pin_workers=ANY,
+            request_timeout=ANY,
+            max_queue_depth=ANY,
             request_handler_class=ANY,
+            stream_request_handler_class=ANY,
             webserver_bind=ANY,
             webserver_access_log=ANY,
             webserver_error_log=ANY,
+            model_fast_load_cache=None,
+            model_dtype="fp32",
+            model_quantize=None,
+            model_warm_up_inputs=(),
+            model_additional_identifiers=(),
+            model_max_memory=None,
+            trace_file=None,
+            trace_format="chrome",
+            profile_directory=None,
+            image_encode_workers=None,
         )
 
     def test_main_serve_image_generate_passes_options(self):
@@ -179,8 +459,27 @@ class CLITestCase(unittest.TestCase):
                 "access_log",
                 "--error-log",
                 "error_log",
+                "--workers",
+                "4",
+                "--threads-per-worker",
+                "2",
+                "--pin-workers",
+                "--request-timeout",
+                "30",
+                "--max-queue-depth",
+                "64",
+                "--warm-up-input",
+                "first",
+                "--warm-up-input",
+                "second",
                 "image-generate",
                 "model",
+                "--max-batch-size",
+                "4",
+                "--batch-timeout",
+                "50",
+                "--encode-workers",
+                "2",
             ],
         )
         self.assertEqual(0, result.exit_code, result.output)
@@ -190,10 +489,29 @@ class CLITestCase(unittest.TestCase):
             model_identifier=ANY,
             model_revision=ANY,
             model_offload_folder=ANY,
+            model_max_batch_size=4,
+            model_batch_timeout=50.0,
+            model_continuous_batching=ANY,
+            model_workers=4,
+            model_threads_per_worker=2,
+            model_pin_workers=True,
+            request_timeout=30.0,
+            max_queue_depth=64,
             request_handler_class=ANY,
+            stream_request_handler_class=ANY,
             webserver_bind="bind",
             webserver_access_log="access_log",
             webserver_error_log="error_log",
+            model_fast_load_cache=None,
+            model_dtype="fp32",
+            model_quantize=None,
+            model_warm_up_inputs=("first", "second"),
+            model_additional_identifiers=(),
+            model_max_memory=None,
+            trace_file=None,
+            trace_format="chrome",
+            profile_directory=None,
+            image_encode_workers=2,
         )
 
     def test_main_run_is_group(self):
@@ -218,6 +536,11 @@ class CLITestCase(unittest.TestCase):
             model_revision=ANY,
             model_offload_folder=None,
             input_text=ANY,
+            model_fast_load_cache=None,
+            model_dtype="fp32",
+            model_quantize=None,
+            model_draft_identifier=None,
+            model_draft_revision=None,
         )
 
     def test_main_run_text_transform_passes_options_and_arguments(self):
@@ -228,6 +551,8 @@ class CLITestCase(unittest.TestCase):
                 "text-transform",
                 "--model-offload-folder",
                 "model_offload_folder",
+                "--draft-model",
+                "draft:draft_revision",
                 "model:revision",
                 "input",
             ],
@@ -239,6 +564,11 @@ class CLITestCase(unittest.TestCase):
             model_revision="revision",
             model_offload_folder=Path("model_offload_folder"),
             input_text="input",
+            model_fast_load_cache=None,
+            model_dtype="fp32",
+            model_quantize=None,
+            model_draft_identifier="draft",
+            model_draft_revision="draft_revision",
         )
 
     def test_main_run_image_generate_is_command_requiring_arguments(self):
@@ -258,6 +588,9 @@ class CLITestCase(unittest.TestCase):
             model_revision=ANY,
             output_file=ANY,
             input_text=ANY,
+            model_fast_load_cache=None,
+            model_dtype="fp32",
+            model_quantize=None,
         )
 
     def test_main_run_image_generate_passes_options_and_arguments(self):
@@ -283,8 +616,247 @@ class CLITestCase(unittest.TestCase):
             model_revision="revision",
             output_file=Path("destination_file"),
             input_text="lot's of input to see here",
+            model_fast_load_cache=None,
+            model_dtype="fp32",
+            model_quantize=None,
         )
 
+    def test_main_run_image_generate_writes_prompts_to_a_directory(self):
+        with self._runner.isolated_filesystem():
+            Path("prompts.txt").write_text("third\n\nfourth\n")
+            result = self._runner.invoke(
+                main,
+                [
+                    "run",
+                    "image-generate",
+                    "model",
+                    "images",
+                    "--prompt",
+                    "first",
+                    "--prompt",
+                    "second",
+                    "--prompt-file",
+                    "prompts.txt",
+                    "--format",
+                    "webp",
+                ],
+            )
+        self.assertEqual(0, result.exit_code, result.output)
+        self._run_image_patch.assert_not_called()
+        self._run_image_prompts_patch.assert_called_once_with(
+            model_handler_class=ImageGenerateModelHandler,
+            model_identifier="model",
+            model_revision=None,
+            output_directory=Path("images"),
+            input_texts=["first", "second", "third", "fourth"],
+            image_format=ImageFormat.webp,
+            model_fast_load_cache=None,
+            model_dtype="fp32",
+            model_quantize=None,
+        )
+
+    def test_main_run_image_generate_requires_input_text_or_prompts(self):
+        for arguments in ([], ["input", "--prompt", "prompt"]):
+            with self.subTest(arguments=arguments):
+                result = self._runner.invoke(
+                    main, ["run", "image-generate", "model", "destination", *arguments]
+                )
+                self.assertNotEqual(0, result.exit_code)
+                self.assertIn("Give either INPUT_TEXT or prompts", result.output)
+
+    def test_main_run_text_transform_batch_is_command_requiring_arguments(self):
+        result = self._runner.invoke(main, ["run", "text-transform-batch"])
+        self.assertNotEqual(0, result.exit_code)
+        self.assertRegex(result.output, "Usage: wrangler run text-transform-batch")
+
+    def test_main_run_text_transform_batch_defaults_as_expected(self):
+        result = self._runner.invoke(main, ["run", "text-transform-batch", "model"])
+        self.assertEqual(0, result.exit_code, result.output)
+        self._run_batch_patch.assert_called_once_with(
+            model_handler_class=TextTransformModelHandler,
+            model_identifier="model",
+            model_revision=None,
+            model_offload_folder=None,
+            input_file=ANY,
+            output_file=ANY,
+            batch_size=8,
+            model_fast_load_cache=None,
+            model_dtype="fp32",
+            model_quantize=None,
+        )
+        self.assertEqual("<stdin>", self._run_batch_patch.call_args.kwargs["input_file"].name)
+        self.assertEqual("<stdout>", self._run_batch_patch.call_args.kwargs["output_file"].name)
+
+    def test_main_run_text_transform_batch_passes_options_and_arguments(self):
+        with self._runner.isolated_filesystem():
+            Path("input.jsonl").write_text("")
+            result = self._runner.invoke(
+                main,
+                [
+                    "run",
+                    "text-transform-batch",
+                    "--output-file",
+                    "output.jsonl",
+                    "--model-offload-folder",
+                    "model_offload_folder",
+                    "--batch-size",
+                    "16",
+                    "model:revision",
+                    "input.jsonl",
+                ],
+            )
+        self.assertEqual(0, result.exit_code, result.output)
+        self._run_batch_patch.assert_called_once_with(
+            model_handler_class=ANY,
+            model_identifier="model",
+            model_revision="revision",
+            model_offload_folder=Path("model_offload_folder"),
+            input_file=ANY,
+            output_file=ANY,
+            batch_size=16,
+            model_fast_load_cache=None,
+            model_dtype="fp32",
+            model_quantize=None,
+        )
+        self.assertEqual("input.jsonl", self._run_batch_patch.call_args.kwargs["input_file"].name)
+        self.assertEqual("output.jsonl", self._run_batch_patch.call_args.kwargs["output_file"].name)
+
+    def test_main_run_image_generate_batch_is_command_requiring_arguments(self):
+        result = self._runner.invoke(main, ["run", "image-generate-batch", "model"])
+        self.assertNotEqual(0, result.exit_code)
+        self.assertRegex(result.output, "Usage: wrangler run image-generate-batch")
+
+    def test_main_run_image_generate_batch_passes_options_and_arguments(self):
+        result = self._runner.invoke(
+            main, ["run", "image-generate-batch", "model:revision", "output_directory"]
+        )
+        self.assertEqual(0, result.exit_code, result.output)
+        self._run_image_batch_patch.assert_called_once_with(
+            model_handler_class=ImageGenerateModelHandler,
+            model_identifier="model",
+            model_revision="revision",
+            output_directory=Path("output_directory"),
+            input_file=ANY,
+            output_file=ANY,
+            batch_size=1,
+            model_fast_load_cache=None,
+            model_dtype="fp32",
+            model_quantize=None,
+        )
+
+    def test_main_run_image_generate_batch_passes_batch_size(self):
+        result = self._runner.invoke(
+            main,
+            ["run", "image-generate-batch", "model", "output_directory", "--batch-size", "4"],
+        )
+        self.assertEqual(0, result.exit_code, result.output)
+        self._run_image_batch_patch.assert_called_once_with(
+            model_handler_class=ANY,
+            model_identifier=ANY,
+            model_revision=ANY,
+            output_directory=ANY,
+            input_file=ANY,
+            output_file=ANY,
+            batch_size=4,
+            model_fast_load_cache=None,
+            model_dtype="fp32",
+            model_quantize=None,
+        )
+
+    def test_main_serve_passes_additional_model_identifiers_and_memory_budget(self):
+        result = self._runner.invoke(
+            main,
+            [
+                "serve",
+                "--max-model-memory",
+                "1073741824",
+                "text-transform",
+                "first:revision",
+                "second",
+                "third:other",
+            ],
+        )
+        self.assertEqual(0, result.exit_code, result.output)
+        kwargs = self._serve_patch.call_args.kwargs
+        self.assertEqual(
+            ("first", "revision"), (kwargs["model_identifier"], kwargs["model_revision"])
+        )
+        self.assertEqual(
+            (("second", None), ("third", "other")), kwargs["model_additional_identifiers"]
+        )
+        self.assertEqual(1073741824, kwargs["model_max_memory"])
+
+    def test_main_fast_load_uses_the_fast_load_cache(self):
+        result = self._runner.invoke(
+            main,
+            ["run", "text-transform", "--fast-load", "--fast-load-cache", "cache", "model", "in"],
+        )
+        self.assertEqual(0, result.exit_code, result.output)
+        self.assertEqual(Path("cache"), self._run_patch.call_args.kwargs["model_fast_load_cache"])
+
+    def test_main_fast_load_cache_defaults_to_the_user_cache_directory(self):
+        result = self._runner.invoke(
+            main,
+            ["serve", "image-generate", "--fast-load", "model"],
+            env={"XDG_CACHE_HOME": "user_cache"},
+        )
+        self.assertEqual(0, result.exit_code, result.output)
+        self.assertEqual(
+            Path("user_cache", "wrangler"),
+            self._serve_patch.call_args.kwargs["model_fast_load_cache"],
+        )
+
+    def test_main_passes_dtype_and_quantization(self):
+        result = self._runner.invoke(
+            main,
+            ["run", "text-transform", "--dtype", "fp32", "--quantize", "dynamic-int8", "m", "in"],
+        )
+        self.assertEqual(0, result.exit_code, result.output)
+        self.assertEqual("fp32", self._run_patch.call_args.kwargs["model_dtype"])
+        self.assertEqual("dynamic-int8", self._run_patch.call_args.kwargs["model_quantize"])
+
+    def test_main_quantization_requires_fp32(self):
+        result = self._runner.invoke(
+            main,
+            ["serve", "image-generate", "--dtype", "bf16", "--quantize", "dynamic-int8", "m"],
+        )
+        self.assertNotEqual(0, result.exit_code)
+        self.assertIn("requires --dtype fp32", result.output)
+        self._serve_patch.assert_not_called()
+
+
+class StartupTestCase(unittest.TestCase):
+    """Guards against the CLI importing libraries that its commands do not use"""
+
+    MODEL_AND_SERVER_PACKAGES = {"torch", "transformers", "diffusers", "fastapi", "hypercorn"}
+
+    @staticmethod
+    def _imported_packages(*args):
+        """Top level packages imported by a Python process according to -X importtime"""
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", *args],
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        return {
+            line.rsplit("|", 1)[-1].strip().split(".")[0]
+            for line in result.stderr.splitlines()
+            if line.startswith("import time:")
+        }
+
+    def test_help_imports_no_model_or_server_packages(self):
+        for command in ([], ["serve", "text-transform"], ["run", "image-generate"]):
+            with self.subTest(command=command):
+                imported = self._imported_packages("-m", "wrangler", *command, "--help")
+                self.assertIn("click", imported)
+                self.assertEqual(set(), imported & self.MODEL_AND_SERVER_PACKAGES)
+
+    def test_run_commands_do_not_import_server_or_diffusers(self):
+        imported = self._imported_packages("-c", "import wrangler.cli")
+        self.assertIn("torch", imported)
+        self.assertEqual(set(), imported & {"diffusers", "fastapi", "hypercorn"})
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,104 @@
+import asyncio
+import json
+import unittest
+
+import httpx
+
+from wrangler.bench import Sample, generate_load, is_streamed, percentiles, summarize
+
+
+class IsStreamedTestCase(unittest.TestCase):
+    def test_streams_the_fraction_of_requests_spread_through_the_run(self):
+        self.assertEqual(
+            [False, True, False, True], [is_streamed(index, 0.5) for index in range(4)]
+        )
+        self.assertEqual(25, sum(is_streamed(index, 0.25) for index in range(100)))
+        self.assertFalse(any(is_streamed(index, 0.0) for index in range(10)))
+        self.assertTrue(all(is_streamed(index, 1.0) for index in range(10)))
+
+
+class SummarizeTestCase(unittest.TestCase):
+    def test_percentiles_are_in_milliseconds(self):
+        values = [index / 1000 for index in range(1, 101)]
+        self.assertEqual(
+            {"mean": 50.5, "p50": 50.5, "p95": 95.05, "p99": 99.01, "max": 100.0},
+            percentiles(values),
+        )
+
+    def test_percentiles_of_a_single_value(self):
+        self.assertEqual(
+            {"mean": 1.0, "p50": 1.0, "p95": 1.0, "p99": 1.0, "max": 1.0}, percentiles([0.001])
+        )
+
+    def test_counts_errors_and_excludes_them_from_latencies(self):
+        samples = [
+            Sample(0.1),
+            Sample(0.2, time_to_first_token=0.05),
+            Sample(5.0, error="http_429"),
+            Sample(6.0, error="http_429"),
+        ]
+        summary = summarize(samples, 2.0)
+        self.assertEqual(4, summary["requests"])
+        self.assertEqual(2, summary["succeeded"])
+        self.assertEqual(1.0, summary["throughput_requests_per_second"])
+        self.assertEqual(0.5, summary["error_rate"])
+        self.assertEqual({"http_429": 2}, summary["errors"])
+        self.assertEqual(200.0, summary["latency_ms"]["max"])
+        self.assertEqual(50.0, summary["time_to_first_token_ms"]["p50"])
+
+    def test_omits_latencies_when_every_request_failed(self):
+        summary = summarize([Sample(1.0, error="transport_error")], 1.0)
+        self.assertEqual(1.0, summary["error_rate"])
+        self.assertNotIn("latency_ms", summary)
+        self.assertNotIn("time_to_first_token_ms", summary)
+
+
+class GenerateLoadTestCase(unittest.TestCase):
+    def setUp(self):
+        self.received = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def _handle(self, request: httpx.Request) -> httpx.Response:
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        await asyncio.sleep(0.01)
+        self.in_flight -= 1
+        body = json.loads(request.content)
+        self.received.append((request.url.path, body["input"]))
+        if body["input"] == "full":
+            return httpx.Response(429, json={"detail": "Too many requests"})
+        if request.url.path == "/stream":
+            if body["input"] == "fail":
+                return httpx.Response(200, content=b'{"text": "a"}\n{"error": "Failed"}\n')
+            return httpx.Response(200, content=b'{"text": "a"}\n{"generated_text": "a"}\n')
+        return httpx.Response(200, json={"generated_text": "a"})
+
+    def _generate(self, bodies, requests, concurrency, stream_fraction=0.0):
+        async def generate():
+            async with httpx.AsyncClient(
+                base_url="http://wrangler", transport=httpx.MockTransport(self._handle)
+            ) as client:
+                return await generate_load(client, bodies, requests, concurrency, stream_fraction)
+
+        return asyncio.run(generate())
+
+    def test_sends_the_requests_in_turn_with_the_given_concurrency(self):
+        samples = self._generate([{"input": "a"}, {"input": "b"}], 6, 3)
+        self.assertEqual(6, len(samples))
+        self.assertEqual(3, self.max_in_flight)
+        self.assertEqual(["a", "b", "a", "b", "a", "b"], [input_ for _, input_ in self.received])
+        self.assertTrue(all(sample.error is None for sample in samples))
+        self.assertTrue(all(sample.time_to_first_token is None for sample in samples))
+
+    def test_times_the_first_line_of_streamed_requests(self):
+        samples = self._generate([{"input": "a"}], 4, 1, stream_fraction=0.5)
+        self.assertEqual(["/", "/stream", "/", "/stream"], [path for path, _ in self.received])
+        streamed = [sample for sample in samples if sample.time_to_first_token is not None]
+        self.assertEqual(2, len(streamed))
+        for sample in streamed:
+            self.assertLessEqual(sample.time_to_first_token, sample.latency)
+
+    def test_records_rejections_and_errors_in_the_stream(self):
+        samples = self._generate([{"input": "full"}, {"input": "fail"}], 2, 1, stream_fraction=1.0)
+        self.assertEqual(["http_429", "stream_error"], [sample.error for sample in samples])
@@ -0,0 +1,70 @@
+import unittest
+from unittest.mock import patch
+
+from wrangler.cache import ResponseCache
+from wrangler.metrics import Metrics
+from wrangler.models import TextTransformRequest, TextTransformResponse
+
+
+class ResponseCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self._metrics = Metrics()
+
+    def _cache(self, max_bytes=10_000, ttl=None, cacheable=lambda request: True):
+        return ResponseCache(
+            "model", "revision", max_bytes, cacheable, ttl=ttl, metrics=self._metrics
+        )
+
+    def test_returns_cached_response_for_identical_request(self):
+        cache = self._cache()
+        response = TextTransformResponse(generated_text="generated")
+        cache.put(cache.key(TextTransformRequest(input="input")), response)
+        self.assertEqual(response, cache.get(cache.key(TextTransformRequest(input="input"))))
+        self.assertIsNone(cache.get(cache.key(TextTransformRequest(input="other"))))
+        self.assertEqual(1, self._metrics.response_cache.value(result="hit"))
+        self.assertEqual(1, self._metrics.response_cache.value(result="miss"))
+
+    def test_key_includes_model_and_revision(self):
+        request = TextTransformRequest(input="input")
+        other = ResponseCache("model", "other", 10_000, lambda request_: True)
+        self.assertNotEqual(self._cache().key(request), other.key(request))
+
+    def test_key_is_none_for_requests_which_are_not_cacheable(self):
+        cache = self._cache(cacheable=lambda request: False)
+        self.assertIsNone(cache.key(TextTransformRequest(input="input")))
+
+    def test_evicts_least_recently_used_responses_to_stay_within_size(self):
+        first, second, third = (TextTransformRequest(input=input_) for input_ in "abc")
+        response = TextTransformResponse(generated_text="generated")
+        cache = self._cache()
+        entry_size = len(cache.key(first)) + len(response.json())
+        cache = self._cache(max_bytes=entry_size * 2)
+        cache.put(cache.key(first), response)
+        cache.put(cache.key(second), response)
+        cache.get(cache.key(first))
+        cache.put(cache.key(third), response)
+        self.assertEqual(2, len(cache))
+        self.assertEqual(entry_size * 2, cache.size)
+        self.assertIsNone(cache.get(cache.key(second)))
+        self.assertIsNotNone(cache.get(cache.key(first)))
+        self.assertIsNotNone(cache.get(cache.key(third)))
+
+    def test_does_not_cache_responses_larger_than_the_cache(self):
+        cache = self._cache(max_bytes=10)
+        cache.put(
+            cache.key(TextTransformRequest(input="input")),
+            TextTransformResponse(generated_text="generated"),
+        )
+        self.assertEqual(0, len(cache))
+        self.assertEqual(0, cache.size)
+
+    def test_expires_responses_after_ttl(self):
+        cache = self._cache(ttl=60.0)
+        key = cache.key(TextTransformRequest(input="input"))
+        with patch("wrangler.cache.time.monotonic", return_value=100.0):
+            cache.put(key, TextTransformResponse(generated_text="generated"))
+        with patch("wrangler.cache.time.monotonic", return_value=159.0):
+            self.assertIsNotNone(cache.get(key))
+        with patch("wrangler.cache.time.monotonic", return_value=160.0):
+            self.assertIsNone(cache.get(key))
+        self.assertEqual(0, cache.size)
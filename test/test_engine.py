@@ -0,0 +1,182 @@
+import unittest
+from unittest.mock import MagicMock
+from uuid import uuid4
+
+from wrangler.engine import ContinuousBatchingEngine
+from wrangler.model_handlers import TextTransformModelHandler
+from wrangler.models import TextTransformRequest
+from wrangler.prefix_cache import PrefixCache
+from test.test_integration import TEXT_TRANSFORM_TEST_MODEL
+
+INPUTS = [
+    "Input Text",
+    "Stuff",
+    "How now brown cow said the very long prompt",
+    "hi",
+    "A cowboy riding a horse through the desert southwest",
+]
+
+
+class ContinuousBatchingEngineTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls) -> None:
+        handler = TextTransformModelHandler(TEXT_TRANSFORM_TEST_MODEL, None, None)
+        cls.model, cls.tokenizer = handler._get_model_and_tokenizer()
+        cls.expected = {
+            input_: handler._generate_results(
+                cls.model, cls.tokenizer, [TextTransformRequest(input=input_)]
+            )[0][0]
+            for input_ in INPUTS
+        }
+
+    def _run_to_completion(self, engine, results, request_inputs):
+        while engine.has_work:
+            for request_id, result, _ in engine.step():
+                results[request_inputs[request_id]] = result
+
+    def test_results_match_generate_when_all_requests_are_added_up_front(self):
+        engine = ContinuousBatchingEngine(self.model, self.tokenizer, max_batch_size=8)
+        request_inputs = {}
+        for input_ in INPUTS:
+            request_id = uuid4()
+            request_inputs[request_id] = input_
+            engine.add(request_id, input_)
+        results: dict = {}
+        self._run_to_completion(engine, results, request_inputs)
+        self.assertEqual(self.expected, results)
+
+    def test_results_match_generate_when_requests_join_a_running_batch(self):
+        engine = ContinuousBatchingEngine(self.model, self.tokenizer, max_batch_size=2)
+        request_inputs = {}
+        results: dict = {}
+        for input_ in INPUTS:
+            request_id = uuid4()
+            request_inputs[request_id] = input_
+            engine.add(request_id, input_)
+            for finished_id, result, _ in engine.step():
+                results[request_inputs[finished_id]] = result
+        self._run_to_completion(engine, results, request_inputs)
+        self.assertEqual(self.expected, results)
+
+    def test_results_match_generate_when_prompts_share_cached_prefixes(self):
+        prefix_cache = PrefixCache(max_bytes=10_000_000)
+        engine = ContinuousBatchingEngine(
+            self.model, self.tokenizer, max_batch_size=2, prefix_cache=prefix_cache
+        )
+        # Each input is added twice so the second is prefilled from the first
+        request_inputs = {}
+        results: dict = {}
+        for input_ in [*INPUTS, *INPUTS]:
+            request_id = uuid4()
+            request_inputs[request_id] = input_
+            engine.add(request_id, input_)
+            self._run_to_completion(engine, results, request_inputs)
+            self.assertEqual(self.expected[input_], results[input_])
+        self.assertGreater(len(prefix_cache), 0)
+
+    def test_results_match_generate_with_generation_parameters(self):
+        requests = [
+            TextTransformRequest(input="Input Text", max_new_tokens=4),
+            TextTransformRequest(input="Stuff", stop=["yl"]),
+            TextTransformRequest(input="hi", stop=["Br", "bl"]),
+        ]
+        engine = ContinuousBatchingEngine(self.model, self.tokenizer, max_batch_size=8)
+        request_inputs = {}
+        for request in requests:
+            request_id = uuid4()
+            request_inputs[request_id] = request.input
+            engine.add(
+                request_id, request.input, max_new_tokens=request.max_new_tokens, stop=request.stop
+            )
+        results: dict = {}
+        self._run_to_completion(engine, results, request_inputs)
+        expected = {
+            request.input: TextTransformModelHandler._generate_results(
+                self.model, self.tokenizer, [request]
+            )[0][0]
+            for request in requests
+        }
+        self.assertEqual(expected, results)
+
+    def test_samples_tokens_when_requested(self):
+        engine = ContinuousBatchingEngine(self.model, self.tokenizer, max_batch_size=8)
+        request_id = uuid4()
+        engine.add(
+            request_id, "Input Text", max_new_tokens=5, do_sample=True, temperature=0.7, top_p=0.9
+        )
+        finished = []
+        while engine.has_work:
+            finished.extend(engine.step())
+        [(finished_id, result, timings)] = finished
+        self.assertEqual(request_id, finished_id)
+        self.assertTrue(result.startswith("Input Text"))
+        self.assertEqual(5, timings.tokens)
+
+    def test_running_batch_never_exceeds_max_batch_size(self):
+        engine = ContinuousBatchingEngine(self.model, self.tokenizer, max_batch_size=2)
+        for input_ in INPUTS:
+            engine.add(uuid4(), input_)
+        while engine.has_work:
+            engine.step()
+            self.assertLessEqual(len(engine._running), 2)
+
+    def test_finished_sequences_are_retired_before_longer_sequences(self):
+        engine = ContinuousBatchingEngine(self.model, self.tokenizer, max_batch_size=2)
+        short_id, long_id = uuid4(), uuid4()
+        engine.add(long_id, "hi", max_new_tokens=10)
+        engine.add(short_id, "hi", max_new_tokens=2)
+        finished = []
+        while engine.has_work:
+            finished.extend(request_id for request_id, *_ in engine.step())
+        self.assertEqual([short_id, long_id], finished)
+
+    def test_max_new_tokens_limits_generated_tokens(self):
+        engine = ContinuousBatchingEngine(self.model, self.tokenizer, max_batch_size=1)
+        request_id = uuid4()
+        engine.add(request_id, "Input Text", max_new_tokens=3)
+        results: dict = {}
+        self._run_to_completion(engine, results, {request_id: "Input Text"})
+        generated = self.tokenizer(results["Input Text"])["input_ids"]
+        self.assertEqual(len(self.tokenizer("Input Text")["input_ids"]) + 3, len(generated))
+
+    def test_cancelled_requests_are_not_returned(self):
+        engine = ContinuousBatchingEngine(self.model, self.tokenizer, max_batch_size=1)
+        running_id, waiting_id, kept_id = uuid4(), uuid4(), uuid4()
+        engine.add(running_id, "Input Text")
+        engine.add(waiting_id, "Stuff")
+        engine.add(kept_id, "hi")
+        engine.step()
+        engine.cancel(running_id)
+        engine.cancel(waiting_id)
+        finished = []
+        while engine.has_work:
+            finished.extend(request_id for request_id, *_ in engine.step())
+        self.assertEqual([kept_id], finished)
+
+    def test_streamer_receives_each_generated_token(self):
+        streamer = MagicMock()
+        engine = ContinuousBatchingEngine(self.model, self.tokenizer, max_batch_size=1)
+        request_id = uuid4()
+        engine.add(request_id, "Input Text", max_new_tokens=3, streamer=streamer)
+        while engine.has_work:
+            engine.step()
+        self.assertEqual(3, streamer.put.call_count)
+        streamer.end.assert_called_once_with()
+
+    def test_step_reports_timings_of_finished_sequences(self):
+        engine = ContinuousBatchingEngine(self.model, self.tokenizer, max_batch_size=2)
+        engine.add(uuid4(), "Input Text", max_new_tokens=3)
+        engine.add(uuid4(), "Stuff", max_new_tokens=3)
+        timings = []
+        while engine.has_work:
+            timings.extend(timing for *_, timing in engine.step())
+        self.assertEqual([3, 3], [timing.tokens for timing in timings])
+        self.assertEqual([2, 2], [timing.batch_size for timing in timings])
+        for timing in timings:
+            self.assertGreater(timing.model, 0.0)
+            self.assertGreater(timing.tokenize, 0.0)
+            self.assertGreater(timing.decode, 0.0)
+
+
+if __name__ == "__main__":
+    unittest.main()
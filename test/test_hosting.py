@@ -0,0 +1,178 @@
+import unittest
+from concurrent.futures import Future
+from unittest.mock import MagicMock
+from uuid import uuid4
+
+from wrangler.hosting import ModelPool, UnknownModelError, model_key
+from wrangler.models import TextTransformRequest
+
+
+class _WorkerPool:
+    """Worker pool which records what it was asked to do rather than starting processes"""
+
+    def __init__(self, model_handler):
+        self.model_handler = model_handler
+        self.started = False
+        self.in_flight = 0
+        self.memory = 0.0
+        self.submitted = []
+        self.cancelled = []
+        self.ready = 0
+        self.failed = False
+        self.restart_delay = 1.0
+        # Completed once the test lets the worker processes exit
+        self.stopped = Future()
+        self.stopped.set_result(None)
+
+    def start(self, loop):
+        self.started = True
+
+    def stop(self):
+        self.started = False
+
+    def stop_in_background(self):
+        self.started = False
+        return self.stopped
+
+    def memory_usage(self):
+        return {"0": self.memory} if self.started else {}
+
+    def submit(self, request_id, request, deadline=None):
+        self.submitted.append(request_id)
+        self.in_flight += 1
+
+    def cancel(self, request_id):
+        self.cancelled.append(request_id)
+
+
+class ModelKeyTestCase(unittest.TestCase):
+    def test_splits_the_revision_from_the_model(self):
+        self.assertEqual(("org/model", "revision"), model_key("org/model:revision"))
+        self.assertEqual(("org/model", None), model_key("org/model"))
+
+
+class ModelPoolTestCase(unittest.TestCase):
+    def setUp(self):
+        self._handlers = {
+            ("first", None): MagicMock(),
+            ("second", None): MagicMock(),
+            ("third", "revision"): MagicMock(),
+        }
+        self._pools = {}
+
+    def _create(self, max_memory=None):
+        def create_worker_pool(model_handler):
+            key = next(key for key, value in self._handlers.items() if value is model_handler)
+            self._pools[key] = _WorkerPool(model_handler)
+            return self._pools[key]
+
+        model_pool = ModelPool(self._handlers, create_worker_pool, max_memory=max_memory)
+        model_pool.start(MagicMock())
+        return model_pool
+
+    def _submit(self, model_pool, model=None):
+        request_id = uuid4()
+        model_pool.submit(request_id, TextTransformRequest(input="Stuff", model=model))
+        return request_id
+
+    def test_loads_only_the_default_model_at_start(self):
+        model_pool = self._create()
+        self.assertEqual(["first"], model_pool.loaded)
+        self.assertFalse(self._pools[("second", None)].started)
+
+    def test_routes_requests_by_model_and_loads_models_on_demand(self):
+        model_pool = self._create()
+        default = self._submit(model_pool)
+        third = self._submit(model_pool, "third:revision")
+        self.assertEqual([default], self._pools[("first", None)].submitted)
+        self.assertEqual([third], self._pools[("third", "revision")].submitted)
+        self.assertEqual(["first", "third:revision"], model_pool.loaded)
+
+    def test_rejects_requests_for_models_it_does_not_host(self):
+        model_pool = self._create()
+        for model in ("unknown", "third", "third:other"):
+            with self.assertRaises(UnknownModelError):
+                self._submit(model_pool, model)
+
+    def test_unloads_least_recently_used_idle_models_to_stay_within_memory(self):
+        model_pool = self._create(max_memory=250)
+        self._pools[("first", None)].memory = 100
+        self._submit(model_pool, "second")
+        self._pools[("second", None)].memory = 100
+        self._submit(model_pool, "first")
+        for pool in self._pools.values():
+            pool.in_flight = 0
+        self._submit(model_pool, "third:revision")
+        self._pools[("third", "revision")].memory = 100
+        model_pool._check()
+        # Second was used less recently than first
+        self.assertEqual(["first", "third:revision"], model_pool.loaded)
+        self.assertFalse(self._pools[("second", None)].started)
+
+    def test_does_not_unload_models_with_outstanding_requests(self):
+        model_pool = self._create(max_memory=150)
+        self._pools[("first", None)].memory = 100
+        self._submit(model_pool)
+        self._submit(model_pool, "second")
+        self._pools[("second", None)].memory = 100
+        model_pool._check()
+        self.assertEqual(["first", "second"], model_pool.loaded)
+
+    def test_makes_room_for_the_memory_a_model_used_before_loading_it_again(self):
+        model_pool = self._create(max_memory=150)
+        self._pools[("first", None)].memory = 100
+        self._submit(model_pool, "second")
+        self._pools[("second", None)].memory = 100
+        self._pools[("second", None)].in_flight = 0
+        self._submit(model_pool, "first")
+        self._pools[("first", None)].in_flight = 0
+        model_pool._check()
+        self.assertEqual(["first"], model_pool.loaded)
+        self._pools[("first", None)].memory = 100
+        self._submit(model_pool, "second")
+        self.assertEqual(["second"], model_pool.loaded)
+
+    def test_holds_requests_for_a_model_until_it_has_unloaded_and_then_loads_it(self):
+        model_pool = self._create(max_memory=150)
+        self._pools[("first", None)].memory = 100
+        self._submit(model_pool, "second")
+        second = self._pools[("second", None)]
+        second.memory = 100
+        second.in_flight = 0
+        second.stopped = Future()
+        self._submit(model_pool, "first")
+        model_pool._check()
+        self.assertEqual(["first"], model_pool.loaded)
+        request_id = self._submit(model_pool, "second")
+        # The request waits in the pool, which is not started while its workers exit
+        self.assertEqual(request_id, second.submitted[-1])
+        self.assertFalse(second.started)
+        model_pool.cancel(request_id)
+        self.assertEqual([request_id], second.cancelled)
+        second.stopped.set_result(None)
+        self.assertTrue(second.started)
+        self.assertEqual(["first", "second"], model_pool.loaded)
+
+    def test_cancels_requests_in_loaded_models(self):
+        model_pool = self._create()
+        request_id = self._submit(model_pool)
+        model_pool.cancel(request_id)
+        self.assertEqual([request_id], self._pools[("first", None)].cancelled)
+        self.assertEqual([], self._pools[("second", None)].cancelled)
+
+    def test_has_failed_once_every_loaded_model_has_failed(self):
+        model_pool = self._create()
+        self._pools[("first", None)].failed = True
+        self.assertTrue(model_pool.failed)
+        self._submit(model_pool, "second")
+        self.assertFalse(model_pool.failed)
+
+    def test_is_deterministic_asks_the_handler_of_the_requested_model(self):
+        model_pool = self._create()
+        self._handlers[("second", None)].is_deterministic.return_value = True
+        self._handlers[("first", None)].is_deterministic.return_value = False
+        self.assertTrue(
+            model_pool.is_deterministic(TextTransformRequest(input="a", model="second"))
+        )
+        self.assertFalse(model_pool.is_deterministic(TextTransformRequest(input="a")))
+        self.assertFalse(model_pool.is_deterministic(TextTransformRequest(input="a", model="x")))
@@ -0,0 +1,119 @@
+import os
+import tempfile
+import unittest
+from io import BytesIO
+from pathlib import Path
+
+from PIL import Image
+
+from wrangler.images import ImageWriter, SharedImage, encode_image
+from wrangler.models import ImageFormat
+
+
+class SharedImageTestCase(unittest.TestCase):
+    def setUp(self):
+        self._image = Image.new("RGB", (8, 4), (255, 0, 0))
+
+    def test_encode_returns_image_in_requested_format(self):
+        shared_image = SharedImage.create(self._image, ImageFormat.png)
+        image = Image.open(BytesIO(shared_image.encode()))
+        self.assertEqual("PNG", image.format)
+        self.assertEqual((8, 4), image.size)
+        self.assertEqual((255, 0, 0), image.getpixel((0, 0)))
+
+    def test_encode_uses_format_override(self):
+        shared_image = SharedImage.create(self._image, ImageFormat.png)
+        image = Image.open(BytesIO(shared_image.encode(ImageFormat.jpg)))
+        self.assertEqual("JPEG", image.format)
+
+    def test_encode_applies_encoding_options(self):
+        shared_image = SharedImage.create(self._image, ImageFormat.jpg)
+        expected = encode_image(self._image, ImageFormat.jpg, quality=10)
+        self.assertEqual(expected, shared_image.encode(quality=10, compress_level=0))
+
+    def test_encode_frees_shared_memory(self):
+        shared_image = SharedImage.create(self._image, ImageFormat.png)
+        shared_image.encode()
+        self.assertFalse(os.path.exists(f"/dev/shm/{shared_image.name}"))
+
+    def test_release_frees_shared_memory(self):
+        shared_image = SharedImage.create(self._image, ImageFormat.png)
+        shared_image.release()
+        self.assertFalse(os.path.exists(f"/dev/shm/{shared_image.name}"))
+
+
+class EncodeImageTestCase(unittest.TestCase):
+    def setUp(self):
+        # A gradient, so compression settings change the encoded size
+        self._image = Image.linear_gradient("L").convert("RGB").resize((64, 64))
+
+    def test_encodes_every_format(self):
+        for image_format in ImageFormat:
+            with self.subTest(image_format):
+                image = Image.open(BytesIO(encode_image(self._image, image_format)))
+                self.assertEqual(image_format.value, image.format)
+                self.assertEqual((64, 64), image.size)
+
+    def test_quality_applies_to_jpeg_and_webp(self):
+        for image_format in (ImageFormat.jpg, ImageFormat.webp):
+            with self.subTest(image_format):
+                self.assertLess(
+                    len(encode_image(self._image, image_format, quality=5)),
+                    len(encode_image(self._image, image_format, quality=95)),
+                )
+
+    def test_compress_level_applies_to_png(self):
+        self.assertLess(
+            len(encode_image(self._image, ImageFormat.png, compress_level=9)),
+            len(encode_image(self._image, ImageFormat.png, compress_level=0)),
+        )
+
+    def test_ignores_options_of_other_formats(self):
+        self.assertEqual(
+            encode_image(self._image, ImageFormat.png),
+            encode_image(self._image, ImageFormat.png, quality=5),
+        )
+        self.assertEqual(
+            encode_image(self._image, ImageFormat.jpg),
+            encode_image(self._image, ImageFormat.jpg, compress_level=0),
+        )
+
+    def test_jpeg_drops_the_alpha_channel(self):
+        image = Image.open(BytesIO(encode_image(self._image.convert("RGBA"), ImageFormat.jpg)))
+        self.assertEqual("RGB", image.mode)
+
+    def test_gif_is_reduced_to_a_palette(self):
+        image = Image.open(
+            BytesIO(encode_image(Image.new("RGB", (8, 8), (255, 0, 0)), ImageFormat.gif))
+        )
+        self.assertEqual("P", image.mode)
+        self.assertEqual((255, 0, 0), image.convert("RGB").getpixel((0, 0)))
+
+
+class ImageWriterTestCase(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self._directory = Path(directory.name)
+
+    def test_writes_every_queued_image_before_closing(self):
+        with ImageWriter(max_pending=1) as writer:
+            for index in range(5):
+                writer.put(
+                    Image.new("L", (4, 4), index),
+                    self._directory.joinpath(f"{index}.png"),
+                    ImageFormat.png,
+                )
+        for index in range(5):
+            image = Image.open(self._directory.joinpath(f"{index}.png"))
+            self.assertEqual("PNG", image.format)
+            self.assertEqual(index, image.getpixel((0, 0)))
+        self.assertGreater(writer.seconds, 0.0)
+
+    def test_raises_errors_writing_images(self):
+        writer = ImageWriter()
+        writer.put(
+            Image.new("L", (4, 4)), self._directory.joinpath("missing/0.png"), ImageFormat.png
+        )
+        with self.assertRaises(FileNotFoundError):
+            writer.close()
@@ -1,15 +1,18 @@
 import base64
+import json
 import os.path
 import pathlib
 import subprocess
 import sys
 import time
 import unittest
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
 from tempfile import TemporaryDirectory, NamedTemporaryFile
 from unittest.mock import ANY
 
 import httpx
+import psutil
 from PIL import Image
 from click.testing import CliRunner
 
@@ -55,6 +58,49 @@ class CliRunTextCompleteIntegrationTestCase(unittest.TestCase):
         self.assertIn("Stuff set set set set setylganibibibibibibibibib\n", actual)
 
 
+class CliRunTextTransformBatchIntegrationTestCase(unittest.TestCase):
+    """Tests from the CLI batch run entrypoint to the model handler"""
+
+    def test_writes_a_result_for_each_input_line_in_order(self):
+        input_lines = [
+            json.dumps({"input": "Input Text"}),
+            "",
+            json.dumps({"input": "Stuff"}),
+            json.dumps({"not input": "hi"}),
+            json.dumps({"input": "hi"}),
+        ]
+        with CliRunner(mix_stderr=False).isolated_filesystem() as temp_folder:
+            runner = CliRunner(mix_stderr=False)
+            response = runner.invoke(
+                main,
+                [
+                    "run",
+                    "text-transform-batch",
+                    "--batch-size",
+                    "2",
+                    "--output-file",
+                    "output.jsonl",
+                    TEXT_TRANSFORM_TEST_MODEL,
+                ],
+                input="\n".join(input_lines),
+            )
+            if response.exception:
+                raise response.exception
+            self.assertEqual(0, response.exit_code, response.stderr)
+            with open(os.path.join(temp_folder, "output.jsonl")) as output_file:
+                actual = [json.loads(line) for line in output_file]
+        self.assertEqual(
+            [
+                {"generated_text": "Input Texttttazazazazazazazazaz"},
+                {"generated_text": "Stuff set set set set setylganibibibibibibibibib"},
+                {"error": ANY},
+                {"generated_text": "hiprers Br Br Br Br Br Br Br Br Br Br bl bl bl bl bl bl"},
+            ],
+            actual,
+        )
+        self.assertRegex(response.stderr, r"Completed 4 requests \(1 failed\)")
+
+
 class CliRunImageGenerateIntegrationTestCase(unittest.TestCase):
     """Tests from the CLI serve entrypoint to the model handler"""
 
@@ -80,6 +126,37 @@ class CliRunImageGenerateIntegrationTestCase(unittest.TestCase):
             self.assertEqual("PNG", image.format)
 
 
+class CliBenchTextTransformIntegrationTestCase(unittest.TestCase):
+    """Tests from the CLI bench entrypoint through a server it starts"""
+
+    def test_reports_throughput_latency_and_time_to_first_token(self):
+        runner = CliRunner(mix_stderr=False)
+        response = runner.invoke(
+            main,
+            [
+                "bench",
+                "--requests",
+                "6",
+                "--concurrency",
+                "2",
+                "--stream-fraction",
+                "0.5",
+                "text-transform",
+                TEXT_TRANSFORM_TEST_MODEL,
+            ],
+        )
+        if response.exception:
+            raise response.exception
+        self.assertEqual(0, response.exit_code, response.stderr)
+        actual = json.loads(response.stdout)
+        self.assertEqual(6, actual["requests"])
+        self.assertEqual(6, actual["succeeded"])
+        self.assertEqual(0.0, actual["error_rate"])
+        self.assertGreater(actual["throughput_requests_per_second"], 0.0)
+        self.assertEqual({"mean", "p50", "p95", "p99", "max"}, set(actual["latency_ms"]))
+        self.assertLessEqual(actual["time_to_first_token_ms"]["p50"], actual["latency_ms"]["max"])
+
+
 class ServerManager:
     def start_server(self, socket_filename, run_args):
         args = [
@@ -99,7 +176,7 @@ class ServerManager:
             args, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
         )
         start = time.perf_counter()
-        while not os.path.isfile(socket_filename) and time.perf_counter() - start < 5.0:
+        while not os.path.exists(socket_filename) and time.perf_counter() - start < 30.0:
             time.sleep(0.001)
 
     def stop_server(self):
@@ -150,6 +227,347 @@ class CliServeTextTransformIntegrationTestCase(unittest.TestCase, ServerManager)
         response.raise_for_status()
         self.assertEqual(expected, response.json())
 
+    def test_stream_request_returns_text_as_it_is_generated(self):
+        with self._client.stream(
+            "POST", "http://socket/stream", json={"input": "Input Text"}
+        ) as response:
+            response.raise_for_status()
+            self.assertRegex(response.headers.get("content-type"), r"^application/x-ndjson")
+            lines = [json.loads(line) for line in response.iter_lines()]
+        self.assertEqual({"generated_text": "Input Texttttazazazazazazazazaz"}, lines[-1])
+        self.assertGreater(len(lines), 2)
+        self.assertEqual("tttazazazazazazazazaz", "".join(line["text"] for line in lines[:-1]))
+
+    def test_metrics_reports_requests_and_model_timings(self):
+        self._client.post("http://socket/", json={"input": "Input Text"}).raise_for_status()
+        response = self._client.get("http://socket/metrics")
+        response.raise_for_status()
+        self.assertIn("wrangler_requests_in_flight 0.0\n", response.text)
+        self.assertIn('wrangler_requests_total{result="success"} 1.0\n', response.text)
+        self.assertIn("wrangler_model_seconds_count 1\n", response.text)
+        self.assertIn("wrangler_queue_wait_seconds_count 1\n", response.text)
+        self.assertRegex(response.text, r"wrangler_generated_tokens_total [1-9]")
+        self.assertRegex(response.text, r'wrangler_worker_resident_memory_bytes{worker="0"} \d+')
+
+
+class CliServeTextTransformBatchingIntegrationTestCase(unittest.TestCase, ServerManager):
+    """Tests from the CLI serve entrypoint to the model handler with batching enabled"""
+
+    batching_args = ["--max-batch-size", "4", "--batch-timeout", "50"]
+
+    def setUp(self):
+        socket_file = NamedTemporaryFile(suffix=".sock")
+        with socket_file:  # Identify a proper temporary file for the file system
+            socket_filename = socket_file.name
+        command_args = ["text-transform", *self.batching_args, TEXT_TRANSFORM_TEST_MODEL]
+        self.start_server(socket_filename, command_args)
+
+        transport = httpx.HTTPTransport(uds=socket_filename)
+        self._client = httpx.Client(transport=transport, timeout=30.0)
+
+    def tearDown(self) -> None:
+        self.stop_server()
+
+    def test_concurrent_requests_return_their_own_results(self):
+        expected = {
+            "Input Text": "Input Texttttazazazazazazazazaz",
+            "Stuff": "Stuff set set set set setylganibibibibibibibibib",
+            "hi": "hiprers Br Br Br Br Br Br Br Br Br Br bl bl bl bl bl bl",
+        }
+
+        def submit(input_text):
+            response = self._client.post("http://socket/", json={"input": input_text})
+            response.raise_for_status()
+            return response.json()["generated_text"]
+
+        with ThreadPoolExecutor(max_workers=len(expected)) as executor:
+            actual = dict(zip(expected.keys(), executor.map(submit, expected.keys()), strict=True))
+        self.assertEqual(expected, actual)
+
+    def test_stream_request_returns_text_as_it_is_generated(self):
+        with self._client.stream("POST", "http://socket/stream", json={"input": "hi"}) as response:
+            response.raise_for_status()
+            lines = [json.loads(line) for line in response.iter_lines()]
+        expected = "hiprers Br Br Br Br Br Br Br Br Br Br bl bl bl bl bl bl"
+        self.assertEqual({"generated_text": expected}, lines[-1])
+        self.assertEqual(expected[2:], "".join(line["text"] for line in lines[:-1]))
+
+    def test_concurrent_requests_with_generation_parameters_return_their_own_results(self):
+        requests = [
+            {"input": "Input Text", "max_new_tokens": 3},
+            {"input": "Stuff", "stop": ["yl"]},
+            {"input": "hi", "stop": [" bl"]},
+            {"input": "hi", "do_sample": True, "num_return_sequences": 2, "max_new_tokens": 4},
+        ]
+
+        def submit(request):
+            response = self._client.post("http://socket/", json=request)
+            response.raise_for_status()
+            return response.json()
+
+        with ThreadPoolExecutor(max_workers=len(requests)) as executor:
+            actual = list(executor.map(submit, requests))
+        self.assertEqual({"generated_text": "Input Textttt"}, actual[0])
+        self.assertEqual({"generated_text": "Stuff set set set set set"}, actual[1])
+        self.assertEqual({"generated_text": "hiprers Br Br Br Br Br Br Br Br Br Br"}, actual[2])
+        self.assertEqual(2, len(actual[3]["generated_texts"]))
+        for generated_text in actual[3]["generated_texts"]:
+            self.assertTrue(generated_text.startswith("hi"))
+
+    def test_stream_request_stops_at_stop_string(self):
+        with self._client.stream(
+            "POST", "http://socket/stream", json={"input": "hi", "stop": ["bl"]}
+        ) as response:
+            response.raise_for_status()
+            lines = [json.loads(line) for line in response.iter_lines()]
+        expected = "hiprers Br Br Br Br Br Br Br Br Br Br "
+        self.assertEqual({"generated_text": expected}, lines[-1])
+        self.assertEqual(expected[2:], "".join(line["text"] for line in lines[:-1]))
+
+    def test_several_sequences_without_sampling_are_rejected(self):
+        response = self._client.post(
+            "http://socket/", json={"input": "hi", "num_return_sequences": 2, "do_sample": False}
+        )
+        self.assertEqual(422, response.status_code)
+
+
+class CliServeTextTransformContinuousBatchingIntegrationTestCase(
+    CliServeTextTransformBatchingIntegrationTestCase
+):
+    """Tests from the CLI serve entrypoint to the model handler with continuous batching"""
+
+    batching_args = ["--max-batch-size", "2", "--continuous-batching"]
+
+
+class CliServeTextTransformPrefixCacheIntegrationTestCase(
+    CliServeTextTransformBatchingIntegrationTestCase
+):
+    """Tests from the CLI serve entrypoint to the model handler with a prefix cache"""
+
+    batching_args = ["--prefix-cache-size", "10000000"]
+
+
+class CliServeTextTransformWorkersIntegrationTestCase(unittest.TestCase, ServerManager):
+    """Tests from the CLI serve entrypoint to multiple model worker processes"""
+
+    def setUp(self):
+        socket_file = NamedTemporaryFile(suffix=".sock")
+        with socket_file:  # Identify a proper temporary file for the file system
+            socket_filename = socket_file.name
+        command_args = ["--workers", "2", "text-transform", TEXT_TRANSFORM_TEST_MODEL]
+        self.start_server(socket_filename, command_args)
+
+        transport = httpx.HTTPTransport(uds=socket_filename)
+        self._client = httpx.Client(transport=transport, timeout=30.0)
+
+    def tearDown(self) -> None:
+        for child in psutil.Process(self._server_process.pid).children():
+            child.kill()
+        self.stop_server()
+
+    def _workers(self):
+        # The server also runs a multiprocessing resource tracker process
+        return [
+            child
+            for child in psutil.Process(self._server_process.pid).children()
+            if not self._is_resource_tracker(child)
+        ]
+
+    @staticmethod
+    def _is_resource_tracker(process):
+        try:
+            return "resource_tracker" in " ".join(process.cmdline())
+        except psutil.ZombieProcess:
+            # A killed worker the server has not reaped yet
+            return False
+
+    def _submit(self, input_text):
+        response = self._client.post("http://socket/", json={"input": input_text})
+        response.raise_for_status()
+        return response.json()
+
+    def test_starts_a_process_per_worker(self):
+        self._submit("Input Text")
+        self.assertEqual(2, len(self._workers()))
+
+    def test_requests_are_served_after_a_worker_exits(self):
+        expected = {"generated_text": "Input Texttttazazazazazazazazaz"}
+        self.assertEqual(expected, self._submit("Input Text"))
+        worker = self._workers()[0]
+        worker.kill()
+        # Requests sent once the exit is noticed go to the remaining worker
+        while worker.pid in [child.pid for child in self._workers()]:
+            time.sleep(0.01)
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            actual = list(executor.map(self._submit, ["Input Text"] * 4))
+        self.assertEqual([expected] * 4, actual)
+
+
+class CliServeTextTransformResponseCacheIntegrationTestCase(unittest.TestCase, ServerManager):
+    """Tests from the CLI serve entrypoint to the response cache"""
+
+    def setUp(self):
+        socket_file = NamedTemporaryFile(suffix=".sock")
+        with socket_file:  # Identify a proper temporary file for the file system
+            socket_filename = socket_file.name
+        command_args = [
+            "text-transform",
+            "--response-cache-size",
+            "1048576",
+            TEXT_TRANSFORM_TEST_MODEL,
+        ]
+        self.start_server(socket_filename, command_args)
+
+        transport = httpx.HTTPTransport(uds=socket_filename)
+        self._client = httpx.Client(transport=transport, timeout=30.0)
+
+    def tearDown(self) -> None:
+        self.stop_server()
+
+    def test_repeated_request_is_answered_from_the_cache(self):
+        expected = {"generated_text": "Input Texttttazazazazazazazazaz"}
+        for _ in range(2):
+            response = self._client.post("http://socket/", json={"input": "Input Text"})
+            response.raise_for_status()
+            self.assertEqual(expected, response.json())
+        metrics = self._client.get("http://socket/metrics").text
+        self.assertIn('wrangler_response_cache_lookups_total{result="hit"} 1.0\n', metrics)
+        self.assertIn('wrangler_response_cache_lookups_total{result="miss"} 1.0\n', metrics)
+        self.assertIn("wrangler_model_seconds_count 1\n", metrics)
+
+
+class CliServeTextTransformWarmUpIntegrationTestCase(unittest.TestCase, ServerManager):
+    """Tests from the CLI serve entrypoint to the readiness of a warmed up model"""
+
+    def setUp(self):
+        socket_file = NamedTemporaryFile(suffix=".sock")
+        with socket_file:  # Identify a proper temporary file for the file system
+            socket_filename = socket_file.name
+        command_args = [
+            "--warm-up-input",
+            "Input Text",
+            "text-transform",
+            TEXT_TRANSFORM_TEST_MODEL,
+        ]
+        self.start_server(socket_filename, command_args)
+
+        transport = httpx.HTTPTransport(uds=socket_filename)
+        self._client = httpx.Client(transport=transport, timeout=30.0)
+
+    def tearDown(self) -> None:
+        self.stop_server()
+
+    def test_is_ready_once_the_model_has_warmed_up(self):
+        response = self._client.get("http://socket/ready")
+        self.assertEqual(503, response.status_code)
+        self.assertIn("retry-after", response.headers)
+        # The server is alive while the model loads
+        self.assertEqual(204, self._client.get("http://socket/ping").status_code)
+        start = time.perf_counter()
+        while response.status_code != 204 and time.perf_counter() - start < 60.0:
+            time.sleep(0.05)
+            response = self._client.get("http://socket/ready")
+        self.assertEqual(204, response.status_code)
+        metrics = self._client.get("http://socket/metrics").text
+        self.assertIn("wrangler_workers_ready 1.0\n", metrics)
+        # Warming up is not a request
+        self.assertIn("wrangler_model_seconds_count 0\n", metrics)
+
+
+class CliServeTextTransformMultipleModelsIntegrationTestCase(unittest.TestCase, ServerManager):
+    """Tests from the CLI serve entrypoint to several models hosted by one server"""
+
+    def setUp(self):
+        socket_file = NamedTemporaryFile(suffix=".sock")
+        with socket_file:  # Identify a proper temporary file for the file system
+            socket_filename = socket_file.name
+        # The revision of a local model is not used, so both load the same weights
+        self._other_model = f"{TEXT_TRANSFORM_TEST_MODEL}:other"
+        command_args = [
+            "--max-model-memory",
+            "1",
+            "text-transform",
+            TEXT_TRANSFORM_TEST_MODEL,
+            self._other_model,
+        ]
+        self.start_server(socket_filename, command_args)
+
+        transport = httpx.HTTPTransport(uds=socket_filename)
+        self._client = httpx.Client(transport=transport, timeout=60.0)
+
+    def tearDown(self) -> None:
+        for child in psutil.Process(self._server_process.pid).children():
+            child.kill()
+        self.stop_server()
+
+    def _submit(self, model):
+        return self._client.post("http://socket/", json={"input": "Input Text", "model": model})
+
+    def test_routes_requests_by_model_and_unloads_idle_models_over_the_memory_budget(self):
+        expected = {"generated_text": "Input Texttttazazazazazazazazaz"}
+        for model in (None, self._other_model, TEXT_TRANSFORM_TEST_MODEL):
+            response = self._submit(model)
+            response.raise_for_status()
+            self.assertEqual(expected, response.json())
+        metrics = self._client.get("http://socket/metrics").text
+        # Loading a model unloads the other as the budget is smaller than either
+        self.assertIn("wrangler_models_loaded 1.0\n", metrics)
+
+    def test_requests_for_models_not_hosted_are_not_found(self):
+        self.assertEqual(404, self._submit("unknown").status_code)
+
+
+class CliServeTextTransformTracingIntegrationTestCase(unittest.TestCase, ServerManager):
+    """Tests from the CLI serve entrypoint to request traces and model profiles"""
+
+    def setUp(self):
+        td = TemporaryDirectory()
+        self._directory = pathlib.Path(td.__enter__())
+        self.addCleanup(td.__exit__, None, None, None)
+        socket_filename = str(self._directory / "wrangler.sock")
+        command_args = [
+            "--trace-file",
+            str(self._directory / "trace.json"),
+            "--profile-dir",
+            str(self._directory / "profiles"),
+            "text-transform",
+            TEXT_TRANSFORM_TEST_MODEL,
+        ]
+        self.start_server(socket_filename, command_args)
+
+        transport = httpx.HTTPTransport(uds=socket_filename)
+        self._client = httpx.Client(transport=transport, timeout=30.0)
+
+    def tearDown(self) -> None:
+        self.stop_server()
+
+    def _wait_for(self, condition):
+        start = time.perf_counter()
+        while not condition() and time.perf_counter() - start < 30.0:
+            time.sleep(0.05)
+
+    def test_traces_requests_and_profiles_the_next_requests_on_demand(self):
+        self._client.post("http://socket/", json={"input": "Input Text"}).raise_for_status()
+        trace_file = self._directory / "trace.json"
+        # The trace is readable while the server runs, before its closing bracket
+        self._wait_for(lambda: "event loop" in trace_file.read_text())
+        events = json.loads(trace_file.read_text() + "]")
+        names = {event["name"] for event in events if event["ph"] == "b"}
+        self.assertEqual(
+            {"request", "queue", "model", "tokenize", "generate", "decode", "response hop"},
+            names - {"event loop"},
+        )
+
+        response = self._client.post("http://socket/admin/profile", params={"requests": 1})
+        self.assertEqual(202, response.status_code, response.text)
+        self.assertEqual(1, response.json()["workers"])
+        self._client.post("http://socket/", json={"input": "Input Text"}).raise_for_status()
+        profiles = self._directory / "profiles"
+        # The profiler writes a temporary file which it renames once the trace is complete
+        self._wait_for(lambda: profiles.exists() and any(profiles.glob("*.json")))
+        (profile,) = profiles.glob("*.json")
+        self.assertIn("traceEvents", json.loads(profile.read_text()))
+
 
 class CliServeImageGenerateIntegrationTestCase(unittest.TestCase, ServerManager):
     """Tests from the CLI serve entrypoint to the model handler"""
@@ -191,6 +609,15 @@ class CliServeImageGenerateIntegrationTestCase(unittest.TestCase, ServerManager)
         image = Image.open(bytesio)
         image.verify()
 
+    def test_submit_request_accepting_png_returns_image_bytes(self):
+        response = self._client.post(
+            "http://socket/", json={"input": "Input Text"}, headers={"Accept": "image/png"}
+        )
+        response.raise_for_status()
+        self.assertEqual("image/png", response.headers.get("content-type"))
+        image = Image.open(BytesIO(response.content))
+        image.verify()
+
 
 if __name__ == "__main__":
     unittest.main()
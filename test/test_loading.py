@@ -0,0 +1,82 @@
+import pathlib
+import unittest
+from tempfile import TemporaryDirectory
+from unittest.mock import patch
+
+import torch
+from safetensors.torch import load_file, save_file
+
+from wrangler.loading import model_source, safetensors_model
+from wrangler.model_handlers import TextTransformModelHandler
+from wrangler.models import TextTransformRequest
+from test.test_integration import TEXT_TRANSFORM_TEST_MODEL
+
+
+class SafetensorsModelTestCase(unittest.TestCase):
+    def setUp(self):
+        temporary_directory = TemporaryDirectory()
+        self.addCleanup(temporary_directory.cleanup)
+        self._directory = pathlib.Path(temporary_directory.name)
+        self._model = self._directory.joinpath("model")
+        self._model.joinpath("unet").mkdir(parents=True)
+        self._model.joinpath("config.json").write_text("{}")
+        weight = torch.arange(6, dtype=torch.float32).reshape(2, 3)
+        # Tied weights share memory in the checkpoint
+        torch.save({"a": weight, "b": weight, "c": weight[0]}, self._model / "pytorch_model.bin")
+        torch.save({"d": weight * 2}, self._model / "unet" / "diffusion_pytorch_model.bin")
+        self._cache = self._directory.joinpath("cache")
+
+    def test_converts_checkpoints_to_safetensors_beside_links_to_other_files(self):
+        converted = pathlib.Path(safetensors_model(str(self._model), None, self._cache))
+        self.assertEqual(self._cache, converted.parent)
+        tensors = load_file(converted / "model.safetensors")
+        self.assertEqual(["a", "b", "c"], sorted(tensors))
+        self.assertTrue(torch.equal(tensors["a"], tensors["b"]))
+        self.assertTrue(torch.equal(tensors["a"][0], tensors["c"]))
+        unet = load_file(converted / "unet" / "diffusion_pytorch_model.safetensors")
+        self.assertEqual([[0.0, 2.0, 4.0], [6.0, 8.0, 10.0]], unet["d"].tolist())
+        self.assertTrue(converted.joinpath("config.json").is_symlink())
+        self.assertFalse(converted.joinpath("pytorch_model.bin").exists())
+
+    def test_converts_checkpoints_without_memory_mapping_on_older_torch(self):
+        load = torch.load
+
+        def load_without_mmap(*args, **kwargs):
+            if "mmap" in kwargs:
+                raise TypeError("load() got an unexpected keyword argument 'mmap'")
+            return load(*args, **kwargs)
+
+        with patch("torch.load", side_effect=load_without_mmap):
+            converted = pathlib.Path(safetensors_model(str(self._model), None, self._cache))
+        self.assertEqual(["a", "b", "c"], sorted(load_file(converted / "model.safetensors")))
+
+    def test_converts_checkpoints_only_once(self):
+        first = safetensors_model(str(self._model), None, self._cache)
+        with patch("wrangler.loading._convert") as convert:
+            second = safetensors_model(str(self._model), None, self._cache)
+        self.assertEqual(first, second)
+        convert.assert_not_called()
+        self.assertEqual(1, len(list(self._cache.iterdir())))
+
+    def test_uses_models_with_safetensors_weights_in_place(self):
+        model = self._directory.joinpath("safetensors")
+        model.mkdir()
+        save_file({"a": torch.zeros(2)}, str(model / "model.safetensors"))
+        self.assertEqual(str(model.resolve()), safetensors_model(str(model), None, self._cache))
+        self.assertFalse(self._cache.exists())
+
+    def test_model_source_is_the_model_without_a_fast_load_cache(self):
+        self.assertEqual(("model", "revision"), model_source("model", "revision", None))
+
+
+class FastLoadTestCase(unittest.TestCase):
+    def test_fast_loaded_model_generates_the_same_text(self):
+        with TemporaryDirectory() as cache:
+            handler = TextTransformModelHandler(
+                TEXT_TRANSFORM_TEST_MODEL, None, None, fast_load_cache=pathlib.Path(cache)
+            )
+            model, tokenizer = handler._get_model_and_tokenizer()
+            results = handler._generate_results(
+                model, tokenizer, [TextTransformRequest(input="Stuff")]
+            )
+        self.assertEqual([["Stuff set set set set setylganibibibibibibibibib"]], results)
@@ -0,0 +1,108 @@
+import time
+import unittest
+from unittest.mock import patch
+
+from wrangler.metrics import Counter, Gauge, Histogram, Metrics, Timings
+
+
+class CounterTestCase(unittest.TestCase):
+    def test_renders_value_of_each_label(self):
+        counter = Counter("requests_total", "Requests", ("result",))
+        counter.inc(result="success")
+        counter.inc(2, result="error")
+        self.assertEqual(
+            [
+                "# HELP requests_total Requests",
+                "# TYPE requests_total counter",
+                'requests_total{result="error"} 2.0',
+                'requests_total{result="success"} 1.0',
+            ],
+            counter.render(),
+        )
+
+    def test_escapes_label_values(self):
+        counter = Counter("requests_total", "Requests", ("result",))
+        counter.inc(result='a"b\\c')
+        self.assertEqual('requests_total{result="a\\"b\\\\c"} 1.0', counter.render()[-1])
+
+
+class GaugeTestCase(unittest.TestCase):
+    def test_renders_collected_value(self):
+        gauge = Gauge("in_flight", "In flight", lambda: 3)
+        self.assertEqual("in_flight 3.0", gauge.render()[-1])
+
+    def test_renders_collected_labelled_values(self):
+        gauge = Gauge("memory", "Memory", lambda: {"1": 20, "0": 10}, label_name="worker")
+        self.assertEqual(['memory{worker="0"} 10.0', 'memory{worker="1"} 20.0'], gauge.render()[2:])
+
+
+class HistogramTestCase(unittest.TestCase):
+    def test_renders_cumulative_buckets(self):
+        histogram = Histogram("latency", "Latency", (0.1, 1.0))
+        histogram.observe(0.05)
+        histogram.observe(0.5)
+        histogram.observe(5.0)
+        self.assertEqual(
+            [
+                'latency_bucket{le="0.1"} 1',
+                'latency_bucket{le="1.0"} 2',
+                'latency_bucket{le="+Inf"} 3',
+                "latency_sum 5.55",
+                "latency_count 3",
+            ],
+            histogram.render()[2:],
+        )
+
+
+class MetricsTestCase(unittest.TestCase):
+    def test_observe_timings_records_queue_wait_and_model_timings(self):
+        metrics = Metrics()
+        metrics.observe_timings(
+            Timings(started=10.5, model=0.2, tokenize=0.01, decode=0.02, tokens=6, batch_size=3),
+            submitted=10.0,
+        )
+        self.assertEqual(1, metrics.queue_wait.count)
+        self.assertEqual(1, metrics.model.count)
+        self.assertEqual(1, metrics.tokenize.count)
+        self.assertEqual(1, metrics.batch_size.count)
+        self.assertEqual(6, metrics.tokens.value())
+        self.assertIn("wrangler_queue_wait_seconds_sum 0.5\n", metrics.render())
+
+    def test_observe_timings_skips_timings_not_measured(self):
+        metrics = Metrics()
+        metrics.observe_timings(Timings(started=10.0, model=0.2), submitted=10.0)
+        self.assertEqual(0, metrics.tokenize.count)
+        self.assertEqual(0, metrics.decode.count)
+        self.assertEqual(0, metrics.tokens.value())
+
+    def test_observe_timings_records_drafted_tokens(self):
+        metrics = Metrics()
+        metrics.observe_timings(
+            Timings(started=10.0, tokens=6, draft_tokens=6, accepted_tokens=4, model_passes=2),
+            submitted=10.0,
+        )
+        self.assertEqual(4, metrics.draft_tokens.value(result="accepted"))
+        self.assertEqual(2, metrics.draft_tokens.value(result="rejected"))
+        self.assertIn("wrangler_tokens_per_model_pass_sum 3.0\n", metrics.render())
+
+    def test_observe_timings_skips_draft_metrics_without_a_draft_model(self):
+        metrics = Metrics()
+        metrics.observe_timings(Timings(started=10.0, tokens=6), submitted=10.0)
+        self.assertEqual(0, metrics.tokens_per_model_pass.count)
+
+    def test_tokens_per_second_averages_over_window(self):
+        metrics = Metrics(tokens_per_second_window=10.0)
+        metrics.observe_timings(Timings(started=time.monotonic(), tokens=50), time.monotonic())
+        self.assertEqual(5.0, metrics.tokens_per_second())
+
+    def test_recent_tokens_stay_within_window_when_not_read(self):
+        metrics = Metrics(tokens_per_second_window=10.0)
+        for second in range(100):
+            with patch("time.monotonic", return_value=float(second)):
+                metrics.observe_timings(Timings(started=float(second), tokens=1), float(second))
+        self.assertEqual(11, len(metrics._recent_tokens))
+
+    def test_render_includes_added_gauges(self):
+        metrics = Metrics()
+        metrics.add_gauge(Gauge("wrangler_requests_in_flight", "In flight", lambda: 0))
+        self.assertIn("wrangler_requests_in_flight 0.0\n", metrics.render())
@@ -0,0 +1,403 @@
+import copy
+import json
+import multiprocessing as mp
+import queue
+import tempfile
+import time
+import unittest
+from pathlib import Path
+from types import SimpleNamespace
+from unittest.mock import patch
+from uuid import uuid4
+
+import torch
+from PIL import Image
+from pydantic import ValidationError
+from transformers import GenerationConfig
+
+from wrangler.metrics import Timings
+from wrangler.model_handlers import (
+    ControlMessages,
+    DraftModel,
+    ImageGenerateModelHandler,
+    ModelHandler,
+    ModelReady,
+    ProfileRequests,
+    RequestProfiler,
+    RunImageGeneratePromptsInput,
+    TextTransformModelHandler,
+    _ResponseStreamer,
+)
+from wrangler.models import ImageFormat, ImageGenerateRequest, TextTransformRequest
+from wrangler.prefix_cache import PrefixCache
+from test.test_integration import TEXT_TRANSFORM_TEST_MODEL
+
+
+class GetRequestBatchTestCase(unittest.TestCase):
+    def setUp(self):
+        self._request_queue = mp.Queue()
+
+    def tearDown(self):
+        self._request_queue.close()
+
+    def test_returns_up_to_max_batch_size_requests(self):
+        items = [(uuid4(), f"request {index}", None) for index in range(3)]
+        for item in items:
+            self._request_queue.put(item)
+        time.sleep(0.1)  # Let the queue's feeder thread flush the items
+        batch = ModelHandler._get_request_batch(self._request_queue, 2, 0.0)
+        self.assertEqual([(request_id, request) for request_id, request, _ in items[:2]], batch)
+
+    def test_drops_requests_whose_deadline_has_passed(self):
+        expired = (uuid4(), "expired", time.monotonic() - 1.0)
+        unexpired = (uuid4(), "unexpired", time.monotonic() + 60.0)
+        self._request_queue.put(expired)
+        self._request_queue.put(unexpired)
+        time.sleep(0.1)  # Let the queue's feeder thread flush the items
+        batch = ModelHandler._get_request_batch(self._request_queue, 2, 0.0)
+        self.assertEqual([(unexpired[0], "unexpired")], batch)
+
+
+class TextTransformIsDeterministicTestCase(unittest.TestCase):
+    def _handler(self, generation_config=None):
+        handler = TextTransformModelHandler(TEXT_TRANSFORM_TEST_MODEL, None, None)
+        if generation_config is None:
+            handler.prepare()
+        else:
+            with patch.object(GenerationConfig, "from_pretrained", return_value=generation_config):
+                handler.prepare()
+        return handler
+
+    def test_greedy_generation_is_deterministic(self):
+        self.assertTrue(self._handler().is_deterministic(TextTransformRequest(input="input")))
+
+    def test_sampling_generation_is_not_deterministic(self):
+        handler = self._handler(GenerationConfig(do_sample=True))
+        self.assertFalse(handler.is_deterministic(TextTransformRequest(input="input")))
+
+    def test_requested_sampling_overrides_generation_config(self):
+        handler = self._handler(GenerationConfig(do_sample=True))
+        self.assertTrue(
+            handler.is_deterministic(TextTransformRequest(input="input", do_sample=False))
+        )
+        self.assertFalse(
+            self._handler().is_deterministic(TextTransformRequest(input="input", do_sample=True))
+        )
+
+    def test_is_not_deterministic_without_generation_config_unless_greedy_is_requested(self):
+        handler = TextTransformModelHandler(TEXT_TRANSFORM_TEST_MODEL, None, None)
+        with patch.object(GenerationConfig, "from_pretrained") as from_pretrained:
+            self.assertFalse(handler.is_deterministic(TextTransformRequest(input="input")))
+            self.assertTrue(
+                handler.is_deterministic(TextTransformRequest(input="input", do_sample=False))
+            )
+        from_pretrained.assert_not_called()
+
+
+class GenerateResultsTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls) -> None:
+        handler = TextTransformModelHandler(TEXT_TRANSFORM_TEST_MODEL, None, None)
+        cls.model, cls.tokenizer = handler._get_model_and_tokenizer()
+
+    def _generate(self, requests, timings=None, **kwargs):
+        return TextTransformModelHandler._generate_results(
+            self.model, self.tokenizer, requests, timings, **kwargs
+        )
+
+    def test_results_match_generate_without_prefix_cache(self):
+        prefix_cache = PrefixCache(max_bytes=10_000_000)
+        for input_ in ["Input Text", "Input Text and more", "Input Text and less", "Stuff"]:
+            expected = self._generate([TextTransformRequest(input=input_)])
+            for _ in range(2):
+                actual = self._generate(
+                    [TextTransformRequest(input=input_)], prefix_cache=prefix_cache
+                )
+                self.assertEqual(expected, actual)
+        self.assertGreater(len(prefix_cache), 0)
+
+    def test_max_new_tokens_limits_generated_tokens(self):
+        timings = [Timings(started=0.0)]
+        results = self._generate(
+            [TextTransformRequest(input="Input Text", max_new_tokens=3)], timings
+        )
+        self.assertEqual([["Input Textttt"]], results)
+        self.assertEqual(3, timings[0].tokens)
+
+    def test_results_are_cut_at_the_first_stop_string(self):
+        results = self._generate([TextTransformRequest(input="Input Text", stop=["za", "az"])])
+        self.assertEqual([["Input Textttt"]], results)
+
+    def test_batched_results_match_results_generated_alone(self):
+        requests = [
+            TextTransformRequest(input="Input Text", max_new_tokens=4),
+            TextTransformRequest(input="Stuff", stop=["yl"]),
+            TextTransformRequest(input="hi"),
+        ]
+        expected = [self._generate([request])[0] for request in requests]
+        self.assertEqual(expected, self._generate(requests))
+
+    def test_samples_num_return_sequences_when_generation_config_samples(self):
+        request = TextTransformRequest(input="Input Text", num_return_sequences=2, max_new_tokens=4)
+        generation_config = self.model.generation_config
+        # Generation configs derived from the model config are rebuilt by generate
+        with patch.object(generation_config, "do_sample", True), patch.object(
+            generation_config, "_from_model_config", False
+        ):
+            (sequences,) = self._generate([request])
+        self.assertEqual(2, len(sequences))
+        with self.assertRaisesRegex(ValueError, "requires do_sample"):
+            self._generate([request])
+
+    def test_samples_num_return_sequences_for_each_request(self):
+        requests = [
+            TextTransformRequest(
+                input=input_, do_sample=True, num_return_sequences=3, max_new_tokens=4
+            )
+            for input_ in ["Input Text", "Stuff"]
+        ]
+        results = self._generate(requests)
+        self.assertEqual([3, 3], [len(sequences) for sequences in results])
+        for request, sequences in zip(requests, results, strict=True):
+            for sequence in sequences:
+                self.assertTrue(sequence.startswith(request.input))
+
+
+class DraftModelTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls) -> None:
+        handler = TextTransformModelHandler(TEXT_TRANSFORM_TEST_MODEL, None, None)
+        cls.model, cls.tokenizer = handler._get_model_and_tokenizer()
+        # A slightly different copy of the model drafts tokens it mostly agrees with
+        draft = copy.deepcopy(cls.model)
+        generator = torch.Generator().manual_seed(0)
+        with torch.no_grad():
+            for parameter in draft.parameters():
+                parameter.add_(torch.randn(parameter.shape, generator=generator) * 0.001)
+        cls.draft_model = DraftModel(cls.model, draft)
+
+    def _generate(self, requests, timings=None, draft_model=None):
+        return TextTransformModelHandler._generate_results(
+            self.model, self.tokenizer, requests, timings, draft_model=draft_model
+        )
+
+    def test_greedy_results_match_generate_without_draft_model(self):
+        for input_ in ["Input Text", "Stuff", "hi"]:
+            with self.subTest(input_):
+                request = TextTransformRequest(input=input_, max_new_tokens=12)
+                timings = [Timings(started=0.0)]
+                self.assertEqual(
+                    self._generate([request]),
+                    self._generate([request], timings, self.draft_model),
+                )
+                timing = timings[0]
+                self.assertGreater(timing.draft_tokens, 0)
+                self.assertLessEqual(timing.accepted_tokens, timing.draft_tokens)
+                self.assertEqual(timing.tokens, timing.accepted_tokens + timing.model_passes)
+
+    def test_batches_are_generated_without_draft_model(self):
+        requests = [TextTransformRequest(input="Input Text"), TextTransformRequest(input="hi")]
+        timings = [Timings(started=0.0) for _ in requests]
+        self.assertEqual(
+            self._generate(requests), self._generate(requests, timings, self.draft_model)
+        )
+        self.assertEqual([0, 0], [timing.model_passes for timing in timings])
+
+    def test_rejects_continuous_batching(self):
+        with self.assertRaises(ValueError):
+            TextTransformModelHandler(
+                TEXT_TRANSFORM_TEST_MODEL, None, None, continuous_batching=True, draft_model="d"
+            )
+
+
+class TextTransformRequestTestCase(unittest.TestCase):
+    def test_several_sequences_require_sampling_unless_left_to_the_generation_config(self):
+        with self.assertRaises(ValidationError):
+            TextTransformRequest(input="input", do_sample=False, num_return_sequences=2)
+        self.assertIsNone(TextTransformRequest(input="input", num_return_sequences=2).do_sample)
+
+
+class GroupRequestsTestCase(unittest.TestCase):
+    def test_groups_requests_with_the_same_sampling_parameters(self):
+        batch = [
+            (0, TextTransformRequest(input="a", max_new_tokens=1)),
+            (1, TextTransformRequest(input="b", do_sample=True, temperature=0.5)),
+            (2, TextTransformRequest(input="c", stop=["."])),
+            (3, TextTransformRequest(input="d", do_sample=True, temperature=0.5)),
+        ]
+        groups = TextTransformModelHandler._group_requests(batch)
+        self.assertEqual([[0, 2], [1, 3]], [[index for index, _ in group] for group in groups])
+
+    def test_groups_image_requests_with_the_same_steps_and_size(self):
+        batch = [
+            (0, ImageGenerateRequest(input="a", seed=1)),
+            (1, ImageGenerateRequest(input="b", width=64)),
+            (2, ImageGenerateRequest(input="c", num_images_per_prompt=2)),
+            (3, ImageGenerateRequest(input="d", num_inference_steps=2)),
+        ]
+        groups = ImageGenerateModelHandler._group_requests(batch)
+        self.assertEqual([[0, 2], [1], [3]], [[index for index, _ in group] for group in groups])
+
+
+class _Pipeline:
+    """Stand in for a diffusion pipeline which generates an image from each generator"""
+
+    device = torch.device("cpu")
+
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, prompts, generator, **kwargs):
+        self.calls.append((prompts, kwargs))
+        images = [
+            Image.new("L", (1, 1), int(torch.randint(256, (1,), generator=generator_)))
+            for generator_ in generator
+        ]
+        return SimpleNamespace(images=images)
+
+
+class GenerateImagesTestCase(unittest.TestCase):
+    def setUp(self):
+        self._pipeline = _Pipeline()
+
+    def _generate(self, requests, timings=None):
+        return ImageGenerateModelHandler._generate_images(self._pipeline, requests, timings)
+
+    def test_generates_every_image_of_the_batch_with_one_pipeline_call(self):
+        requests = [
+            ImageGenerateRequest(input="a", num_images_per_prompt=2, num_inference_steps=3),
+            ImageGenerateRequest(input="b", num_inference_steps=3),
+        ]
+        timings = [Timings(started=0.0), Timings(started=0.0)]
+        results = self._generate(requests, timings)
+        self.assertEqual([2, 1], [len(images) for images in results])
+        self.assertEqual([(["a", "a", "b"], {"num_inference_steps": 3})], self._pipeline.calls)
+        self.assertEqual([2, 2], [timing.batch_size for timing in timings])
+
+    def test_seeded_request_generates_the_same_images_when_batched(self):
+        request = ImageGenerateRequest(input="a", num_images_per_prompt=2, seed=7)
+        (alone,) = self._generate([request])
+        _, batched = self._generate([ImageGenerateRequest(input="b", seed=1), request])
+        self.assertEqual(
+            [image.getpixel((0, 0)) for image in alone],
+            [image.getpixel((0, 0)) for image in batched],
+        )
+        self.assertNotEqual(alone[0].getpixel((0, 0)), alone[1].getpixel((0, 0)))
+
+
+class RunImageGeneratePromptsTestCase(unittest.TestCase):
+    def test_writes_a_numbered_image_for_each_prompt(self):
+        handler = ImageGenerateModelHandler("model", None)
+        pipeline = _Pipeline()
+        with tempfile.TemporaryDirectory() as directory, patch.object(
+            handler, "_get_pipeline", return_value=pipeline
+        ), patch("click.echo") as echo:
+            output_directory = Path(directory, "images")
+            handler.run(
+                RunImageGeneratePromptsInput(
+                    inputs=["a", "b", "c"],
+                    output_directory=output_directory,
+                    format=ImageFormat.jpg,
+                )
+            )
+            self.assertEqual(
+                ["000001.jpg", "000002.jpg", "000003.jpg"],
+                sorted(path.name for path in output_directory.iterdir()),
+            )
+            self.assertEqual("JPEG", Image.open(output_directory.joinpath("000001.jpg")).format)
+        self.assertEqual([(["a"], {}), (["b"], {}), (["c"], {})], pipeline.calls)
+        self.assertRegex(
+            echo.call_args.args[0],
+            r"Generated 3 images in [\d.]+s, [\d.]+ images/s, spending [\d.]+s in the pipeline "
+            r"and [\d.]+s encoding and writing images",
+        )
+
+
+class WarmUpTestCase(unittest.TestCase):
+    def test_reports_ready_after_generating_from_the_warm_up_inputs(self):
+        response_queue = queue.Queue()
+        generated = []
+
+        def generate(inputs):
+            # Ready must not be reported until generation has finished
+            self.assertTrue(response_queue.empty())
+            generated.append(inputs)
+
+        ModelHandler._warm_up(("a", "b"), generate, response_queue)
+        self.assertEqual([["a", "b"]], generated)
+        request_id, response, timings = response_queue.get_nowait()
+        self.assertIsInstance(response, ModelReady)
+        self.assertTrue(response_queue.empty())
+
+    def test_reports_ready_without_generating_when_there_are_no_warm_up_inputs(self):
+        response_queue = queue.Queue()
+        ModelHandler._warm_up((), self.fail, response_queue)
+        self.assertIsInstance(response_queue.get_nowait()[1], ModelReady)
+
+
+class ControlMessagesTestCase(unittest.TestCase):
+    def test_passes_profiling_requests_to_the_profiler(self):
+        control_queue = queue.Queue()
+        control_messages = ControlMessages(control_queue)
+        request_id = uuid4()
+        control_queue.put(request_id)
+        control_queue.put(ProfileRequests(2, Path("profiles")))
+        with patch.object(control_messages.profiler, "request") as request:
+            self.assertEqual([request_id], control_messages.poll())
+        request.assert_called_once_with(ProfileRequests(2, Path("profiles")))
+        self.assertIn(request_id, control_messages)
+
+
+class RequestProfilerTestCase(unittest.TestCase):
+    def setUp(self):
+        self._directory = tempfile.TemporaryDirectory()
+        self._profiles = Path(self._directory.name, "profiles")
+
+    def tearDown(self):
+        self._directory.cleanup()
+
+    def test_writes_a_chrome_trace_once_the_requests_have_finished(self):
+        profiler = RequestProfiler()
+        profiler.request(ProfileRequests(3, self._profiles))
+        profiler.start()
+        torch.ones(4) @ torch.ones(4)
+        profiler.finished(2)
+        self.assertFalse(self._profiles.exists())
+        profiler.start()
+        profiler.finished()
+        (profile,) = self._profiles.iterdir()
+        self.assertIn("traceEvents", json.loads(profile.read_text()))
+        # Only the requested requests are profiled
+        profiler.start()
+        profiler.finished()
+        self.assertEqual(1, len(list(self._profiles.iterdir())))
+
+    def test_does_nothing_unless_asked_to_profile(self):
+        profiler = RequestProfiler()
+        profiler.start()
+        profiler.finished()
+        self.assertFalse(self._profiles.exists())
+
+
+class ResponseStreamerTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls) -> None:
+        handler = TextTransformModelHandler(TEXT_TRANSFORM_TEST_MODEL, None, None)
+        _, cls.tokenizer = handler._get_model_and_tokenizer()
+
+    def _stream(self, text, stop):
+        response_queue = queue.Queue()
+        streamer = _ResponseStreamer(self.tokenizer, uuid4(), response_queue, False, stop)
+        for token_id in self.tokenizer(text)["input_ids"]:
+            streamer.put(torch.tensor([token_id]))
+        streamer.end()
+        chunks = []
+        while not response_queue.empty():
+            chunks.append(response_queue.get()[1].text)
+        return chunks
+
+    def test_streams_all_text_without_stop_strings(self):
+        self.assertEqual("tttazazaz", "".join(self._stream("tttazazaz", None)))
+
+    def test_does_not_stream_stop_string_or_text_after_it(self):
+        self.assertEqual("ttta", "".join(self._stream("tttazazaz", ["za"])))
@@ -0,0 +1,82 @@
+import unittest
+from unittest.mock import MagicMock, patch
+
+import torch
+from torch import nn
+from torch.ao.nn.quantized.dynamic import Linear as DynamicQuantizedLinear
+
+from wrangler.model_handlers import ImageGenerateModelHandler, TextTransformModelHandler
+from wrangler.models import TextTransformRequest
+from wrangler.precision import check_precision, quantize_module
+from test.test_integration import TEXT_TRANSFORM_TEST_MODEL
+
+
+class CheckPrecisionTestCase(unittest.TestCase):
+    def test_accepts_every_dtype_without_quantization(self):
+        for dtype in ("fp32", "bf16", "fp16"):
+            check_precision(dtype, None)
+
+    def test_quantization_requires_fp32(self):
+        check_precision("fp32", "dynamic-int8")
+        with self.assertRaisesRegex(ValueError, "requires fp32"):
+            check_precision("bf16", "dynamic-int8")
+
+    def test_rejects_unknown_names(self):
+        with self.assertRaises(ValueError):
+            check_precision("int4", None)
+        with self.assertRaises(ValueError):
+            check_precision("fp32", "static-int8")
+
+
+class TextTransformPrecisionTestCase(unittest.TestCase):
+    def _handler(self, **kwargs):
+        handler = TextTransformModelHandler(TEXT_TRANSFORM_TEST_MODEL, None, None, **kwargs)
+        model, tokenizer = handler._get_model_and_tokenizer()
+        return handler, model, tokenizer
+
+    def test_dynamic_int8_quantizes_linear_layers_except_the_output_embeddings(self):
+        handler, model, tokenizer = self._handler(quantize="dynamic-int8")
+        block = model.transformer.h[0]
+        for layer in (block.attn.c_attn, block.attn.c_proj, block.mlp.c_fc, block.mlp.c_proj):
+            self.assertIsInstance(layer, DynamicQuantizedLinear)
+        self.assertIsInstance(model.lm_head, nn.Linear)
+        results = handler._generate_results(model, tokenizer, [TextTransformRequest(input="Stuff")])
+        self.assertEqual([["Stuff set set set set setylganibibibibibibibibib"]], results)
+
+    def test_quantized_logits_stay_close_to_fp32(self):
+        _, model, tokenizer = self._handler()
+        inputs = tokenizer("How now brown cow", return_tensors="pt")
+        with torch.no_grad():
+            expected = model(**inputs).logits
+            actual = quantize_module(model, "dynamic-int8")(**inputs).logits
+        self.assertLess((expected - actual).abs().max().item(), 0.1)
+
+    def test_bf16_loads_weights_in_bf16(self):
+        handler, model, tokenizer = self._handler(dtype="bf16")
+        self.assertEqual(torch.bfloat16, model.transformer.h[0].mlp.c_fc.weight.dtype)
+        results = handler._generate_results(model, tokenizer, [TextTransformRequest(input="Stuff")])
+        self.assertEqual(1, len(results[0]))
+
+
+class ImageGeneratePrecisionTestCase(unittest.TestCase):
+    def test_quantizes_the_unet_and_text_encoder(self):
+        pipeline = MagicMock(
+            unet=nn.Sequential(nn.Linear(4, 4)),
+            text_encoder=nn.Sequential(nn.Linear(4, 4)),
+            vae=nn.Sequential(nn.Linear(4, 4)),
+            text_encoder_2=None,
+        )
+        pipeline.to.return_value = pipeline
+        handler = ImageGenerateModelHandler("model", None, quantize="dynamic-int8")
+        with patch("diffusers.DiffusionPipeline.from_pretrained", return_value=pipeline) as load:
+            handler._get_pipeline()
+        self.assertEqual(torch.float32, load.call_args.kwargs["torch_dtype"])
+        self.assertIsInstance(pipeline.unet[0], DynamicQuantizedLinear)
+        self.assertIsInstance(pipeline.text_encoder[0], DynamicQuantizedLinear)
+        self.assertIsInstance(pipeline.vae[0], nn.Linear)
+
+    def test_loads_the_pipeline_in_the_dtype(self):
+        handler = ImageGenerateModelHandler("model", None, dtype="bf16")
+        with patch("diffusers.DiffusionPipeline.from_pretrained") as load:
+            handler._get_pipeline()
+        self.assertEqual(torch.bfloat16, load.call_args.kwargs["torch_dtype"])
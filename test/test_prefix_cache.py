@@ -0,0 +1,80 @@
+import unittest
+
+import torch
+
+from wrangler.prefix_cache import PrefixCache
+
+LAYERS = 2
+HEADS = 2
+HEAD_SIZE = 4
+# Bytes of the keys and values of all layers for a single token
+TOKEN_SIZE = LAYERS * 2 * HEADS * HEAD_SIZE * 4
+
+
+def _past_key_values(token_ids):
+    # Each cache entry holds its token ID so slices can be checked
+    entries = torch.tensor(token_ids, dtype=torch.float32)[None, None, :, None]
+    entries = entries.expand(1, HEADS, len(token_ids), HEAD_SIZE)
+    return tuple((entries.clone(), entries.clone()) for _ in range(LAYERS))
+
+
+class PrefixCacheTestCase(unittest.TestCase):
+    def _insert(self, prefix_cache, token_ids):
+        prefix_cache.insert(token_ids, _past_key_values(token_ids))
+
+    def test_lookup_returns_kv_cache_of_longest_shared_prefix(self):
+        prefix_cache = PrefixCache(max_bytes=100 * TOKEN_SIZE)
+        self._insert(prefix_cache, [1, 2, 3, 4])
+        self._insert(prefix_cache, [1, 2, 5])
+        length, past_key_values = prefix_cache.lookup([1, 2, 3, 9])
+        self.assertEqual(3, length)
+        for key, value in past_key_values:
+            self.assertEqual([1.0, 2.0, 3.0], key[0, 0, :, 0].tolist())
+            self.assertEqual([1.0, 2.0, 3.0], value[0, 0, :, 0].tolist())
+
+    def test_lookup_returns_nothing_without_shared_prefix(self):
+        prefix_cache = PrefixCache(max_bytes=100 * TOKEN_SIZE)
+        self._insert(prefix_cache, [1, 2, 3])
+        self.assertEqual((0, None), prefix_cache.lookup([2, 3]))
+
+    def test_insert_skips_sequences_already_held_as_a_prefix(self):
+        prefix_cache = PrefixCache(max_bytes=100 * TOKEN_SIZE)
+        self._insert(prefix_cache, [1, 2, 3])
+        self._insert(prefix_cache, [1, 2])
+        self.assertEqual(1, len(prefix_cache))
+        self.assertEqual(3 * TOKEN_SIZE, prefix_cache.size)
+
+    def test_insert_replaces_cached_prefixes_of_the_sequence(self):
+        prefix_cache = PrefixCache(max_bytes=100 * TOKEN_SIZE)
+        self._insert(prefix_cache, [1, 2])
+        self._insert(prefix_cache, [1, 2, 3])
+        self.assertEqual(1, len(prefix_cache))
+        self.assertEqual(3 * TOKEN_SIZE, prefix_cache.size)
+        self.assertEqual(2, prefix_cache.lookup([1, 2])[0])
+
+    def test_evicts_least_recently_used_sequences_to_stay_within_budget(self):
+        prefix_cache = PrefixCache(max_bytes=6 * TOKEN_SIZE)
+        self._insert(prefix_cache, [1, 2, 3])
+        self._insert(prefix_cache, [4, 5])
+        prefix_cache.lookup([1])
+        self._insert(prefix_cache, [6, 7])
+        self.assertEqual(5 * TOKEN_SIZE, prefix_cache.size)
+        self.assertEqual(3, prefix_cache.lookup([1, 2, 3])[0])
+        self.assertEqual(0, prefix_cache.lookup([4, 5])[0])
+        self.assertEqual(2, prefix_cache.lookup([6, 7])[0])
+
+    def test_eviction_keeps_prefixes_shared_with_remaining_sequences(self):
+        prefix_cache = PrefixCache(max_bytes=7 * TOKEN_SIZE)
+        self._insert(prefix_cache, [1, 2, 3])
+        self._insert(prefix_cache, [1, 2, 4, 5])
+        self._insert(prefix_cache, [6, 7, 8])
+        self.assertEqual(2, prefix_cache.lookup([1, 2, 3])[0])
+        length, past_key_values = prefix_cache.lookup([1, 2, 4, 5])
+        self.assertEqual(4, length)
+        self.assertEqual([1.0, 2.0, 4.0, 5.0], past_key_values[0][0][0, 0, :, 0].tolist())
+
+    def test_does_not_cache_sequences_larger_than_budget(self):
+        prefix_cache = PrefixCache(max_bytes=2 * TOKEN_SIZE)
+        self._insert(prefix_cache, [1, 2, 3])
+        self.assertEqual(0, len(prefix_cache))
+        self.assertEqual((0, None), prefix_cache.lookup([1, 2, 3]))
@@ -0,0 +1,353 @@
+import asyncio
+import base64
+import threading
+import time
+import unittest
+from io import BytesIO
+from unittest.mock import ANY, MagicMock, patch
+
+from fastapi import HTTPException
+from fastapi.responses import Response
+from PIL import Image
+
+from wrangler.cache import ResponseCache
+from wrangler.images import SharedImage
+from wrangler.metrics import Metrics
+from wrangler.models import (
+    ImageFormat,
+    ImageGenerateRequest,
+    ImageGenerateResponse,
+    TextTransformRequest,
+    TextTransformResponse,
+    TextTransformStreamRequest,
+    TextTransformToken,
+)
+from wrangler.request_handlers import (
+    ImageGenerateRequestHandler,
+    TextTransformRequestHandler,
+    TextTransformStreamRequestHandler,
+)
+from wrangler.workers import QueueFullError, WorkerPoolFailedError
+
+
+class _HttpRequest:
+    """Stand in for a Starlette request whose client may disconnect"""
+
+    def __init__(self, headers=None):
+        self.headers = headers or {}
+        self.disconnected = asyncio.Event()
+
+    async def receive(self):
+        await self.disconnected.wait()
+        return {"type": "http.disconnect"}
+
+
+class RequestHandlerTestCase(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self._worker_pool = MagicMock()
+        self._worker_pool.available = True
+        self._worker_pool.failed = False
+        self._worker_pool.restart_delay = 1.5
+        self._request_future_map = {}
+        self._http_request = _HttpRequest()
+        self._metrics = Metrics()
+
+    def _handler(self, timeout=None):
+        return TextTransformRequestHandler(
+            self._worker_pool, self._request_future_map, timeout=timeout, metrics=self._metrics
+        )
+
+    def _respond(self, response):
+        request_id = self._worker_pool.submit.call_args.args[0]
+        self._request_future_map[request_id].set_result(response)
+
+    async def test_returns_response_and_removes_request(self):
+        expected = TextTransformResponse(generated_text="generated")
+        task = asyncio.create_task(
+            self._handler()(TextTransformRequest(input="input"), self._http_request)
+        )
+        await asyncio.sleep(0)
+        self._respond(expected)
+        self.assertEqual(expected, await task)
+        self.assertEqual({}, self._request_future_map)
+        self._worker_pool.cancel.assert_not_called()
+        self.assertEqual(1, self._metrics.requests.value(result="success"))
+
+    async def test_timeout_cancels_request_and_raises_504(self):
+        with self.assertRaises(HTTPException) as context:
+            await self._handler(timeout=0.01)(
+                TextTransformRequest(input="input"), self._http_request
+            )
+        self.assertEqual(504, context.exception.status_code)
+        self.assertEqual(1, self._metrics.requests.value(result="timeout"))
+        self.assertEqual({}, self._request_future_map)
+        request_id = self._worker_pool.submit.call_args.args[0]
+        self._worker_pool.cancel.assert_called_once_with(request_id)
+
+    async def test_client_disconnect_cancels_request(self):
+        task = asyncio.create_task(
+            self._handler()(TextTransformRequest(input="input"), self._http_request)
+        )
+        await asyncio.sleep(0)
+        self._http_request.disconnected.set()
+        with self.assertRaises(HTTPException) as context:
+            await task
+        self.assertEqual(499, context.exception.status_code)
+        self.assertEqual(1, self._metrics.requests.value(result="disconnected"))
+        self.assertEqual({}, self._request_future_map)
+        request_id = self._worker_pool.submit.call_args.args[0]
+        self._worker_pool.cancel.assert_called_once_with(request_id)
+
+    async def test_handler_cancellation_cancels_request(self):
+        task = asyncio.create_task(
+            self._handler()(TextTransformRequest(input="input"), self._http_request)
+        )
+        await asyncio.sleep(0)
+        task.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await task
+        self.assertEqual({}, self._request_future_map)
+        request_id = self._worker_pool.submit.call_args.args[0]
+        self._worker_pool.cancel.assert_called_once_with(request_id)
+
+    async def test_submits_request_with_deadline_of_timeout(self):
+        request = TextTransformRequest(input="input")
+        task = asyncio.create_task(self._handler(timeout=30.0)(request, self._http_request))
+        await asyncio.sleep(0)
+        request_id, submitted_request, deadline = self._worker_pool.submit.call_args.args
+        self.assertEqual(request, submitted_request)
+        self.assertAlmostEqual(time.monotonic() + 30.0, deadline, delta=1.0)
+        self._respond(TextTransformResponse(generated_text="generated"))
+        await task
+
+    async def test_full_queue_raises_429_with_retry_after(self):
+        self._worker_pool.submit.side_effect = QueueFullError()
+        with self.assertRaises(HTTPException) as context:
+            await self._handler()(TextTransformRequest(input="input"), self._http_request)
+        self.assertEqual(429, context.exception.status_code)
+        self.assertEqual(1, self._metrics.requests.value(result="rejected"))
+        self.assertIn("Retry-After", context.exception.headers)
+        self.assertEqual({}, self._request_future_map)
+
+    async def test_unavailable_workers_raises_503_with_retry_after(self):
+        self._worker_pool.available = False
+        with self.assertRaises(HTTPException) as context:
+            await self._handler()(TextTransformRequest(input="input"), self._http_request)
+        self.assertEqual(503, context.exception.status_code)
+        self.assertEqual(1, self._metrics.requests.value(result="unavailable"))
+        self.assertEqual("2", context.exception.headers["Retry-After"])
+        self._worker_pool.submit.assert_not_called()
+        self.assertEqual({}, self._request_future_map)
+
+    async def test_failed_workers_raises_503_without_retry_after(self):
+        self._worker_pool.available = False
+        self._worker_pool.failed = True
+        self._worker_pool.submit.side_effect = WorkerPoolFailedError("failed to start")
+        with self.assertRaises(HTTPException) as context:
+            await self._handler()(TextTransformRequest(input="input"), self._http_request)
+        self.assertEqual(503, context.exception.status_code)
+        self.assertEqual("failed to start", context.exception.detail)
+        self.assertIsNone(context.exception.headers)
+        self.assertEqual({}, self._request_future_map)
+
+    async def test_caches_responses_and_returns_them_without_submitting(self):
+        response_cache = ResponseCache("model", None, 10_000, lambda request: True)
+        handler = TextTransformRequestHandler(
+            self._worker_pool, self._request_future_map, response_cache=response_cache
+        )
+        expected = TextTransformResponse(generated_text="generated")
+        task = asyncio.create_task(handler(TextTransformRequest(input="input"), self._http_request))
+        await asyncio.sleep(0)
+        self._respond(expected)
+        await task
+        self._worker_pool.submit.reset_mock()
+        self.assertEqual(
+            expected, await handler(TextTransformRequest(input="input"), self._http_request)
+        )
+        self._worker_pool.submit.assert_not_called()
+
+    async def test_does_not_cache_errors(self):
+        response_cache = ResponseCache("model", None, 10_000, lambda request: True)
+        handler = TextTransformRequestHandler(
+            self._worker_pool, self._request_future_map, response_cache=response_cache
+        )
+        task = asyncio.create_task(handler(TextTransformRequest(input="input"), self._http_request))
+        await asyncio.sleep(0)
+        request_id = self._worker_pool.submit.call_args.args[0]
+        self._request_future_map[request_id].set_exception(RuntimeError("failed"))
+        with self.assertRaises(RuntimeError):
+            await task
+        self.assertEqual(0, len(response_cache))
+
+    async def test_records_the_root_span_of_each_request(self):
+        tracer = MagicMock()
+        handler = TextTransformRequestHandler(
+            self._worker_pool, self._request_future_map, tracer=tracer
+        )
+        task = asyncio.create_task(handler(TextTransformRequest(input="input"), self._http_request))
+        await asyncio.sleep(0)
+        self._respond(TextTransformResponse(generated_text="generated"))
+        await task
+        request_id = self._worker_pool.submit.call_args.args[0]
+        tracer.span.assert_called_once_with(
+            request_id,
+            "request",
+            ANY,
+            ANY,
+            parent=None,
+            attributes={"handler": "TextTransformRequestHandler"},
+        )
+
+
+class TextTransformStreamRequestHandlerTestCase(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self._worker_pool = MagicMock()
+        self._worker_pool.available = True
+        self._worker_pool.failed = False
+        self._request_future_map = {}
+        self._metrics = Metrics()
+
+    async def _response(self):
+        handler = TextTransformStreamRequestHandler(
+            self._worker_pool, self._request_future_map, metrics=self._metrics
+        )
+        response = await handler(TextTransformStreamRequest(input="input"))
+        return response, self._worker_pool.submit.call_args.args[0]
+
+    async def test_streams_tokens_and_removes_request(self):
+        response, request_id = await self._response()
+        stream = self._request_future_map[request_id]
+        stream.put_nowait(TextTransformToken(text="a"))
+        stream.put_nowait(TextTransformResponse(generated_text="inputa"))
+        sent = []
+
+        async def send(message):
+            sent.append(message)
+
+        async def receive():
+            await asyncio.Event().wait()
+
+        await response({"type": "http"}, receive, send)
+        body = b"".join(message.get("body", b"") for message in sent)
+        self.assertEqual(b'{"text": "a"}\n{"generated_text": "inputa"}\n', body)
+        self.assertEqual({}, self._request_future_map)
+        self._worker_pool.cancel.assert_not_called()
+        self.assertEqual(1, self._metrics.requests.value(result="success"))
+
+    async def test_disconnect_before_streaming_cancels_request(self):
+        response, request_id = await self._response()
+        started = asyncio.Event()
+
+        async def send(message):
+            # The client disconnects while the response is starting
+            started.set()
+            await asyncio.Event().wait()
+
+        async def receive():
+            await started.wait()
+            return {"type": "http.disconnect"}
+
+        await response({"type": "http"}, receive, send)
+        self.assertEqual({}, self._request_future_map)
+        self._worker_pool.cancel.assert_called_once_with(request_id)
+        self.assertEqual(1, self._metrics.requests.value(result="disconnected"))
+
+
+class ImageGenerateRequestHandlerTestCase(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self._worker_pool = MagicMock()
+        self._worker_pool.available = True
+        self._worker_pool.failed = False
+        self._request_future_map = {}
+        self._metrics = Metrics()
+        self._handler = ImageGenerateRequestHandler(
+            self._worker_pool, self._request_future_map, metrics=self._metrics
+        )
+        self._image = Image.new("RGB", (8, 8))
+
+    async def _call(self, request, headers=None):
+        task = asyncio.create_task(self._handler(request, _HttpRequest(headers)))
+        await asyncio.sleep(0)
+        request_id = self._worker_pool.submit.call_args.args[0]
+        shared_images = [
+            SharedImage.create(self._image, request.format)
+            for _ in range(request.num_images_per_prompt)
+        ]
+        self._request_future_map[request_id].set_result(shared_images)
+        return await task
+
+    async def test_returns_base64_encoded_image_in_json_by_default(self):
+        response = await self._call(ImageGenerateRequest(input="input"))
+        self.assertIsInstance(response, ImageGenerateResponse)
+        self.assertEqual(ImageFormat.png, response.format)
+        Image.open(BytesIO(base64.b64decode(response.image))).verify()
+        self.assertEqual(1, self._metrics.image_encode.count)
+
+    async def test_returns_every_image_in_json_when_several_are_requested(self):
+        response = await self._call(
+            ImageGenerateRequest(input="input", num_images_per_prompt=2), {"accept": "image/png"}
+        )
+        self.assertIsInstance(response, ImageGenerateResponse)
+        self.assertEqual(2, len(response.images))
+        self.assertEqual(response.images[0], response.image)
+        for image in response.images:
+            Image.open(BytesIO(base64.b64decode(image))).verify()
+
+    async def test_returns_image_bytes_when_image_media_type_is_accepted(self):
+        response = await self._call(
+            ImageGenerateRequest(input="input"), {"accept": "image/png, application/json"}
+        )
+        self.assertIsInstance(response, Response)
+        self.assertEqual("image/png", response.media_type)
+        self.assertEqual("PNG", Image.open(BytesIO(response.body)).format)
+
+    async def test_returns_accepted_media_type_over_requested_format(self):
+        response = await self._call(
+            ImageGenerateRequest(input="input", format=ImageFormat.png), {"accept": "image/gif"}
+        )
+        self.assertEqual("image/gif", response.media_type)
+        self.assertEqual("GIF", Image.open(BytesIO(response.body)).format)
+
+    async def test_returns_webp_image_bytes_when_accepted(self):
+        response = await self._call(ImageGenerateRequest(input="input"), {"accept": "image/webp"})
+        self.assertEqual("image/webp", response.media_type)
+        self.assertEqual("WEBP", Image.open(BytesIO(response.body)).format)
+
+    async def test_encodes_with_the_requested_options(self):
+        self._image = Image.linear_gradient("L").convert("RGB")
+        sizes = []
+        for quality in (5, 95):
+            response = await self._call(
+                ImageGenerateRequest(input="input", format=ImageFormat.jpg, quality=quality),
+                {"accept": "image/jpeg"},
+            )
+            sizes.append(len(response.body))
+        self.assertLess(sizes[0], sizes[1])
+
+    async def test_encodes_several_images_on_the_encoding_threads(self):
+        threads = []
+        encode = SharedImage.encode
+
+        def record_thread(shared_image, *args, **kwargs):
+            threads.append(threading.current_thread().name)
+            return encode(shared_image, *args, **kwargs)
+
+        with patch.object(SharedImage, "encode", record_thread):
+            response = await self._call(
+                ImageGenerateRequest(input="input", num_images_per_prompt=3)
+            )
+        self.assertEqual(3, len(response.images))
+        self.assertEqual(3, len(threads))
+        for name in threads:
+            self.assertTrue(name.startswith("image-encoder"), name)
+
+    async def test_records_the_image_encode_span_within_the_request(self):
+        tracer = MagicMock()
+        self._handler = ImageGenerateRequestHandler(
+            self._worker_pool, self._request_future_map, tracer=tracer
+        )
+        await self._call(ImageGenerateRequest(input="input"))
+        (encode, request) = tracer.span.call_args_list
+        self.assertEqual(("image encode", "request"), (encode.args[1], request.args[1]))
+        self.assertLessEqual(request.args[2], encode.args[2])
+        self.assertLessEqual(encode.args[3], request.args[3])
@@ -0,0 +1,45 @@
+import unittest
+
+import torch
+
+from wrangler.stopping import StopStringCriteria
+
+
+class _Tokenizer:
+    """Tokenizer whose tokens are single characters"""
+
+    @staticmethod
+    def decode(token_ids, skip_special_tokens=False):
+        return "".join(chr(int(token_id)) for token_id in token_ids)
+
+
+def _ids(text):
+    return [ord(character) for character in text]
+
+
+class StopStringCriteriaTestCase(unittest.TestCase):
+    def _criteria(self, stops, max_new_tokens=100, eos_token_id=0):
+        return StopStringCriteria(
+            _Tokenizer(), 2, stops, [max_new_tokens] * len(stops), [eos_token_id]
+        )
+
+    def test_stops_once_every_sequence_has_generated_a_stop_string(self):
+        criteria = self._criteria([["cd"], ["x"]])
+        self.assertFalse(criteria(torch.tensor([_ids("abc"), _ids("abx")]), None))
+        self.assertTrue(criteria(torch.tensor([_ids("abcd"), _ids("abxy")]), None))
+
+    def test_finds_stop_strings_in_several_tokens_added_at_once(self):
+        criteria = self._criteria([["cd"]])
+        self.assertFalse(criteria(torch.tensor([_ids("abc")]), None))
+        # Assisted generation accepts drafted tokens past the end of the stop string
+        self.assertTrue(criteria(torch.tensor([_ids("abcdefgh")]), None))
+
+    def test_finds_end_of_sequence_in_several_tokens_added_at_once(self):
+        criteria = self._criteria([None])
+        self.assertFalse(criteria(torch.tensor([_ids("abc")]), None))
+        self.assertTrue(criteria(torch.tensor([_ids("abc") + [0] + _ids("de")]), None))
+
+    def test_stops_at_max_new_tokens(self):
+        criteria = self._criteria([None], max_new_tokens=3)
+        self.assertFalse(criteria(torch.tensor([_ids("abcd")]), None))
+        self.assertTrue(criteria(torch.tensor([_ids("abcde")]), None))
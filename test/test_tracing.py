@@ -0,0 +1,106 @@
+import json
+import tempfile
+import threading
+import unittest
+from pathlib import Path
+from uuid import uuid4
+
+from wrangler.metrics import Timings
+from wrangler.tracing import Tracer
+
+
+class TracerTestCase(unittest.TestCase):
+    def setUp(self):
+        self._directory = tempfile.TemporaryDirectory()
+        self._path = Path(self._directory.name, "trace")
+        self._request_id = uuid4()
+        self._timings = Timings(
+            started=10.0, model=0.5, tokenize=0.1, decode=0.2, tokens=4, batch_size=2, sent=11.0
+        )
+
+    def tearDown(self):
+        self._directory.cleanup()
+
+    def _trace(self, format_):
+        tracer = Tracer(self._path, format_)
+        tracer.span(self._request_id, "request", 9.0, 12.0, parent=None)
+        tracer.model_spans(self._request_id, "Model worker 0", 9.5, self._timings, 11.25)
+        return tracer
+
+    def test_writes_chrome_trace_events(self):
+        self._trace("chrome").close()
+        events = json.loads(self._path.read_text())
+        processes = {event["pid"]: event["args"]["name"] for event in events if event["ph"] == "M"}
+        self.assertEqual({0: "API", 1: "Model worker 0"}, processes)
+        begins = {event["name"]: event for event in events if event["ph"] == "b"}
+        ends = {event["name"]: event for event in events if event["ph"] == "e"}
+        self.assertEqual(
+            ["request", "queue", "model", "tokenize", "generate", "decode", "response hop"],
+            list(begins)[:7],
+        )
+        self.assertEqual({self._request_id.hex}, {event["id"] for event in begins.values()})
+        self.assertEqual(1, begins["model"]["pid"])
+        self.assertEqual(str(self._request_id), begins["model"]["args"]["request_id"])
+        self.assertEqual(2, begins["model"]["args"]["batch_size"])
+        # Model phases are laid out one after another from the start of processing
+        self.assertEqual(10.1e6, ends["tokenize"]["ts"])
+        self.assertEqual(10.6e6, ends["generate"]["ts"])
+        self.assertAlmostEqual(10.8e6, ends["decode"]["ts"])
+        self.assertEqual(
+            (11.0e6, 11.25e6), (begins["response hop"]["ts"], ends["response hop"]["ts"])
+        )
+
+    def test_chrome_trace_is_readable_before_it_is_closed(self):
+        tracer = self._trace("chrome")
+        tracer.flush()
+        try:
+            events = json.loads(self._path.read_text() + "]")
+        finally:
+            tracer.close()
+        self.assertEqual("request", events[1]["name"])
+
+    def test_writes_spans_off_the_recording_thread(self):
+        tracer = Tracer(self._path, "chrome")
+        write_chrome = tracer._write_chrome
+        threads = []
+
+        def record_thread(*args):
+            threads.append(threading.current_thread())
+            write_chrome(*args)
+
+        tracer._write_chrome = record_thread
+        tracer.span(self._request_id, "request", 9.0, 12.0, parent=None)
+        tracer.close()
+        self.assertEqual(1, len(threads))
+        self.assertIsNot(threading.current_thread(), threads[0])
+        self.assertEqual("request", json.loads(self._path.read_text())[1]["name"])
+
+    def test_writes_otlp_json_lines(self):
+        self._trace("otlp").close()
+        requests = [json.loads(line) for line in self._path.read_text().splitlines()]
+        spans = {}
+        for request in requests:
+            (resource_spans,) = request["resourceSpans"]
+            (scope_spans,) = resource_spans["scopeSpans"]
+            (span,) = scope_spans["spans"]
+            spans[span["name"]] = span
+        self.assertEqual({self._request_id.hex}, {span["traceId"] for span in spans.values()})
+        self.assertNotIn("parentSpanId", spans["request"])
+        self.assertEqual(spans["request"]["spanId"], spans["model"]["parentSpanId"])
+        self.assertEqual(spans["model"]["spanId"], spans["generate"]["parentSpanId"])
+        self.assertEqual(
+            500_000_000,
+            int(spans["generate"]["endTimeUnixNano"]) - int(spans["generate"]["startTimeUnixNano"]),
+        )
+        self.assertIn({"key": "tokens", "value": {"intValue": "4"}}, spans["model"]["attributes"])
+
+    def test_ignores_spans_once_closed(self):
+        tracer = self._trace("otlp")
+        tracer.close()
+        lines = self._path.read_text()
+        tracer.span(self._request_id, "late", 1.0, 2.0)
+        self.assertEqual(lines, self._path.read_text())
+
+    def test_rejects_unknown_formats(self):
+        with self.assertRaises(ValueError):
+            Tracer(self._path, "zipkin")
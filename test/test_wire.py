@@ -0,0 +1,151 @@
+import multiprocessing as mp
+import queue
+import time
+import unittest
+from uuid import uuid4
+
+from wrangler.images import SharedImage
+from wrangler.metrics import Timings
+from wrangler.model_handlers import ModelReady
+from wrangler.models import (
+    ImageFormat,
+    ImageGenerateRequest,
+    TextTransformRequest,
+    TextTransformResponse,
+    TextTransformStreamRequest,
+    TextTransformToken,
+)
+from wrangler.wire import (
+    RequestChannel,
+    ResponseChannel,
+    decode_request,
+    decode_response,
+    encode_request,
+    encode_response,
+)
+
+
+class RequestFrameTestCase(unittest.TestCase):
+    def test_round_trips_every_request_type(self):
+        request_id = uuid4()
+        for request in (
+            TextTransformRequest(input="Stuff ünïcode", do_sample=True, stop=["."]),
+            TextTransformStreamRequest(input="Stuff", max_new_tokens=4),
+            ImageGenerateRequest(input="Cow", format=ImageFormat.jpg, seed=7, width=64),
+        ):
+            with self.subTest(type(request).__name__):
+                actual = decode_request(encode_request(request_id, request, 12.5))
+                self.assertEqual((request_id, request, 12.5), actual)
+                self.assertIs(type(request), type(actual[1]))
+
+    def test_round_trips_requests_without_a_deadline(self):
+        request_id = uuid4()
+        request = TextTransformRequest(input="Stuff")
+        self.assertEqual(
+            (request_id, request, None), decode_request(encode_request(request_id, request, None))
+        )
+
+    def test_image_format_is_rebuilt_as_an_enum(self):
+        request = ImageGenerateRequest(input="Cow", format=ImageFormat.gif)
+        _, actual, _ = decode_request(encode_request(uuid4(), request, None))
+        self.assertIs(ImageFormat.gif, actual.format)
+
+
+class ResponseFrameTestCase(unittest.TestCase):
+    def setUp(self):
+        self._request_id = uuid4()
+        self._timings = Timings(
+            started=1.5,
+            model=0.25,
+            tokenize=0.5,
+            tokens=3,
+            batch_size=2,
+            sent=2.5,
+            draft_tokens=8,
+            accepted_tokens=5,
+            model_passes=4,
+        )
+
+    def _round_trip(self, response, timings=None, request_id=None):
+        request_id = request_id or self._request_id
+        return decode_response(encode_response(request_id, response, timings))
+
+    def test_round_trips_tokens_as_text(self):
+        token = TextTransformToken(text=" ünïcode")
+        self.assertEqual((self._request_id, token, None), self._round_trip(token))
+
+    def test_round_trips_text_responses_and_timings(self):
+        for response in (
+            TextTransformResponse(generated_text="a"),
+            TextTransformResponse(generated_text="a", generated_texts=["a", "bc", ""]),
+        ):
+            with self.subTest(response):
+                self.assertEqual(
+                    (self._request_id, response, self._timings),
+                    self._round_trip(response, self._timings),
+                )
+
+    def test_round_trips_shared_images(self):
+        images = [
+            SharedImage("psm_a", "RGB", (64, 32), ImageFormat.png),
+            SharedImage("psm_b", "L", (8, 8), ImageFormat.jpg),
+        ]
+        self.assertEqual(
+            (self._request_id, images, self._timings), self._round_trip(images, self._timings)
+        )
+
+    def test_round_trips_exceptions(self):
+        request_id, response, timings = self._round_trip(ValueError("Bad"), self._timings)
+        self.assertIsInstance(response, ValueError)
+        self.assertEqual("Bad", str(response))
+        self.assertEqual(self._timings, timings)
+
+    def test_round_trips_model_ready_without_a_request_id(self):
+        request_id, response, timings = decode_response(encode_response(None, ModelReady(), None))
+        self.assertIsNone(request_id)
+        self.assertIsInstance(response, ModelReady)
+        self.assertIsNone(timings)
+
+    def test_tokens_are_framed_compactly(self):
+        frame = encode_response(self._request_id, TextTransformToken(text="abc"), None)
+        self.assertEqual(1 + 16 + 3, len(frame))
+
+
+def _send_tokens(response_channel, request_id, count):
+    for index in range(count):
+        response_channel.put((request_id, TextTransformToken(text=str(index)), None))
+
+
+class ChannelTestCase(unittest.TestCase):
+    def test_request_channel_gets_requests_in_order(self):
+        channel = RequestChannel()
+        items = [(uuid4(), TextTransformRequest(input=str(index)), None) for index in range(3)]
+        for item in items:
+            channel.put(item)
+        self.assertEqual(items, [channel.get(timeout=5) for _ in items])
+        with self.assertRaises(queue.Empty):
+            channel.get(block=False)
+
+    def test_response_channel_ends_once_the_sending_process_exits(self):
+        channel = ResponseChannel()
+        request_id = uuid4()
+        process = mp.Process(target=_send_tokens, args=(channel, request_id, 100))
+        process.start()
+        channel.close_writer()
+        received = []
+        start = time.perf_counter()
+        with self.assertRaises(EOFError):
+            while time.perf_counter() - start < 30:
+                received.append(channel.get()[1].text)
+        process.join()
+        channel.close()
+        self.assertEqual([str(index) for index in range(100)], received)
+
+    def test_response_channel_records_when_responses_were_sent(self):
+        channel = ResponseChannel()
+        timings = Timings(started=time.monotonic())
+        channel.put((uuid4(), TextTransformResponse(generated_text="a"), timings))
+        _, _, received = channel.get()
+        channel.close()
+        self.assertGreaterEqual(received.sent, timings.started)
+        self.assertLessEqual(received.sent, time.monotonic())
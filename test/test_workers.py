@@ -0,0 +1,134 @@
+import unittest
+from pathlib import Path
+from unittest.mock import ANY, MagicMock, patch
+from uuid import uuid4
+
+from wrangler.metrics import Timings
+from wrangler.model_handlers import ProfileRequests
+from wrangler.workers import QueueFullError, WorkerPool, WorkerPoolFailedError, _exit_with_parent
+
+
+class WorkerPoolTestCase(unittest.TestCase):
+    def test_submit_raises_queue_full_error_at_max_queue_depth(self):
+        worker_pool = WorkerPool(MagicMock(), MagicMock(), max_queue_depth=2)
+        worker_pool.submit(uuid4(), MagicMock())
+        worker_pool.submit(uuid4(), MagicMock())
+        with self.assertRaises(QueueFullError):
+            worker_pool.submit(uuid4(), MagicMock())
+        self.assertEqual(2, worker_pool.in_flight)
+
+    def test_cancelled_requests_free_queue_depth(self):
+        worker_pool = WorkerPool(MagicMock(), MagicMock(), max_queue_depth=1)
+        request_id = uuid4()
+        worker_pool.submit(request_id, MagicMock())
+        worker_pool.cancel(request_id)
+        worker_pool.submit(uuid4(), MagicMock())
+        self.assertEqual(1, worker_pool.in_flight)
+
+    def test_is_unavailable_until_started(self):
+        worker_pool = WorkerPool(MagicMock(), MagicMock())
+        self.assertFalse(worker_pool.available)
+
+    def test_is_ready_once_a_running_worker_reports_ready(self):
+        worker_pool = WorkerPool(MagicMock(), MagicMock(), workers=2)
+        first, second = worker_pool._workers
+        first.process = second.process = MagicMock()
+        worker_pool._handle_ready(first)
+        self.assertEqual(1, worker_pool.ready)
+
+    def test_exited_workers_are_not_ready(self):
+        worker_pool = WorkerPool(MagicMock(), MagicMock(), restart_delay=60)
+        worker_pool._loop = MagicMock()
+        (worker,) = worker_pool._workers
+        worker.process = MagicMock()
+        worker_pool._handle_ready(worker)
+        worker_pool._handle_exit(worker)
+        self.assertEqual(0, worker_pool.ready)
+        # Reports from the exited process are ignored
+        worker_pool._handle_ready(worker)
+        self.assertEqual(0, worker_pool.ready)
+
+    @staticmethod
+    def _exit(worker_pool, worker, ready=False, ran=0.0):
+        """Exit a worker which had run for some seconds and return its restart delay"""
+        worker.process = MagicMock()
+        worker.started = 100.0
+        if ready:
+            worker_pool._handle_ready(worker)
+        worker_pool._loop.call_later.reset_mock()
+        with patch("time.monotonic", return_value=100.0 + ran):
+            worker_pool._handle_exit(worker)
+        if not worker_pool._loop.call_later.called:
+            return None
+        return worker_pool._loop.call_later.call_args.args[0]
+
+    def test_restart_delay_backs_off_and_resets_after_running_for_a_while(self):
+        worker_pool = WorkerPool(
+            MagicMock(), MagicMock(), restart_delay=1.0, max_restart_delay=5.0, backoff_reset=60
+        )
+        worker_pool._loop = MagicMock()
+        (worker,) = worker_pool._workers
+        delays = [self._exit(worker_pool, worker, ready=True) for _ in range(5)]
+        self.assertEqual([1.0, 2.0, 4.0, 5.0, 5.0], delays)
+        self.assertEqual(1.0, self._exit(worker_pool, worker, ready=True, ran=60.0))
+
+    def test_stops_restarting_workers_that_repeatedly_fail_to_start(self):
+        on_response = MagicMock()
+        worker_pool = WorkerPool(MagicMock(), on_response, workers=2, max_start_failures=2)
+        worker_pool._loop = MagicMock()
+        first, second = worker_pool._workers
+        self.assertIsNotNone(self._exit(worker_pool, first))
+        self.assertIsNone(self._exit(worker_pool, first))
+        self.assertTrue(first.failed)
+        self.assertFalse(worker_pool.failed)
+        # Requests wait for the worker that is restarting
+        request_id = uuid4()
+        worker_pool.submit(request_id, MagicMock())
+        self.assertIsNotNone(self._exit(worker_pool, second))
+        # A worker that became ready starts counting its failures again
+        self.assertIsNotNone(self._exit(worker_pool, second, ready=True))
+        self.assertIsNotNone(self._exit(worker_pool, second))
+        self.assertIsNone(self._exit(worker_pool, second))
+        self.assertTrue(worker_pool.failed)
+        ((failed_request_id, error),) = [call.args for call in on_response.call_args_list]
+        self.assertEqual(request_id, failed_request_id)
+        self.assertIsInstance(error, WorkerPoolFailedError)
+        with self.assertRaises(WorkerPoolFailedError):
+            worker_pool.submit(uuid4(), MagicMock())
+
+    def test_restarting_the_pool_restarts_failed_workers(self):
+        worker_pool = WorkerPool(MagicMock(), MagicMock(), max_start_failures=1)
+        worker_pool._loop = MagicMock()
+        (worker,) = worker_pool._workers
+        self._exit(worker_pool, worker)
+        self.assertTrue(worker_pool.failed)
+        with patch.object(WorkerPool, "_start_worker"), patch("wrangler.workers.resource_tracker"):
+            worker_pool.start(MagicMock())
+        self.assertFalse(worker_pool.failed)
+
+    def test_records_the_spans_of_responses_in_the_tracer(self):
+        tracer = MagicMock()
+        worker_pool = WorkerPool(MagicMock(), MagicMock(), tracer=tracer)
+        (worker,) = worker_pool._workers
+        request_id = uuid4()
+        worker_pool.submit(request_id, MagicMock())
+        timings = Timings(started=1.0, sent=2.0)
+        worker_pool._handle_response(worker, request_id, MagicMock(), timings, 3.0)
+        tracer.model_spans.assert_called_once_with(request_id, "Model worker 0", ANY, timings, 3.0)
+
+    def test_asks_running_workers_to_profile(self):
+        worker_pool = WorkerPool(MagicMock(), MagicMock(), workers=2)
+        first, second = worker_pool._workers
+        first.process = MagicMock()
+        first.control_queue = MagicMock()
+        self.assertEqual(1, worker_pool.profile(5, Path("profiles")))
+        first.control_queue.put.assert_called_once_with(ProfileRequests(5, Path("profiles")))
+
+
+class ExitWithParentTestCase(unittest.TestCase):
+    def test_exits_once_the_parent_process_has_exited(self):
+        with patch("os.getppid", side_effect=[10, 10, 1]), patch("time.sleep"), patch(
+            "os._exit"
+        ) as exit_:
+            _exit_with_parent(10)
+        exit_.assert_called_once_with(1)